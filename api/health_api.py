@@ -0,0 +1,28 @@
+from fastapi import status
+from fastapi.responses import JSONResponse
+from core.fastapi_util import AppRouter, api_response_data
+from core.constants import Result
+from services.ai_loader import ai_engine
+
+router = AppRouter()
+
+
+@router.get("/health")
+def health():
+    # Liveness: the process is up and serving; never touches the models
+    return api_response_data(Result.SUCCESS.value, {"status": "ok"})
+
+
+@router.get("/health/ready")
+def readiness():
+    # Readiness: 200 once every preloaded model has finished loading (ready, unavailable or failed),
+    # 503 while any is still loading; the per-model state is in the reply either way
+    engine_status = ai_engine.status()
+    if engine_status["ready"]:
+        return api_response_data(Result.SUCCESS.value, engine_status)
+    response = JSONResponse(
+        {"result": Result.ERROR_NOT_READY.value, "reply": engine_status},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+    response.headers["Content-Type"] = 'application/json; charset=utf-8'
+    return response
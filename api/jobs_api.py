@@ -0,0 +1,105 @@
+import os
+import shutil
+from uuid import uuid4
+from fastapi import Depends, UploadFile, File, Form
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from core.fastapi_util import AppRouter, api_response_data
+from core.database import get_db
+from core.config import settings
+from core.constants import Result
+from db import crud
+from db.models import AnalysisJob
+from services.jobs import job_manager
+
+router = AppRouter()
+
+
+def job_to_dict(j: AnalysisJob):
+    return {
+        "id": j.id,
+        "video_id": j.video_id,
+        "status": j.status,
+        "priority": j.priority,
+        "frames_processed": j.frames_processed,
+        "position_sec": j.position_sec,
+        "duration_sec": j.duration_sec,
+        "progress": j.progress,
+        "fps": j.fps,
+        "eta_sec": j.eta_sec,
+        "error": j.error,
+        "created_at": j.created_at.isoformat() if j.created_at else None,
+        "started_at": j.started_at.isoformat() if j.started_at else None,
+        "finished_at": j.finished_at.isoformat() if j.finished_at else None,
+    }
+
+
+def _save_upload(file: UploadFile, path: str):
+    with open(path, "wb") as f:
+        shutil.copyfileobj(file.file, f, 1024 * 1024)
+
+
+@router.post("/jobs")
+async def submit_job(file: UploadFile = File(...), priority: int = Form(0), db: Session = Depends(get_db)):
+    if not file or not file.filename:
+        return api_response_data(Result.ERROR_FILE_NONE.value)
+
+    video_id = uuid4().hex
+    ext = os.path.splitext(file.filename)[1] or ".mp4"
+    os.makedirs(settings.VIDEO_UPLOAD_DIR, exist_ok=True)
+    save_path = os.path.join(settings.VIDEO_UPLOAD_DIR, f"{video_id}{ext}")
+    # Videos can be large: stream to disk off the event loop instead of reading into memory
+    await run_in_threadpool(_save_upload, file, save_path)
+
+    job = crud.create_job(db, video_id=video_id, video_path=save_path, priority=priority)
+    job_manager.wake()
+    return api_response_data(Result.SUCCESS.value, job_to_dict(job))
+
+
+@router.get("/jobs")
+async def list_jobs(skip: int = 0, limit: int = 100, status: str = None, db: Session = Depends(get_db)):
+    items = crud.get_jobs(db, skip=skip, limit=limit, status=status)
+    total = crud.get_jobs_count(db, status=status)
+    return api_response_data(Result.SUCCESS.value, {
+        "items": [job_to_dict(j) for j in items],
+        "total": total,
+        "skip": skip,
+        "limit": limit
+    })
+
+
+@router.get("/jobs/{job_id}")
+async def get_job_detail(job_id: int, db: Session = Depends(get_db)):
+    job = crud.get_job(db, job_id)
+    if not job:
+        return api_response_data(Result.ERROR_NOT_FOUND.value)
+    return api_response_data(Result.SUCCESS.value, job_to_dict(job))
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: int, db: Session = Depends(get_db)):
+    job = crud.cancel_job(db, job_id)
+    if not job:
+        return api_response_data(Result.ERROR_NOT_FOUND.value)
+    return api_response_data(Result.SUCCESS.value, job_to_dict(job))
+
+
+@router.get("/jobs/{job_id}/results")
+async def get_job_results(job_id: int, minutes: bool = False, student_id: int = None, db: Session = Depends(get_db)):
+    # Served from the rollup tables; raw analysis_durations rows are never scanned here
+    job = crud.get_job(db, job_id)
+    if not job:
+        return api_response_data(Result.ERROR_NOT_FOUND.value)
+    totals = {}
+    for row in crud.get_session_rollups(db, job.video_id):
+        totals.setdefault(row.student_id, {}).setdefault(row.category, {})[row.label] = row.seconds
+    reply = {
+        "job": job_to_dict(job),
+        "students": [{"student_id": sid, **cats} for sid, cats in totals.items()],
+    }
+    if minutes:
+        reply["minutes"] = [
+            {"student_id": r.student_id, "minute": r.minute, "category": r.category, "label": r.label, "seconds": r.seconds}
+            for r in crud.get_minute_rollups(db, job.video_id, student_id=student_id)
+        ]
+    return api_response_data(Result.SUCCESS.value, reply)
@@ -1,8 +1,12 @@
 from core.fastapi_util import AppRouter
 from . import auth_api
 from . import students_api
+from . import jobs_api
+from . import health_api
 
 router_api = AppRouter()
 
 router_api.include_router(auth_api.router, prefix="/auth", tags=["Auth API"])
-router_api.include_router(students_api.router, tags=["Students API"])
\ No newline at end of file
+router_api.include_router(students_api.router, tags=["Students API"])
+router_api.include_router(jobs_api.router, tags=["Jobs API"])
+router_api.include_router(health_api.router, tags=["Health API"])
\ No newline at end of file
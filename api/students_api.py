@@ -1,14 +1,17 @@
+import asyncio
 from typing import List, Optional
 from datetime import datetime
 import os
-from fastapi import Depends, UploadFile, File, Request
+from fastapi import Depends, UploadFile, File, Request, status
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from core.fastapi_util import AppRouter, api_response_data
 from core.database import get_db
 from sqlalchemy.orm import Session
 from db import crud
 from db.models import Student
-from services.ai_loader import ai_engine
-from db.vector_db import vector_db_instance
+from services.face_batcher import face_batcher
+from db.vector_db import ReadOnlyVectorDB, vector_db_instance
 from core.config import settings
 from core.constants import Result
 
@@ -38,6 +41,31 @@ def student_to_dict(s: Student):
     }
 
 
+def gallery_unavailable(error: ReadOnlyVectorDB):
+    # 503 when the face gallery writer cannot take a change; the request left no rows or files behind
+    response = JSONResponse(
+        {"result": Result.ERROR_NOT_READY.value, "reply": None, "message": str(error)},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+    response.headers["Content-Type"] = 'application/json; charset=utf-8'
+    return response
+
+
+def upload_file(web_path: str):
+    # Disk path of an /uploads/... photo path, None for anything else
+    if not web_path or not web_path.startswith("/uploads/"):
+        return None
+    return os.path.join(settings.UPLOAD_DIR, os.path.basename(web_path))
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
 @router.get("/students")
 async def list_students(skip: int = 0, limit: int = 100, search: str = None, status: str = None, db: Session = Depends(get_db)):
     items = crud.get_students(db, skip=skip, limit=limit, search=search, status=status)
@@ -69,6 +97,7 @@ async def list_student_photos(student_id: int, skip: int = 0, limit: int = 100,
             "id": p.id,
             "student_id": p.student_id,
             "photo_path": p.photo_path,
+            "has_embedding": p.embedding_id is not None,
             "created_at": p.created_at.isoformat() if getattr(p, "created_at", None) else None,
         }
         for p in items
@@ -199,10 +228,36 @@ async def update_student(student_id: int, request: Request, db: Session = Depend
 
 @router.delete("/students/{student_id}")
 async def delete_student(student_id: int, db: Session = Depends(get_db)):
-    ok = crud.delete_student(db, student_id)
-    if not ok:
+    s = crud.get_student(db, student_id)
+    if not s:
         return api_response_data(Result.ERROR_NOT_FOUND.value)
-    return api_response_data(Result.SUCCESS.value, {"success": True})
+    # Embeddings first: if the gallery cannot be changed, the student stays as it was. On a reader worker the
+    # change is a round trip to the gallery writer, so it runs off the event loop.
+    try:
+        removed = await run_in_threadpool(vector_db_instance.remove_student, student_id)
+    except ReadOnlyVectorDB as e:
+        return gallery_unavailable(e)
+    web_paths = {s.photo_path} | {photo.photo_path for photo in crud.get_student_photos(db, student_id, limit=None)}
+    crud.delete_student(db, student_id)  # with its photo rows
+    remove_files(path for path in map(upload_file, web_paths) if path)
+    return api_response_data(Result.SUCCESS.value, {"success": True, "embeddings_removed": removed})
+
+
+@router.delete("/students/{student_id}/photos/{photo_id}")
+async def delete_student_photo(student_id: int, photo_id: int, db: Session = Depends(get_db)):
+    photo = crud.get_student_photo(db, photo_id)
+    if not photo or photo.student_id != student_id:
+        return api_response_data(Result.ERROR_NOT_FOUND.value)
+    try:
+        removed = 0
+        if photo.embedding_id is not None:
+            removed = await run_in_threadpool(vector_db_instance.remove_embeddings, [photo.embedding_id])
+    except ReadOnlyVectorDB as e:
+        return gallery_unavailable(e)
+    crud.delete_student_photo(db, photo_id)
+    if removed:
+        crud.update_student(db, student_id, face_embedding_count_inc=-removed)
+    return api_response_data(Result.SUCCESS.value, {"success": True, "embeddings_removed": removed})
 
 
 @router.post("/students/{student_id}/face")
@@ -219,24 +274,33 @@ async def upload_student_face(student_id: int, file: UploadFile = File(...), db:
     with open(save_path, "wb") as f:
         f.write(data)
     web_photo_path = f"/uploads/{base_name}"
+
+    import cv2
+    import numpy as np
+    embedding_id = None
+    nparr = np.frombuffer(data, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img is not None:
+        # Runs on the shared face batcher thread (None when the identity model is unavailable)
+        faces = await face_batcher.embed(img)
+        if faces and len(faces) == 1:
+            embedding = getattr(faces[0], "embedding", None)
+            if embedding is not None:
+                # Into the gallery before any row is written, so a gallery that cannot be changed leaves nothing behind
+                try:
+                    embedding_id = await run_in_threadpool(vector_db_instance.add_embedding, student_id, embedding.reshape(1, -1))
+                except ReadOnlyVectorDB as e:
+                    remove_files([save_path])
+                    return gallery_unavailable(e)
     try:
-        crud.create_student_photo(db, student_id, web_photo_path)
+        rec = crud.create_student_photo(db, student_id, web_photo_path)
     except Exception:
-        pass
-
-    if ai_engine.identity_model is not None:
-        import cv2
-        import numpy as np
-        nparr = np.frombuffer(data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        if img is not None:
-            faces = ai_engine.identity_model.get(img)
-            if faces and len(faces) == 1:
-                embedding = getattr(faces[0], "embedding", None)
-                if embedding is not None:
-                    vector_db_instance.add_embedding(student_id, embedding.reshape(1, -1))
-                    s = crud.update_student(db, student_id, photo_path=web_photo_path, face_embedding_count_inc=1)
-                    return api_response_data(Result.SUCCESS.value, student_to_dict(s))
+        rec = None
+    if embedding_id is not None:
+        if rec is not None:
+            crud.set_photo_embeddings(db, [(rec.id, embedding_id)])
+        s = crud.update_student(db, student_id, photo_path=web_photo_path, face_embedding_count_inc=1)
+        return api_response_data(Result.SUCCESS.value, student_to_dict(s))
     # Fallback: save photo only
     s = crud.update_student(db, student_id, photo_path=web_photo_path)
     return api_response_data(Result.SUCCESS.value, student_to_dict(s))
@@ -253,8 +317,8 @@ async def upload_student_faces_batch(student_id: int, files: List[UploadFile] =
 
     ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
     os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
-    added = []
-    embed_added = 0
+    saved = []  # (file path, web path) per upload
+    pending = []  # (upload index, face batcher future); all photos of the upload are embedded together
 
     for i, file in enumerate(files):
         data = await file.read()
@@ -262,7 +326,40 @@ async def upload_student_faces_batch(student_id: int, files: List[UploadFile] =
         save_path = os.path.join(settings.UPLOAD_DIR, base_name)
         with open(save_path, "wb") as f:
             f.write(data)
-        web_photo_path = f"/uploads/{base_name}"
+        saved.append((save_path, f"/uploads/{base_name}"))
+
+        import cv2
+        import numpy as np
+        nparr = np.frombuffer(data, np.uint8)
+        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        if img is not None:
+            pending.append((i, asyncio.wrap_future(face_batcher.submit(img))))
+
+    embeddings = []
+    embedded = []  # upload index of each embedding
+    results = await asyncio.gather(*(future for _, future in pending), return_exceptions=True)
+    for (i, _), faces in zip(pending, results):
+        if isinstance(faces, Exception) or not faces or len(faces) != 1:
+            continue
+        embedding = getattr(faces[0], "embedding", None)
+        if embedding is not None:
+            embeddings.append(embedding.reshape(-1))
+            embedded.append(i)
+    embedding_of = {}
+    if embeddings:
+        # Into the gallery before any row is written, so a gallery that cannot be changed leaves nothing behind
+        try:
+            embedding_ids = await run_in_threadpool(
+                vector_db_instance.add_embeddings, [student_id] * len(embeddings), np.stack(embeddings))
+        except ReadOnlyVectorDB as e:
+            remove_files(path for path, _ in saved)
+            return gallery_unavailable(e)
+        embedding_of = dict(zip(embedded, embedding_ids.tolist()))
+    embed_added = len(embedding_of)
+
+    added = []
+    links = []
+    for i, (_, web_photo_path) in enumerate(saved):
         try:
             rec = crud.create_student_photo(db, student_id, web_photo_path)
         except Exception:
@@ -271,22 +368,10 @@ async def upload_student_faces_batch(student_id: int, files: List[UploadFile] =
             "photo_path": web_photo_path,
             "id": getattr(rec, "id", None)
         })
-
-        if ai_engine.identity_model is not None:
-            try:
-                import cv2
-                import numpy as np
-                nparr = np.frombuffer(data, np.uint8)
-                img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                if img is not None:
-                    faces = ai_engine.identity_model.get(img)
-                    if faces and len(faces) == 1:
-                        embedding = getattr(faces[0], "embedding", None)
-                        if embedding is not None:
-                            vector_db_instance.add_embedding(student_id, embedding.reshape(1, -1))
-                            embed_added += 1
-            except Exception:
-                pass
+        if rec is not None and i in embedding_of:
+            links.append((rec.id, embedding_of[i]))
+    if links:
+        crud.set_photo_embeddings(db, links)
 
     if embed_added:
         s = crud.update_student(db, student_id, face_embedding_count_inc=embed_added)
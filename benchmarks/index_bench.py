@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+import faiss
+import numpy as np
+
+from benchmarks.pipeline_bench import _git_commit
+from db.faiss_index import (ENCODINGS, INDEX_TYPES, build_index, configure_search, export_vectors, measure_recall,
+                            memory_footprint, reconstruct_positions)
+from db.gallery import CentroidGallery
+
+# Recall and query cost of the gallery index types against an exact flat scan.
+#
+#   python -m benchmarks.index_bench --students 10000 --photos 4
+#   python -m benchmarks.index_bench --index data_storage/faiss_index.bin --nprobe 4 16 64
+#   python -m benchmarks.index_bench --types flat ivf --encodings float32 fp16 int8 pq
+#
+# Synthetic galleries are unit-norm student "identities" with a few noisy photos each; queries are new
+# noisy photos of random students. With --index, the vectors of an existing index are used and the
+# queries are perturbed copies of them. Every result carries the memory the index takes against storing the
+# same vectors as float32 (saved_pct), next to its recall against an exact float32 flat scan.
+
+
+def make_gallery(students: int, photos: int, dim: int = 512, noise: float = 0.04, queries: int = 500, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(students, dim)).astype('float32')
+    faiss.normalize_L2(centers)
+
+    def photos_of(student_ids):
+        x = centers[student_ids] + rng.normal(scale=noise, size=(len(student_ids), dim)).astype('float32')
+        faiss.normalize_L2(x)
+        return x
+
+    ids = np.repeat(np.arange(1, students + 1, dtype=np.int64), photos)
+    vectors = photos_of(ids - 1)
+    query_vectors = photos_of(rng.integers(0, students, size=queries))
+    return vectors, ids, query_vectors
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare FAISS index types for the face gallery against flat search.")
+    parser.add_argument("--index", help="existing index file to take the vectors from (default: synthetic gallery)")
+    parser.add_argument("--students", type=int, default=5000)
+    parser.add_argument("--photos", type=int, default=4, help="photos per synthetic student")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--noise", type=float, default=0.04, help="per-dimension photo noise (0.04 ~ 0.75 cosine)")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = ~4*sqrt(vectors))")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=80)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--encodings", nargs="+", choices=ENCODINGS, default=["float32"],
+                        help="vector encodings to build each index type with (pq: IVF only)")
+    parser.add_argument("--pq-m", type=int, default=64, help="PQ code bytes per vector")
+    parser.add_argument("--rerank", type=int, default=0, help="PQ candidates re-scored against fp16 copies (0 = codes only)")
+    parser.add_argument("--centroids", action="store_true",
+                        help="also measure the per-student centroid gallery (FAISS_GALLERY_MODE=centroids)")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[5], help="centroid gallery shortlist sizes")
+    parser.add_argument("--vote-k", type=int, default=5)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def _search_settings(kind, args):
+    if kind == "ivf":
+        return [{"nprobe": n} for n in args.nprobe]
+    if kind == "hnsw":
+        return [{"ef_search": ef} for ef in args.ef_search]
+    return [{}]
+
+
+def _centroid_results(vectors, ids, queries, args):
+    # Top-1 student agreement of the centroid gallery (with photo re-ranking) with a flat scan
+    exact = build_index("flat", vectors.shape[1], vectors, ids)
+    started = time.perf_counter()
+    _, truth = exact.search(queries, 1)
+    flat_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    started = time.perf_counter()
+    gallery = CentroidGallery(vectors.shape[1])
+    gallery.add(ids, np.arange(len(ids)), vectors)
+    build_sec = time.perf_counter() - started
+    results = []
+    for candidates in args.candidates:
+        started = time.perf_counter()
+        matches = gallery.identify(queries, lambda positions: reconstruct_positions(exact, positions),
+                                   candidates, args.vote_k)
+        query_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        recall = float(np.mean([student_id == t for (student_id, _), t in zip(matches, truth[:, 0].tolist())]))
+        results.append({"type": "centroids", "candidates": candidates, "vote_k": args.vote_k,
+                        "build_sec": round(build_sec, 3), "students": len(gallery), "queries": len(queries),
+                        "recall_at_1": round(recall, 4), "query_ms": round(query_ms, 4),
+                        "flat_query_ms": round(flat_ms, 4)})
+        print(f"centroids candidates={candidates} vote_k={args.vote_k}  recall@1 {recall:.4f}  "
+              f"{query_ms:.3f} ms/query (flat {flat_ms:.3f})  {len(gallery)} students", file=sys.stderr)
+    return results
+
+
+def run(args):
+    if args.index:
+        vectors, ids = export_vectors(faiss.read_index(args.index))
+        rng = np.random.default_rng(args.seed)
+        rows = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+        queries = vectors[rows] + rng.normal(scale=args.noise, size=(len(rows), vectors.shape[1])).astype('float32')
+        faiss.normalize_L2(queries)
+    else:
+        vectors, ids, queries = make_gallery(args.students, args.photos, args.dim, args.noise, args.queries, args.seed)
+
+    results = []
+    raw_bytes = vectors.shape[1] * 4
+    for kind in args.types:
+        for encoding in args.encodings:
+            if encoding == "pq" and kind != "ivf":
+                continue
+            started = time.perf_counter()
+            index = build_index(kind, vectors.shape[1], vectors, ids, nlist=args.nlist, hnsw_m=args.hnsw_m,
+                                ef_construction=args.ef_construction, encoding=encoding, pq_m=args.pq_m,
+                                rerank=args.rerank)
+            build_sec = time.perf_counter() - started
+            memory = memory_footprint(index)
+            saved_pct = round(100 * (1 - memory["bytes_per_vector"] / raw_bytes), 1)
+            scan_saved_pct = round(100 * (1 - memory["scan_bytes_per_vector"] / raw_bytes), 1)
+            for params in _search_settings(kind, args):
+                configure_search(index, **params)
+                recall = measure_recall(index, vectors, ids, queries, k=args.k)
+                results.append({"type": kind, "encoding": encoding, **params, "build_sec": round(build_sec, 3),
+                                 "size_mb": memory["index_mb"], **memory, "saved_pct": saved_pct,
+                                 "scan_saved_pct": scan_saved_pct, **recall})
+                print(f"{kind:5s} {encoding:7s} {json.dumps(params):20s} recall@1 {recall['recall_at_1']:.4f}  "
+                      f"recall@{recall['k']} {recall['recall_at_k']:.4f}  {recall['query_ms']:.3f} ms/query "
+                      f"(flat {recall['flat_query_ms']:.3f})  build {build_sec:.1f}s  {memory['index_mb']:.1f} MB "
+                      f"({saved_pct:.0f}% saved, scan {memory['scan_mb']:.1f} MB)", file=sys.stderr)
+
+    if args.centroids:
+        results.extend(_centroid_results(vectors, ids, queries, args))
+
+    return {
+        "benchmark": "index",
+        "commit": _git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "faiss": faiss.__version__, "faiss_threads": faiss.omp_get_max_threads()},
+        "config": {
+            "source": args.index or "synthetic",
+            "vectors": len(vectors),
+            "students": len(np.unique(ids)),
+            "dim": int(vectors.shape[1]),
+            "noise": args.noise,
+            "queries": len(queries),
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
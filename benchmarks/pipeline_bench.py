@@ -0,0 +1,217 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+# End-to-end throughput benchmark for run_analysis_pipeline on a synthetic video.
+#
+#   python -m benchmarks.pipeline_bench --duration 120 --students 30 --output bench.json
+#   python -m benchmarks.pipeline_bench --set PIPELINE_MODE=sequential --baseline bench.json
+#
+# Database, FAISS index and video live in a scratch directory, so the application's data_storage is
+# never touched. With --engine stub (the default) no model weights or network access are needed.
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+
+
+def _rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _latency(per_call_ms: float, per_item_ms: float):
+    return per_call_ms / 1000, per_item_ms / 1000
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the video analysis pipeline on a synthetic video.")
+    parser.add_argument("--duration", type=float, default=60.0, help="video length in seconds")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=25.0)
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=["stub", "real"], default="stub",
+                        help="stub: deterministic fake models; real: AIEngine with the weights in models/")
+    parser.add_argument("--yolo-ms", type=float, nargs=2, default=[30.0, 8.0], metavar=("CALL", "FRAME"),
+                        help="stub YOLO latency per call and per frame")
+    parser.add_argument("--face-detect-ms", type=float, nargs=2, default=[3.0, 0.0], metavar=("CALL", "ITEM"))
+    parser.add_argument("--face-embed-ms", type=float, nargs=2, default=[2.0, 1.0], metavar=("CALL", "FACE"))
+    parser.add_argument("--emotion-ms", type=float, nargs=2, default=[5.0, 0.5], metavar=("CALL", "FACE"))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE",
+                        help="settings override for the run, e.g. PIPELINE_BATCH_SIZE=16 (repeatable)")
+    parser.add_argument("--workdir", help="scratch directory (default: a new temporary directory)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against (summary on stderr)")
+    return parser.parse_args(argv)
+
+
+def _configure_environment(args, workdir: Path):
+    # Must run before core.config is imported: settings are read from the environment once
+    overrides = {}
+    for item in args.overrides:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise SystemExit(f"--set expects KEY=VALUE, got {item!r}")
+        overrides[key.strip()] = value.strip()
+    os.environ.update(overrides)
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir / 'bench.db'}"
+    os.environ["FAISS_INDEX_FILE"] = str(workdir / "faiss_index.bin")
+    os.environ["METADATA_FILE"] = str(workdir / "metadata.json")
+    os.environ["FAISS_WAL_FILE"] = str(workdir / "faiss_index.wal")
+    os.environ["FAISS_ROLE"] = "writer"  # the scratch gallery is this process's own
+    os.environ["FAISS_WRITER_SOCKET"] = ""  # next to the scratch index, never the API writer's socket
+    os.environ.setdefault("JOBS_ENABLED", "false")
+    return overrides
+
+
+def _video_path(args, workdir: Path):
+    name = f"synthetic_{args.width}x{args.height}_{args.fps:g}fps_{args.duration:g}s_{args.students}s_{args.seed}.avi"
+    return workdir / name
+
+
+def run(args):
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="pipeline_bench_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    overrides = _configure_environment(args, workdir)
+
+    from benchmarks.synthetic import StubEngine, make_video
+    from core.config import settings
+    from core.database import Base, engine as db_engine
+    from db import models as db_models  # noqa: F401
+    from db.vector_db import vector_db_instance
+    from services.pipeline import run_analysis_pipeline
+
+    Base.metadata.create_all(bind=db_engine)
+    video = _video_path(args, workdir)
+    if not video.exists():
+        generated = time.perf_counter()
+        make_video(video, args.duration, args.width, args.height, args.fps, args.students, args.seed)
+        print(f"Synthetic video written in {time.perf_counter() - generated:.1f}s: {video}", file=sys.stderr)
+
+    if args.engine == "stub":
+        engine = StubEngine(args.students, args.width, args.height, latency={
+            "yolo": _latency(*args.yolo_ms),
+            "face_detect": _latency(*args.face_detect_ms),
+            "face_embed": _latency(*args.face_embed_ms),
+            "emotion": _latency(*args.emotion_ms),
+        }, dim=settings.EMBEDDING_DIM, seed=args.seed)
+        # Enroll the synthetic students so recognition resolves identities as it would in production
+        if vector_db_instance.index.ntotal == 0:
+            for student_id, embedding in enumerate(engine.embeddings, start=1):
+                vector_db_instance.add_embedding(student_id, embedding.reshape(1, -1))
+    else:
+        from services.ai_loader import ai_engine as engine
+
+    rss_before = _rss_mb()
+    runs = []
+    for i in range(max(1, args.repeat)):
+        started = time.perf_counter()
+        result = run_analysis_pipeline(str(video), f"bench-{i}", engine=engine)
+        elapsed = time.perf_counter() - started
+        if result is None:
+            raise SystemExit("pipeline run failed (see output above)")
+        profile = result.get("profile") or {}
+        runs.append({
+            "elapsed_sec": round(elapsed, 4),
+            "frames_processed": result["frames_processed"],
+            "fps": round(result["frames_processed"] / elapsed, 3) if elapsed > 0 else 0.0,
+            "video_sec_per_sec": round(args.duration / elapsed, 3) if elapsed > 0 else 0.0,
+            "students_seen": len(result["student_behavior_time"]),
+            "stages": profile.get("stages", {}),
+            "queues": profile.get("queues", {}),
+        })
+
+    fps = [r["fps"] for r in runs]
+    stage_names = sorted({name for r in runs for name in r["stages"]})
+    return {
+        "benchmark": "pipeline",
+        "commit": _git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {
+            "video": {"duration_sec": args.duration, "width": args.width, "height": args.height, "fps": args.fps,
+                      "students": args.students, "seed": args.seed},
+            "engine": args.engine,
+            "stub_latency_ms": None if args.engine != "stub" else {
+                "yolo": args.yolo_ms, "face_detect": args.face_detect_ms,
+                "face_embed": args.face_embed_ms, "emotion": args.emotion_ms,
+            },
+            "overrides": overrides,
+            "settings": {key: getattr(settings, key) for key in sorted(type(settings).model_fields)
+                         if key.startswith(("PIPELINE_", "INFERENCE_", "ONNX_", "ANALYSIS_"))},
+        },
+        "summary": {
+            "runs": len(runs),
+            "fps_median": round(statistics.median(fps), 3),
+            "fps_min": min(fps),
+            "fps_max": max(fps),
+            # Median per-stage seconds across runs
+            "stage_sec": {name: round(statistics.median(r["stages"].get(name, {}).get("total_sec", 0.0) for r in runs), 4)
+                          for name in stage_names},
+        },
+        "memory": {
+            "rss_before_mb": round(rss_before, 1),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "peak_rss_delta_mb": round(_peak_rss_mb() - rss_before, 1),
+        },
+        "runs": runs,
+    }
+
+
+def compare(report, baseline):
+    # One line per metric: baseline -> current (ratio); higher fps and lower stage time are better
+    lines = []
+    old, new = baseline["summary"]["fps_median"], report["summary"]["fps_median"]
+    lines.append(f"fps_median: {old} -> {new} ({new / old:.2f}x)" if old else f"fps_median: {old} -> {new}")
+    for name in sorted(set(baseline["summary"]["stage_sec"]) | set(report["summary"]["stage_sec"])):
+        old = baseline["summary"]["stage_sec"].get(name, 0.0)
+        new = report["summary"]["stage_sec"].get(name, 0.0)
+        lines.append(f"  {name}: {old}s -> {new}s" + (f" ({new / old:.2f}x)" if old else ""))
+    old, new = baseline["memory"]["peak_rss_mb"], report["memory"]["peak_rss_mb"]
+    lines.append(f"peak_rss_mb: {old} -> {new}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Progress prints from the pipeline and the loaders go to stderr; stdout carries only the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import time
+
+import cv2
+import numpy as np
+import torch
+
+# Synthetic classroom videos and a deterministic stand-in for AIEngine, so the pipeline can be
+# benchmarked offline without the model weights. The stub knows the seating layout the video was
+# drawn with and answers from it; the latencies stand in for model inference.
+
+BEHAVIORS = {0: "hand-raising", 1: "reading", 2: "writing", 3: "sleeping", 4: "using-phone"}
+EMOTIONS = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
+
+
+def seat_layout(students: int, width: int, height: int):
+    # (x1, y1, x2, y2) person boxes on a grid that fills the frame
+    cols = max(1, int(np.ceil(np.sqrt(students * width / height))))
+    rows = max(1, int(np.ceil(students / cols)))
+    cell_w, cell_h = width // cols, height // rows
+    seats = []
+    for i in range(students):
+        row, col = divmod(i, cols)
+        x1, y1 = col * cell_w + cell_w // 8, row * cell_h + cell_h // 10
+        seats.append((x1, y1, x1 + cell_w * 3 // 4, y1 + cell_h * 4 // 5))
+    return seats
+
+
+def head_box(seat):
+    x1, y1, x2, y2 = seat
+    w, h = x2 - x1, y2 - y1
+    return (x1 + w * 3 // 8, y1, x1 + w * 5 // 8, y1 + h // 4)
+
+
+def make_video(path, duration_sec: float, width: int, height: int, fps: float, students: int, seed: int = 0):
+    # Students sway a little and change colour (i.e. behavior) every few seconds; some sampled
+    # frames are static and some are not, so adaptive sampling has something to do
+    rng = np.random.default_rng(seed)
+    seats = seat_layout(students, width, height)
+    palette = rng.integers(40, 255, size=(len(BEHAVIORS), 3))
+    phases = rng.uniform(0, 2 * np.pi, size=students)
+    background = np.tile(np.linspace(60, 120, width, dtype=np.uint8)[None, :, None], (height, 1, 3))
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"cannot write {path}")
+    try:
+        for index in range(int(round(duration_sec * fps))):
+            t = index / fps
+            frame = background.copy()
+            for i, (x1, y1, x2, y2) in enumerate(seats):
+                dx = int(4 * np.sin(t + phases[i]))
+                color = palette[(i + int(t // 5)) % len(BEHAVIORS)].tolist()
+                cv2.rectangle(frame, (x1 + dx, y1 + (y2 - y1) // 4), (x2 + dx, y2), color, -1)
+                hx1, hy1, hx2, hy2 = head_box((x1 + dx, y1, x2 + dx, y2))
+                cv2.ellipse(frame, ((hx1 + hx2) // 2, (hy1 + hy2) // 2), ((hx2 - hx1) // 2, (hy2 - hy1) // 2),
+                            0, 0, 360, (170, 190, 220), -1)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+class _Box:
+    __slots__ = ("xyxy", "cls", "conf")
+
+    def __init__(self, xyxy, cls_id):
+        self.xyxy = [xyxy]
+        self.cls = [cls_id]
+        self.conf = [0.9]
+
+
+class _Result:
+    __slots__ = ("boxes",)
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class _Face:
+    # Same attributes the pipeline reads from insightface's Face
+    def __init__(self, bbox, kps, det_score=0.9):
+        self.bbox = bbox
+        self.kps = kps
+        self.det_score = det_score
+        self.embedding = None
+
+
+class _StubBehaviorModel:
+    names = BEHAVIORS
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __call__(self, frames, device=None, verbose=False):
+        engine = self.engine
+        engine._wait(engine.latency["yolo"], len(frames))
+        results = []
+        for frame in frames:
+            # The behavior is read off the body colour, so it changes with the video
+            boxes = []
+            for x1, y1, x2, y2 in engine.seats:
+                pixel = frame[min(y2 - 2, frame.shape[0] - 1), (x1 + x2) // 2]
+                boxes.append(_Box([x1, y1, x2, y2], int(pixel.sum()) % len(BEHAVIORS)))
+            results.append(_Result(boxes))
+        return results
+
+
+class _StubEmotionModel:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __call__(self, batch):
+        self.engine._wait(self.engine.latency["emotion"], batch.shape[0])
+        classes = (batch.mean(dim=(1, 2, 3)) * 1000).long() % len(EMOTIONS)
+        return torch.nn.functional.one_hot(classes, len(EMOTIONS)).float()
+
+
+class StubEngine:
+    # Drop-in for AIEngine (behavior_model, identity_model, emotion_model, detect_faces, embed_faces).
+    # latency maps a stage ("yolo", "face_detect", "face_embed", "emotion") to (per call, per item) seconds.
+    # Boxes are in source-video pixels, so frames must be decoded at native size (PIPELINE_DECODE_MAX_WIDTH=0).
+    def __init__(self, students: int, width: int, height: int, latency: dict = None, dim: int = 512, seed: int = 0):
+        self.device = "cpu"
+        self.seats = seat_layout(students, width, height)
+        self.heads = np.array([head_box(seat) for seat in self.seats], dtype=np.float32)
+        self.frame_shape = (height, width)
+        self.latency = {"yolo": (0.0, 0.0), "face_detect": (0.0, 0.0), "face_embed": (0.0, 0.0), "emotion": (0.0, 0.0)}
+        self.latency.update(latency or {})
+        rng = np.random.default_rng(seed)
+        embeddings = rng.standard_normal((students, dim)).astype(np.float32)
+        self.embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.behavior_model = _StubBehaviorModel(self)
+        self.identity_model = self
+        self.emotion_model = _StubEmotionModel(self)
+        self.emotion_classes = EMOTIONS
+
+    @staticmethod
+    def _wait(latency, items):
+        per_call, per_item = latency
+        seconds = per_call + per_item * items
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def emotion_transform(self, rgb):
+        crop = cv2.resize(rgb, (224, 224), interpolation=cv2.INTER_LINEAR)
+        return torch.from_numpy(crop.transpose(2, 0, 1).astype(np.float32) / 255.0)
+
+    def detect_faces(self, img):
+        # A full frame gets every head; a person crop gets the head at the top of the crop
+        height, width = img.shape[:2]
+        if (height, width) == self.frame_shape:
+            boxes = self.heads
+        else:
+            boxes = np.array([[width * 0.375, 0, width * 0.625, height * 0.25]], dtype=np.float32)
+        self._wait(self.latency["face_detect"], 1)
+        faces = []
+        for x1, y1, x2, y2 in boxes:
+            cx, cy, w = (x1 + x2) / 2, (y1 + y2) / 2, x2 - x1
+            kps = np.array([[cx - w / 5, cy - w / 8], [cx + w / 5, cy - w / 8], [cx, cy],
+                            [cx - w / 6, cy + w / 5], [cx + w / 6, cy + w / 5]], dtype=np.float32)
+            faces.append(_Face(np.array([x1, y1, x2, y2], dtype=np.float32), kps))
+        return faces
+
+    def embed_faces(self, img, faces):
+        # Each face gets the embedding of the seat whose head centre is nearest
+        if not faces:
+            return faces
+        self._wait(self.latency["face_embed"], len(faces))
+        centres = (self.heads[:, :2] + self.heads[:, 2:]) / 2
+        for face in faces:
+            centre = (face.bbox[:2] + face.bbox[2:4]) / 2
+            face.embedding = self.embeddings[int(np.argmin(((centres - centre) ** 2).sum(1)))].copy()
+        return faces
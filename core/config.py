@@ -10,7 +10,103 @@ class Settings(BaseSettings):
     FAISS_INDEX_FILE: str = str(_BASE_DIR / "data_storage" / "faiss_index.bin")
     METADATA_FILE: str = str(_BASE_DIR / "data_storage" / "metadata.json")
     UPLOAD_DIR: str = str(_BASE_DIR / "data_storage" / "uploads")
+    VIDEO_UPLOAD_DIR: str = str(_BASE_DIR / "data_storage" / "videos")
     FAISS_THRESHOLD_COSINE: float = 0.6
+    FAISS_WAL_FILE: str = str(_BASE_DIR / "data_storage" / "faiss_index.wal")  # inserts since the last snapshot
+    FAISS_WAL_FSYNC: bool = True  # fsync every logged insert
+    FAISS_SNAPSHOT_EVERY: int = 1000  # logged inserts that trigger a background snapshot
+    FAISS_SNAPSHOT_INTERVAL_SEC: float = 300.0  # snapshot pending inserts at least this often
+    FAISS_INDEX_TYPE: str = "ivf"  # flat | ivf | hnsw: what the gallery is promoted to (flat = always exact)
+    FAISS_PROMOTE_AT: int = 20000  # vectors before a flat gallery is rebuilt as FAISS_INDEX_TYPE
+    FAISS_PROMOTE_MIN_RECALL: float = 0.95  # recall@1 vs a flat scan a rebuilt index needs to go live
+    FAISS_RETRAIN_GROWTH: float = 2.0  # retrain IVF centroids once the gallery is this many times their training size
+    FAISS_IVF_NLIST: int = 0  # 0 = ~4*sqrt(vectors)
+    FAISS_IVF_NPROBE: int = 16  # lists scanned per query
+    FAISS_HNSW_M: int = 32
+    FAISS_HNSW_EF_CONSTRUCTION: int = 80
+    FAISS_HNSW_EF_SEARCH: int = 64  # candidates explored per query
+    FAISS_COMPACT_RATIO: float = 0.2  # share of removed (tombstoned) embeddings that triggers a background rebuild
+    FAISS_ENCODING: str = "float32"  # float32 | fp16 | int8 | pq (IVF only): 2 KB, 1 KB, 512 B, FAISS_PQ_M B a vector
+    FAISS_PQ_M: int = 64  # PQ code bytes per vector (must divide EMBEDDING_DIM)
+    FAISS_PQ_RERANK: int = 0  # >0: PQ candidates per result re-scored against fp16 copies. Better recall, but the copies add 1 KB a vector, so PQ then needs about as much heap as fp16 unless readers use FAISS_MMAP
+    FAISS_GALLERY_MODE: str = "photos"  # photos | centroids (first pass over one centroid per student)
+    FAISS_GALLERY_CANDIDATES: int = 5  # students whose photos are re-ranked in centroid mode
+    FAISS_GALLERY_VOTE_K: int = 5  # most similar candidate photos that vote for the identity
+    FAISS_ROLE: str = ""  # auto | writer | reader; empty: API workers take the writer lock first-come (auto), every other process reads
+    FAISS_WRITER_SOCKET: str = ""  # where the writer takes readers' changes (empty: next to FAISS_INDEX_FILE)
+    FAISS_WRITER_AUTHKEY: str = ""  # shared secret for that socket's handshake (the socket itself is 0600)
+    FAISS_WRITER_TIMEOUT_SEC: float = 30.0  # a forwarded change unanswered this long fails with WriterUnavailable
+    FAISS_MMAP: bool = False  # readers memory-map the published index read-only instead of loading it onto the heap
+    FAISS_READER_REFRESH_SEC: float = 2.0  # how often readers look for new snapshots and logged changes
+
+    # Video analysis pipeline
+    PIPELINE_BATCH_SIZE: int = 8  # sampled frames per YOLO call (1 = frame by frame)
+    PIPELINE_MODE: str = "threaded"  # threaded | sequential
+    PIPELINE_QUEUE_SIZE: int = 4  # batches buffered between two stages
+    PIPELINE_SAMPLE_INTERVAL_SEC: float = 1.0
+    PIPELINE_DECODE_BACKEND: str = "grab"  # read | grab | seek
+    PIPELINE_DECODE_MAX_WIDTH: int = 0  # downscale decoded frames wider than this (0 = native); applied after a full-resolution decode, so it cuts inference cost, not decode time
+    PIPELINE_EMOTION_BATCH_SIZE: int = 64  # max face crops per emotion forward pass
+    PIPELINE_FACE_MODE: str = "per_box"  # per_box | full_frame (one face detector pass per frame)
+    PIPELINE_FACE_MIN_CONTAINMENT: float = 0.6  # share of a face that must lie inside a person box
+    PIPELINE_TRACKING: bool = True  # reuse identity/emotion along IoU tracks between samples
+    PIPELINE_TRACK_IOU: float = 0.3
+    PIPELINE_TRACK_MAX_AGE_SEC: float = 5.0  # drop tracks not matched for this long
+    PIPELINE_TRACK_REFRESH_SEC: float = 30.0  # re-run recognition on a resolved track after this long
+    PIPELINE_TRACK_MIN_SIMILARITY: float = 0.7  # below this a resolved track keeps re-identifying
+    PIPELINE_TRACK_EMOTION_REFRESH_SEC: float = 3.0
+    PIPELINE_ADAPTIVE_SAMPLING: bool = False  # motion-driven interval, reuse results on static frames
+    PIPELINE_MOTION_MIN_INTERVAL_SEC: float = 0.5
+    PIPELINE_MOTION_MAX_INTERVAL_SEC: float = 5.0
+    PIPELINE_MOTION_STATIC_THRESHOLD: float = 2.0  # mean abs gray-level difference treated as "no change"
+    PIPELINE_MOTION_SPIKE_THRESHOLD: float = 12.0
+    PIPELINE_MOTION_MAX_REUSE_SEC: float = 30.0  # always re-analyze at least this often
+    PIPELINE_PROFILING: bool = True  # per-stage timings in the result and the data log
+    PIPELINE_SHARDS: int = 0  # >1: split each job's video into this many time ranges, one process each; capped at the cores idle when the job is dispatched (a lone job gets the whole machine)
+    PIPELINE_SHARD_MIN_SEC: float = 300.0  # never cut shards shorter than this
+
+    # Model loading
+    MODEL_PRELOAD: list[str] = ["identity"]  # loaded + warmed in the background at startup; others load on first use
+    MODEL_WARMUP: bool = True  # dummy inference passes after a background load
+
+    # Shared model server (python -m services.model_server)
+    MODEL_SERVER_MODE: str = "off"  # off | client (API workers and their jobs infer through the server)
+    MODEL_SERVER_SOCKET: str = "/tmp/student_behavior_models.sock"
+    MODEL_SERVER_AUTHKEY: str = ""  # shared secret for the socket handshake (the socket itself is 0600)
+    MODEL_SERVER_TIMEOUT_SEC: float = 60.0  # a request unanswered this long marks the server down
+    MODEL_SERVER_RETRY_SEC: float = 10.0  # infer in-process this long after a failure before retrying the server
+    MODEL_SERVER_FALLBACK: bool = True  # False: raise instead of loading the models in-process
+    MODEL_SERVER_PRELOAD: list[str] = ["behavior", "identity", "emotion"]
+
+    # Face embedding micro-batching (upload endpoints)
+    FACE_BATCH_MAX_SIZE: int = 16  # images per recognition call
+    FACE_BATCH_MAX_WAIT_MS: float = 5.0  # how long the oldest queued image may wait for others
+
+    # Model inference backend
+    INFERENCE_BACKEND: str = "torch"  # torch | onnx (onnxruntime; exports cached next to the weights)
+    ONNX_QUANTIZE: bool = False  # int8 dynamic quantization of the exported models
+    ONNX_INTRA_OP_THREADS: int = 0  # 0 = onnxruntime default
+    ONNX_PARITY_CHECK: bool = True  # compare the emotion model against PyTorch at load time
+    ONNX_PARITY_MIN_AGREEMENT: float = 0.9  # top-1 agreement below this falls back to PyTorch
+
+    # Persisted analysis results
+    ANALYSIS_BUCKET_SEC: int = 10  # granularity of the analysis_durations rows
+    ANALYSIS_PERSIST_CHUNK_SEC: int = 300  # video seconds written per transaction
+
+    # Live stream analysis
+    STREAM_LATENCY_BUDGET_SEC: float = 2.0  # frames older than this when dequeued are skipped
+    STREAM_FLUSH_SEC: float = 60.0  # rolling aggregate flush period (wall clock)
+    STREAM_MAX_SAMPLE_GAP_SEC: float = 5.0  # most time one sample may account for after a stall
+    STREAM_RECONNECT_SEC: float = 2.0
+
+    # Background analysis jobs
+    JOBS_ENABLED: bool = True
+    JOB_WORKERS: int = 0  # analysis processes (0 = cores - 1)
+    JOB_WORKER_NICE: int = 5  # niceness increment so analysis never starves the API workers
+    JOB_POLL_INTERVAL_SEC: float = 2.0
+    JOB_PROGRESS_INTERVAL_SEC: float = 2.0  # progress write / cancellation check period
+    JOB_STALE_SEC: int = 600  # running jobs without a heartbeat for this long are requeued on startup
+    JOB_LOCK_FILE: str = str(_BASE_DIR / "data_storage" / "jobs.lock")  # held by the one API worker that runs the pool
     LOGGER_CONFIG: ClassVar[Dict[str, Any]] = {
         'log_dir': 'log'
     }
@@ -40,3 +40,21 @@ class Result(str, Enum):
     ERROR_ACCESS_TOKEN = "error_access_token"
     ERROR_AUTH = "error_auth"
     ERROR_PASSWORD_FORMAT_WRONG = "error_password_format_wrong"
+    ERROR_NOT_READY = "error_not_ready"
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    CANCELLING = "cancelling"
+    CANCELLED = "cancelled"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class ModelState(str, Enum):
+    NOT_LOADED = "not_loaded"
+    LOADING = "loading"
+    READY = "ready"
+    UNAVAILABLE = "unavailable"  # weights or optional dependency missing
+    FAILED = "failed"
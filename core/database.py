@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base
 from .config import settings
 import os
@@ -30,3 +30,20 @@ def get_db():
         yield db
     finally:
         db.close()
+
+def add_missing_columns(engine, metadata):
+    # create_all only creates missing tables; columns added to an existing model later are added here
+    # (nullable, no default) so older databases keep working without a migration tool
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                ddl = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {ddl}'))
+                print(f"Added column {table.name}.{column.name}")
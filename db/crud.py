@@ -1,6 +1,8 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, insert
+from collections import defaultdict
 from datetime import datetime, date
+from core.constants import JobStatus
 from . import models
 
 # === Student ===
@@ -105,6 +107,8 @@ def delete_student(db: Session, student_id: int):
     student = get_student(db, student_id)
     if not student:
         return False
+    # Photo rows have no foreign key to cascade on, so they go in the same transaction as the student
+    db.query(models.StudentPhoto).filter(models.StudentPhoto.student_id == student_id).delete(synchronize_session=False)
     db.delete(student)
     db.commit()
     return True
@@ -117,6 +121,24 @@ def create_student_photo(db: Session, student_id: int, photo_path: str):
     db.refresh(rec)
     return rec
 
+def get_student_photo(db: Session, photo_id: int):
+    return db.query(models.StudentPhoto).filter(models.StudentPhoto.id == photo_id).first()
+
+def set_photo_embeddings(db: Session, links):
+    # links: [(photo_id, embedding_id)]
+    for photo_id, embedding_id in links:
+        db.query(models.StudentPhoto).filter(models.StudentPhoto.id == photo_id).update(
+            {"embedding_id": int(embedding_id)}, synchronize_session=False)
+    db.commit()
+
+def delete_student_photo(db: Session, photo_id: int):
+    photo = get_student_photo(db, photo_id)
+    if not photo:
+        return False
+    db.delete(photo)
+    db.commit()
+    return True
+
 def get_student_photos(db: Session, student_id: int, skip: int = 0, limit: int = 100):
     return (
         db.query(models.StudentPhoto)
@@ -126,3 +148,161 @@ def get_student_photos(db: Session, student_id: int, skip: int = 0, limit: int =
         .limit(limit)
         .all()
     )
+
+# === AnalysisJob ===
+def create_job(db: Session, video_id: str, video_path: str, priority: int = 0):
+    job = models.AnalysisJob(video_id=video_id, video_path=video_path, priority=priority, status=JobStatus.QUEUED.value)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+def get_job(db: Session, job_id: int):
+    return db.query(models.AnalysisJob).filter(models.AnalysisJob.id == job_id).first()
+
+def get_jobs(db: Session, skip: int = 0, limit: int = 100, status: str = None):
+    query = db.query(models.AnalysisJob)
+    if status:
+        query = query.filter(models.AnalysisJob.status == status)
+    return query.order_by(models.AnalysisJob.id.desc()).offset(skip).limit(limit).all()
+
+def get_jobs_count(db: Session, status: str = None):
+    query = db.query(models.AnalysisJob)
+    if status:
+        query = query.filter(models.AnalysisJob.status == status)
+    return query.count()
+
+def claim_next_job(db: Session, worker: str):
+    # Highest priority first, then FIFO. The conditional UPDATE makes the claim safe when
+    # several API processes run a dispatcher against the same table.
+    candidates = (
+        db.query(models.AnalysisJob.id)
+        .filter(models.AnalysisJob.status == JobStatus.QUEUED.value)
+        .order_by(models.AnalysisJob.priority.desc(), models.AnalysisJob.id.asc())
+        .limit(10)
+        .all()
+    )
+    now = datetime.utcnow()
+    for (job_id,) in candidates:
+        claimed = (
+            db.query(models.AnalysisJob)
+            .filter(models.AnalysisJob.id == job_id, models.AnalysisJob.status == JobStatus.QUEUED.value)
+            .update({"status": JobStatus.RUNNING.value, "worker": worker, "started_at": now, "heartbeat_at": now},
+                    synchronize_session=False)
+        )
+        db.commit()
+        if claimed:
+            return get_job(db, job_id)
+    return None
+
+def update_job_progress(db: Session, job_id: int, **fields):
+    # Returns the job's current status so the worker can notice a cancellation request
+    fields["heartbeat_at"] = datetime.utcnow()
+    db.query(models.AnalysisJob).filter(models.AnalysisJob.id == job_id).update(fields, synchronize_session=False)
+    db.commit()
+    return db.query(models.AnalysisJob.status).filter(models.AnalysisJob.id == job_id).scalar()
+
+def finish_job(db: Session, job_id: int, status: str, error: str = None, result: str = None):
+    fields = {"status": status, "finished_at": datetime.utcnow(), "error": error}
+    if result is not None:
+        fields["result"] = result
+    if status == JobStatus.COMPLETED.value:
+        fields["progress"] = 1.0
+        fields["eta_sec"] = 0.0
+    db.query(models.AnalysisJob).filter(models.AnalysisJob.id == job_id).update(fields, synchronize_session=False)
+    db.commit()
+
+def cancel_job(db: Session, job_id: int):
+    # Queued jobs are cancelled outright; running ones are flagged and stop at their next progress check
+    now = datetime.utcnow()
+    db.query(models.AnalysisJob).filter(
+        models.AnalysisJob.id == job_id, models.AnalysisJob.status == JobStatus.QUEUED.value
+    ).update({"status": JobStatus.CANCELLED.value, "finished_at": now}, synchronize_session=False)
+    db.query(models.AnalysisJob).filter(
+        models.AnalysisJob.id == job_id, models.AnalysisJob.status == JobStatus.RUNNING.value
+    ).update({"status": JobStatus.CANCELLING.value}, synchronize_session=False)
+    db.commit()
+    return get_job(db, job_id)
+
+def requeue_stale_jobs(db: Session, heartbeat_before: datetime):
+    # Jobs whose worker stopped reporting (process killed, server restarted) go back to the queue
+    stale = models.AnalysisJob.heartbeat_at < heartbeat_before
+    requeued = db.query(models.AnalysisJob).filter(stale, models.AnalysisJob.status == JobStatus.RUNNING.value).update(
+        {"status": JobStatus.QUEUED.value, "worker": None}, synchronize_session=False)
+    cancelling = db.query(models.AnalysisJob).filter(stale, models.AnalysisJob.status == JobStatus.CANCELLING.value)
+    video_ids = [video_id for (video_id,) in cancelling.with_entities(models.AnalysisJob.video_id).all()]
+    cancelling.update({"status": JobStatus.CANCELLED.value, "finished_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    # A cancelled job keeps none of the results its worker had already flushed
+    for video_id in video_ids:
+        delete_analysis_results(db, video_id)
+    return requeued
+
+# === Analysis results ===
+def delete_analysis_results(db: Session, video_id: str):
+    for model in (models.AnalysisDuration, models.AnalysisMinuteRollup, models.AnalysisSessionRollup):
+        db.query(model).filter(model.video_id == video_id).delete(synchronize_session=False)
+    db.commit()
+
+def _add_to_rollup(db: Session, model, video_id: str, totals: dict, key_fields: tuple):
+    # Increments existing rollup rows in place and bulk-inserts the missing ones
+    if not totals:
+        return
+    query = db.query(model).filter(
+        model.video_id == video_id,
+        model.student_id.in_({key[0] for key in totals}),
+    )
+    if "minute" in key_fields:
+        query = query.filter(model.minute.in_({key[1] for key in totals}))
+    existing = {tuple(getattr(row, f) for f in key_fields): row for row in query}
+    new_rows = []
+    for key, seconds in totals.items():
+        row = existing.get(key)
+        if row is not None:
+            row.seconds = (row.seconds or 0.0) + seconds
+        else:
+            new_rows.append(dict(zip(key_fields, key), video_id=video_id, seconds=seconds))
+    db.flush()
+    if new_rows:
+        db.execute(insert(model), new_rows)
+
+def save_analysis_chunk(db: Session, video_id: str, rows):
+    # rows: (student_id, bucket_start, category, label, seconds). Raw buckets are bulk-inserted and the
+    # minute/session rollups updated in the same transaction, so readers never see them disagree.
+    rows = list(rows)
+    if not rows:
+        return
+    minute_totals = defaultdict(float)
+    session_totals = defaultdict(float)
+    for student_id, bucket_start, category, label, seconds in rows:
+        minute_totals[(student_id, bucket_start // 60, category, label)] += seconds
+        session_totals[(student_id, category, label)] += seconds
+    try:
+        db.execute(insert(models.AnalysisDuration), [
+            {"video_id": video_id, "student_id": student_id, "bucket_start": bucket_start,
+             "category": category, "label": label, "seconds": seconds}
+            for student_id, bucket_start, category, label, seconds in rows
+        ])
+        _add_to_rollup(db, models.AnalysisMinuteRollup, video_id, minute_totals,
+                       ("student_id", "minute", "category", "label"))
+        _add_to_rollup(db, models.AnalysisSessionRollup, video_id, session_totals,
+                       ("student_id", "category", "label"))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+def get_session_rollups(db: Session, video_id: str):
+    return (
+        db.query(models.AnalysisSessionRollup)
+        .filter(models.AnalysisSessionRollup.video_id == video_id)
+        .order_by(models.AnalysisSessionRollup.student_id, models.AnalysisSessionRollup.category,
+                  models.AnalysisSessionRollup.label)
+        .all()
+    )
+
+def get_minute_rollups(db: Session, video_id: str, student_id: int = None):
+    query = db.query(models.AnalysisMinuteRollup).filter(models.AnalysisMinuteRollup.video_id == video_id)
+    if student_id is not None:
+        query = query.filter(models.AnalysisMinuteRollup.student_id == student_id)
+    return query.order_by(models.AnalysisMinuteRollup.minute, models.AnalysisMinuteRollup.student_id).all()
@@ -0,0 +1,253 @@
+import time
+
+import faiss
+import numpy as np
+
+# Index tiers for the face gallery. Every index is an IndexIDMap around one of
+#
+#   flat  IndexFlatIP     exact scan of every vector
+#   ivf   IndexIVFFlat    vectors bucketed under nlist trained centroids; a query scans the nprobe closest buckets
+#   hnsw  IndexHNSWFlat   navigable small-world graph; a query explores efSearch candidates
+#
+# Stored vectors are L2-normalized, so inner product is cosine similarity in all three.
+#
+# Each tier can store its vectors compressed (the encoding):
+#
+#   float32  4 bytes per dimension, 2 KB per 512-d embedding
+#   fp16     scalar quantization to half floats, 1 KB; scores move by ~1e-4
+#   int8     scalar quantization to 8 bits over the per-dimension range seen in training, 512 B
+#   pq       product quantization to pq_m bytes (IVF only: an HNSW graph built on PQ distances loses too
+#            much recall). With rerank > 0 the best rerank candidates per result are re-scored against fp16
+#            copies kept next to the codes (IndexRefine), which adds 1 KB per 512-d vector: PQ with re-ranking
+#            takes about as much heap as plain fp16 unless the index is memory-mapped, so it only pays off
+#            for FAISS_MMAP readers. With rerank = 0 (the default) only the codes are stored.
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+ENCODINGS = ("float32", "fp16", "int8", "pq")
+TRAINED_ENCODINGS = ("int8", "pq")
+_SQ_TYPES = {"fp16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+
+
+def inner_index(index):
+    return faiss.downcast_index(index.index)
+
+
+def base_index(index):
+    # The index that scans: the inner index without the re-ranking wrapper
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexRefine):
+        return faiss.downcast_index(inner.base_index)
+    return inner
+
+
+def index_type(index):
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf"
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def index_encoding(index):
+    core = base_index(index)
+    if isinstance(core, faiss.IndexHNSW):
+        core = faiss.downcast_index(core.storage)
+    if isinstance(core, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(core, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if core.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    return "float32"
+
+
+def ivf_nlist(n: int, configured: int = 0):
+    if configured > 0:
+        return max(1, min(configured, n))
+    # ~4*sqrt(n) buckets, keeping at least 39 training vectors per centroid (k-means warns below that)
+    return int(max(1, min(4 * np.sqrt(n), n // 39)))
+
+
+def build_index(kind: str, dim: int, vectors=None, ids=None, nlist: int = 0, hnsw_m: int = 32,
+                ef_construction: int = 80, encoding: str = "float32", pq_m: int = 64, rerank: int = 0):
+    # IVF, int8 and PQ are trained on the vectors they are built from, so they cannot be built empty
+    n = 0 if vectors is None else len(vectors)
+    metric = faiss.METRIC_INNER_PRODUCT
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"unknown index type {kind!r} (expected one of {', '.join(INDEX_TYPES)})")
+    if encoding not in ENCODINGS:
+        raise ValueError(f"unknown encoding {encoding!r} (expected one of {', '.join(ENCODINGS)})")
+    if encoding == "pq" and (kind != "ivf" or dim % pq_m):
+        raise ValueError(f"PQ needs an IVF index and a dimension divisible by pq_m ({kind}, {dim} / {pq_m})")
+    if n == 0 and (kind == "ivf" or encoding in TRAINED_ENCODINGS):
+        raise ValueError(f"a {kind} {encoding} index needs vectors to train on")
+    if kind == "flat":
+        if encoding == "float32":
+            inner = faiss.IndexFlatIP(dim)
+        else:
+            inner = faiss.IndexScalarQuantizer(dim, _SQ_TYPES[encoding], metric)
+    elif kind == "ivf":
+        quantizer = faiss.IndexFlatIP(dim)
+        lists = ivf_nlist(n, nlist)
+        if encoding == "float32":
+            inner = faiss.IndexIVFFlat(quantizer, dim, lists, metric)
+        elif encoding == "pq":
+            inner = faiss.IndexIVFPQ(quantizer, dim, lists, pq_m, 8, metric)
+        else:
+            inner = faiss.IndexIVFScalarQuantizer(quantizer, dim, lists, _SQ_TYPES[encoding], metric)
+    else:
+        if encoding == "float32":
+            inner = faiss.IndexHNSWFlat(dim, hnsw_m, metric)
+        else:
+            inner = faiss.IndexHNSWSQ(dim, _SQ_TYPES[encoding], hnsw_m, metric)
+        inner.hnsw.efConstruction = ef_construction
+    if not inner.is_trained:
+        inner.train(vectors)
+    if encoding == "pq" and rerank > 0:
+        inner = faiss.IndexRefine(inner, faiss.IndexScalarQuantizer(dim, _SQ_TYPES["fp16"], metric))
+        inner.k_factor = rerank
+    index = faiss.IndexIDMap(inner)
+    if n:
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def read_index(path: str, mmap: bool = False):
+    # With mmap the stored vectors (flat / HNSW codes, IVF inverted lists) stay in the file and are paged in
+    # on demand, shared through the page cache with every other process mapping the same file. A mapped
+    # index is read-only: adding to it aborts the process, so callers must never write to it.
+    if not mmap:
+        return faiss.read_index(path)
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # Fall back to mapping only the IVF inverted lists, through FAISS's on-disk list reader
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def configure_search(index, nprobe: int = 16, ef_search: int = 64, rerank: int = 0):
+    # rerank: PQ candidates re-scored per result (0 keeps the index's own setting)
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexRefine) and rerank > 0:
+        inner.k_factor = rerank
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = max(1, min(nprobe, inner.nlist))
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = max(1, ef_search)
+
+
+def exclusion(index, ids):
+    # Search parameters for `index` that skip the given ids (tombstones), keeping its nprobe / efSearch
+    selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64)))
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexRefine):
+        # The id map hands its selector to the re-ranking wrapper, which does not pass it on to the index
+        # that scans; give that one a selector over positions instead
+        by_position = faiss.IDSelectorTranslated(index.id_map, selector)
+        base_params = _selector_params(base_index(index), by_position)
+        params = faiss.IndexRefineSearchParameters(k_factor=inner.k_factor, base_index_params=base_params)
+        params.referenced_objects = [selector, by_position, base_params]
+        return params
+    return _selector_params(inner, selector)
+
+
+def _selector_params(inner, selector):
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def id_map(index):
+    # Zero-copy view of the ids by insertion position; only valid until the index is next modified
+    if index.id_map.size() == 0:
+        return np.empty(0, dtype=np.int64)
+    return faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+
+
+def export_vectors(index):
+    # (vectors, ids) of everything in the index, in insertion order
+    n = index.ntotal
+    ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+    if n == 0:
+        return np.empty((0, index.d), dtype='float32'), ids
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexIVF) and inner.direct_map.no():
+        inner.make_direct_map(True)
+        try:
+            vectors = inner.reconstruct_n(0, n)
+        finally:
+            inner.make_direct_map(False)
+    else:
+        vectors = inner.reconstruct_n(0, n)
+    return vectors, ids
+
+
+def enable_reconstruct(index):
+    # IVF can only look vectors up by position with a direct map (8 bytes per vector); flat and HNSW always can
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexIVF) and inner.direct_map.no():
+        inner.make_direct_map(True)
+
+
+def reconstruct_positions(index, positions):
+    # Stored vectors at the given insertion positions (not ids); IVF needs enable_reconstruct first
+    return inner_index(index).reconstruct_batch(np.asarray(positions, dtype=np.int64))
+
+
+def memory_footprint(index):
+    # Heap taken by the index when loaded normally (its serialized size), and the part a query scans: all of
+    # it except PQ's re-ranking copies, which a memory-mapped index only pages in for candidates
+    total = faiss.serialize_index(index).nbytes
+    inner = inner_index(index)
+    scan = total
+    if isinstance(inner, faiss.IndexRefine):
+        refine = faiss.downcast_index(inner.refine_index)
+        scan -= refine.ntotal * refine.sa_code_size()
+    n = max(1, index.ntotal)
+    return {"index_mb": round(total / 2**20, 2), "scan_mb": round(scan / 2**20, 2),
+            "bytes_per_vector": round(total / n, 1), "scan_bytes_per_vector": round(scan / n, 1)}
+
+
+def noisy_queries(vectors, count: int = 200, noise: float = 0.04, seed: int = 0):
+    # Stored vectors plus gaussian noise, re-normalized; noise=0.04 puts a 512-d query at ~0.75 cosine
+    # from its source, about what a second photo of the same face scores
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), size=min(count, len(vectors)), replace=False)
+    queries = vectors[rows] + rng.normal(scale=noise, size=(len(rows), vectors.shape[1])).astype('float32')
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def measure_recall(index, vectors, ids, queries=None, k: int = 10, label=None):
+    # Agreement of `index` with an exact flat scan over the same vectors. Matches are compared by
+    # label(id) (e.g. the student an embedding belongs to), which is what identification uses:
+    # recall_at_1 is the share of queries whose best label is the exact best label, recall_at_k the
+    # share of the exact top-k labels that appear in the approximate top-k.
+    if queries is None:
+        queries = noisy_queries(vectors)
+    if len(queries) == 0 or len(vectors) == 0:
+        return {"queries": 0, "k": k, "recall_at_1": 1.0, "recall_at_k": 1.0}
+    k = min(k, len(vectors))
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    started = time.perf_counter()
+    _, rows = exact.search(queries, k)
+    exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    started = time.perf_counter()
+    _, found = index.search(queries, k)
+    approx_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    truth = ids[rows]
+    if label is not None:
+        truth, found = label(truth), label(found)
+    top1 = float(np.mean(found[:, 0] == truth[:, 0]))
+    overlap = [len(set(f[f >= 0].tolist()) & set(t.tolist())) / len(set(t.tolist())) for f, t in zip(found, truth)]
+    return {
+        "queries": len(queries),
+        "k": k,
+        "recall_at_1": round(top1, 4),
+        "recall_at_k": round(float(np.mean(overlap)), 4),
+        "query_ms": round(approx_ms, 4),
+        "flat_query_ms": round(exact_ms, 4),
+    }
@@ -0,0 +1,118 @@
+import numpy as np
+
+# Per-student centroid gallery (FAISS_GALLERY_MODE=centroids). Every student is one normalized mean of
+# their photo embeddings, so the first pass of a search costs one dot product per student however many
+# photos were enrolled. The photos of the best `candidates` students are then fetched from the per-photo
+# index by position and the `vote_k` most similar ones vote for the identity.
+
+
+class CentroidGallery:
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._rows = {}  # student id -> row
+        self._n = 0  # rows in use, including those of students whose last photo was removed
+        self._ids = np.empty(0, dtype=np.int64)
+        self._sums = np.empty((0, dim), dtype='float32')
+        self._centroids = np.empty((0, dim), dtype='float32')
+        self._positions = []  # row -> positions of the student's photos in the per-photo index
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _grow(self, rows: int):
+        capacity = len(self._sums)
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 64)
+        for name, dtype in (("_sums", 'float32'), ("_centroids", 'float32'), ("_ids", np.int64)):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, student_ids, positions, vectors):
+        # vectors[i] (normalized) is stored at positions[i] of the per-photo index. Grouped by student, so
+        # building the gallery from a whole index costs one pass per student rather than per photo.
+        student_ids = np.asarray(student_ids, dtype=np.int64).reshape(-1)
+        if len(student_ids) == 0:
+            return
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1)
+        students, inverse = np.unique(student_ids, return_inverse=True)
+        rows = np.empty(len(students), dtype=np.int64)
+        for i, student_id in enumerate(students.tolist()):
+            row = self._rows.get(student_id)
+            if row is None:
+                row = self._n
+                self._n += 1
+                self._rows[student_id] = row
+                self._positions.append([])
+            rows[i] = row
+        self._grow(self._n)
+        self._ids[rows] = students
+        np.add.at(self._sums, rows[inverse], np.asarray(vectors, dtype='float32'))
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(students)))[:-1]
+        for row, chunk in zip(rows.tolist(), np.split(positions[order], bounds)):
+            self._positions[row].extend(chunk.tolist())
+        self._refresh(rows.tolist())
+
+    def remove(self, student_ids, positions, vectors):
+        # Photos leaving the gallery; a student without photos drops out of the candidates
+        touched = set()
+        for student_id, position, vector in zip(np.asarray(student_ids).tolist(), np.asarray(positions).tolist(), vectors):
+            row = self._rows.get(student_id)
+            if row is None or position not in self._positions[row]:
+                continue
+            self._sums[row] -= vector
+            self._positions[row].remove(position)
+            if not self._positions[row]:
+                del self._rows[student_id]
+                self._ids[row] = -1
+                self._sums[row] = 0
+            touched.add(row)
+        self._refresh(touched)
+
+    def _refresh(self, rows):
+        if not rows:
+            return
+        rows = np.fromiter(rows, dtype=np.int64)
+        norms = np.linalg.norm(self._sums[rows], axis=1, keepdims=True)
+        self._centroids[rows] = self._sums[rows] / np.maximum(norms, 1e-12)
+
+    def candidates(self, queries, count: int):
+        # (students, similarities) of the `count` closest centroids per query, best first;
+        # rows of removed students score 0 and carry student id -1
+        n = self._n
+        scores = queries @ self._centroids[:n].T
+        count = min(count, n)
+        top = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return self._ids[top], np.take_along_axis(scores, top, axis=1)
+
+    def identify(self, queries, reconstruct, candidates: int = 5, vote_k: int = 5):
+        # (student_id, similarity) per query; similarity is the best photo of the winning student.
+        # reconstruct(positions) returns the stored vectors at those per-photo index positions.
+        if len(self._rows) == 0:
+            return [(None, 0.0)] * len(queries)
+        students, _ = self.candidates(queries, candidates)
+        matches = []
+        for query, shortlist in zip(queries, students):
+            shortlist = shortlist[shortlist >= 0]
+            if len(shortlist) == 0:
+                matches.append((None, 0.0))
+                continue
+            rows = [self._rows[s] for s in shortlist.tolist()]
+            positions = np.fromiter((p for row in rows for p in self._positions[row]), dtype=np.int64)
+            owners = np.repeat(shortlist, [len(self._positions[row]) for row in rows])
+            similarities = reconstruct(positions) @ query
+            top = np.argsort(-similarities)[:vote_k]
+            votes = {}
+            for student_id, similarity in zip(owners[top].tolist(), similarities[top].tolist()):
+                weight, best = votes.get(student_id, (0.0, -1.0))
+                votes[student_id] = (weight + max(similarity, 0.0), max(best, similarity))
+            # Votes are weighted by similarity, so two close photos of a student outweigh three distant
+            # ones of a student with more photos enrolled; a tie goes to the closer best photo
+            student_id, (_, best) = max(votes.items(), key=lambda item: item[1])
+            matches.append((int(student_id), float(best)))
+        return matches
@@ -0,0 +1,65 @@
+import argparse
+import json
+import sys
+
+from core.config import settings
+from db.faiss_index import ENCODINGS, INDEX_TYPES, memory_footprint
+
+# Re-encodes the stored face index (FAISS_INDEX_FILE and METADATA_FILE) in place:
+#
+#   python -m db.migrate_index --encoding int8
+#   python -m db.migrate_index --encoding pq --type ivf --min-recall 0.9
+#
+# Runs as the index writer, so it refuses to start while the API holds the index. The new index goes through
+# the recall gate of a background rebuild (FAISS_PROMOTE_MIN_RECALL unless --min-recall) and only replaces
+# the files if it passes. Set FAISS_ENCODING to the same value afterwards, or the API converts it back.
+# Vectors are re-encoded from what the current index stores: converting a float32 index (or PQ with
+# re-ranking, which keeps float32 copies) is exact, but going from int8 back to float32 restores nothing.
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Re-encode the stored face index and report memory vs recall.")
+    parser.add_argument("--encoding", choices=ENCODINGS, required=True)
+    parser.add_argument("--type", choices=INDEX_TYPES, help="index type to rebuild as (default: the current one)")
+    parser.add_argument("--min-recall", type=float, help="recall@1 vs a flat scan the new index needs")
+    parser.add_argument("--output", help="write the JSON report here as well")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings.FAISS_ROLE = "writer"
+    settings.FAISS_ENCODING = args.encoding
+    if args.min_recall is not None:
+        settings.FAISS_PROMOTE_MIN_RECALL = args.min_recall
+    from db.vector_db import vector_db_instance
+
+    before = {**vector_db_instance.index_status(), **memory_footprint(vector_db_instance.index)}
+    kind = args.type or before["type"]
+    if args.encoding == "pq" and kind != "ivf":
+        sys.exit("PQ needs an IVF index: pass --type ivf")
+    vector_db_instance.rebuild_index(kind, reason="migration", wait=True, encoding=args.encoding)
+    after = {**vector_db_instance.index_status(), **memory_footprint(vector_db_instance.index)}
+    migrated = after["type"] == kind and after["encoding"] == args.encoding
+    recall = after["recall"] or {}
+    report = {
+        "migrated": migrated,
+        "index_file": settings.FAISS_INDEX_FILE,
+        "vectors": after["ntotal"],
+        "before": {key: before[key] for key in ("type", "encoding", "index_mb", "scan_mb", "bytes_per_vector")},
+        "after": {key: after[key] for key in ("type", "encoding", "index_mb", "scan_mb", "bytes_per_vector")},
+        "saved_mb": round(before["index_mb"] - after["index_mb"], 2),
+        "scan_saved_mb": round(before["scan_mb"] - after["scan_mb"], 2),
+        "recall_at_1": recall.get("recall_at_1"),
+        "recall_at_k": recall.get("recall_at_k"),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0 if migrated else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Date, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Float, ForeignKey, DateTime, Date, Text, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from core.database import Base
@@ -31,4 +31,65 @@ class StudentPhoto(Base):
     id = Column(Integer, primary_key=True, index=True)
     student_id = Column(Integer, index=True)
     photo_path = Column(String(512))
+    embedding_id = Column(BigInteger, index=True)  # FAISS id of the face embedding taken from this photo
     created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    video_id = Column(String(64), unique=True, index=True)
+    video_path = Column(String(512))
+    status = Column(String(20), default="queued", index=True)  # queued, running, cancelling, cancelled, completed, failed
+    priority = Column(Integer, default=0, index=True)  # higher runs first
+    frames_processed = Column(Integer, default=0)
+    position_sec = Column(Float, default=0.0)
+    duration_sec = Column(Float)
+    progress = Column(Float, default=0.0)  # 0..1
+    fps = Column(Float)
+    eta_sec = Column(Float)
+    worker = Column(String(64))
+    error = Column(Text)
+    result = Column(Text)  # JSON summary of the per-student aggregates
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+class AnalysisDuration(Base):
+    # Seconds a student spent in a behavior/emotion within one time bucket of a video
+    __tablename__ = "analysis_durations"
+    id = Column(Integer, primary_key=True, index=True)
+    video_id = Column(String(64), index=True)
+    student_id = Column(Integer, index=True)
+    bucket_start = Column(Integer)  # seconds from the start of the video
+    category = Column(String(20))  # behavior, emotion
+    label = Column(String(50))
+    seconds = Column(Float, default=0.0)
+    __table_args__ = (Index("ix_analysis_durations_video_student_bucket", "video_id", "student_id", "bucket_start"),)
+
+
+class AnalysisMinuteRollup(Base):
+    __tablename__ = "analysis_minute_rollups"
+    id = Column(Integer, primary_key=True, index=True)
+    video_id = Column(String(64), index=True)
+    student_id = Column(Integer, index=True)
+    minute = Column(Integer)  # minutes from the start of the video
+    category = Column(String(20))
+    label = Column(String(50))
+    seconds = Column(Float, default=0.0)
+    __table_args__ = (UniqueConstraint("video_id", "student_id", "minute", "category", "label",
+                                       name="uq_analysis_minute_rollups_key"),)
+
+
+class AnalysisSessionRollup(Base):
+    __tablename__ = "analysis_session_rollups"
+    id = Column(Integer, primary_key=True, index=True)
+    video_id = Column(String(64), index=True)
+    student_id = Column(Integer, index=True)
+    category = Column(String(20))
+    label = Column(String(50))
+    seconds = Column(Float, default=0.0)
+    __table_args__ = (UniqueConstraint("video_id", "student_id", "category", "label",
+                                       name="uq_analysis_session_rollups_key"),)
@@ -1,63 +1,918 @@
+import atexit
+import fcntl
+import hashlib
 import os
 import json
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
 import faiss
 import numpy as np
 from core.config import settings
+from db.faiss_index import (ENCODINGS, INDEX_TYPES, TRAINED_ENCODINGS, build_index, configure_search,
+                            enable_reconstruct, exclusion, export_vectors, id_map, index_encoding, index_type,
+                            measure_recall, read_index, reconstruct_positions)
+from db.gallery import CentroidGallery
+
+# Every embedding has its own FAISS id, student_id << 32 | sequence number, so the student of a match is
+# read off the id and all of a student's embeddings form one id range. StudentPhoto.embedding_id links a
+# photo to the embedding extracted from it.
+#
+# Inserts and removals are appended to a write-ahead log (FAISS_WAL_FILE) and applied in memory; the index
+# file and metadata.json are only rewritten by periodic snapshots, which then drop the logged records they
+# cover. A removed embedding stays in the index as a tombstone that searches skip; once tombstones make up
+# FAISS_COMPACT_RATIO of the index it is rebuilt without them in the background.
+#
+# WAL record: op (u8), lsn (i64), embedding id (i64), crc32 (u32) of everything else, then the payload:
+# dim float32 values for an add, nothing for a removal. metadata.json holds the lsn of the snapshot, the
+# next sequence number and the tombstones. Snapshot files are replaced index first, then metadata; replay
+# skips adds whose id the index already holds, so a crash between the two replaces is harmless.
+# Indexes written before per-embedding ids (ids were student ids) are relabeled on load.
+#
+# The gallery starts as an exact flat index and is rebuilt in the background as FAISS_INDEX_TYPE (IVF or
+# HNSW, see db/faiss_index.py) once it holds FAISS_PROMOTE_AT vectors; an IVF index is retrained whenever
+# the gallery has grown FAISS_RETRAIN_GROWTH times past the size its centroids were trained on. A rebuild
+# only replaces the live index if its recall@1 against a flat scan reaches FAISS_PROMOTE_MIN_RECALL.
+# FAISS_ENCODING compresses the stored vectors (fp16, int8 or PQ, see db/faiss_index.py) through the same
+# gated rebuild: fp16 right away, the trained encodings once the gallery holds FAISS_PROMOTE_AT vectors, and
+# `python -m db.migrate_index` converts an existing index offline.
+#
+# With FAISS_GALLERY_MODE=centroids, searches go through a per-student centroid gallery (db/gallery.py)
+# rebuilt from the index at startup and kept current on every insert and removal; the per-photo index
+# then only serves the photos of the shortlisted students.
+#
+# Only one process writes: the one holding an exclusive lock on FAISS_INDEX_FILE.lock. FAISS_ROLE decides
+# who may take it; left empty, the API workers compete for it (main.py sets auto) and every other entry
+# point (jobs, streams, benchmarks, scripts) only reads, so a CLI started before the API cannot take the
+# gallery from it. The writer keeps the index on its heap, logs every change and publishes snapshots.
+# Every other process is a reader: it opens the published index read-only, memory-mapped with FAISS_MMAP
+# so all readers share one copy through the page cache, applies the records logged since that snapshot to
+# a small private "delta" index, and at most every FAISS_READER_REFRESH_SEC reopens newer snapshots and
+# reads newer records. Readers never touch the files: their adds and removals are forwarded to the writer
+# over a Unix socket (FAISS_WRITER_SOCKET) and raise WriterUnavailable when it cannot be reached.
+
+WAL_ADD = 1
+WAL_REMOVE = 2
+_WAL_HEADER = struct.Struct("<BqqI")
+_STUDENT_SHIFT = 32
+_SEQ_MASK = (1 << _STUDENT_SHIFT) - 1
+
+
+class ReadOnlyVectorDB(Exception):
+    pass
+
+
+class WriterUnavailable(ReadOnlyVectorDB):
+    # A reader could not get a change confirmed by the writer
+    pass
+
+
+_FORWARDED = ("add_embeddings", "remove_embeddings", "remove_student")
+
+
+def student_of(embedding_ids):
+    # Student id of an embedding id (or of an array of them); -1 (no match) stays -1
+    return embedding_ids >> _STUDENT_SHIFT
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _file_version(path: str):
+    # Changes whenever the file is appended to or replaced; None if it does not exist
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _writer_socket(index_file: str):
+    if settings.FAISS_WRITER_SOCKET:
+        return settings.FAISS_WRITER_SOCKET
+    path = f"{index_file}.sock"
+    if len(path) < 100:  # AF_UNIX path limit
+        return path
+    digest = hashlib.sha1(os.path.realpath(index_file).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"faiss-writer-{digest}.sock")
+
+
+def _writer_authkey():
+    return settings.FAISS_WRITER_AUTHKEY.encode() if settings.FAISS_WRITER_AUTHKEY else None
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(path)
+
 
 class VectorDB:
     def __init__(self):
         self.dim = settings.EMBEDDING_DIM
         self.index_file = settings.FAISS_INDEX_FILE
         self.metadata_file = settings.METADATA_FILE
+        self.wal_file = settings.FAISS_WAL_FILE
 
-        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(self.dim))
-        self.metadata = {}
+        self.index = build_index("flat", self.dim)
+        self.metadata = {}  # student id -> live embeddings, recomputed from the index on load
+        self.index_info = {"type": "flat", "encoding": "float32", "trained_on": 0, "recall": None}
+        self.snapshot_lsn = 0  # last logged record contained in the index file
+        self.next_lsn = 1
+        self.next_seq = 1  # sequence part of the next embedding id
+        self._tombstones = set()  # removed embedding ids still stored in the index
+        self._exclude = {}  # id(index) -> search parameters skipping the tombstones, reset when they change
+        self._lock = threading.RLock()
+        self._wal = None
+        self._pending = 0  # records this process logged since its last snapshot
+        self._snapshot_wanted = threading.Event()
+        self._snapshot_lock = threading.Lock()  # one snapshot at a time (background thread vs atexit)
+        self._snapshot_thread = None
+        self._rebuild_backlog = None  # inserts made while a rebuild runs, replayed into the new index
+        self._rebuild_after = 0  # no rebuild attempt before the gallery reaches this size
+        self._delta = None  # readers: private index of the records logged after the published snapshot
+        self._present = None  # readers: ids stored in the index or the delta
+        self._published = None  # readers: version of the metadata.json the index was opened with
+        self._wal_seen = None  # readers: version of the WAL last read
+        self._wal_pos = None  # readers: (inode, offset) just past the last complete record read
+        self._next_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+        self._writer_lock = None
+        self.writer_socket = _writer_socket(self.index_file)
+        self._listener = None  # writer: accepts changes forwarded by readers
+        self._writer_conn = None  # readers: connection to the writer, opened on the first change
+        self._writer_conn_lock = threading.Lock()
+        self.gallery = None
+        self.read_only = not self._claim_writer()
+        if self.read_only:
+            self._open_published()
+            print(f"Opened FAISS index read-only{' (memory-mapped)' if settings.FAISS_MMAP else ''}. "
+                  f"Total vectors: {self._ntotal()}")
+            return
+        legacy_ntotal = None
+        migrated = False
 
         if os.path.exists(self.index_file) and os.path.exists(self.metadata_file):
             print("Loading existing FAISS index...")
             self.index = faiss.read_index(self.index_file)
-            with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                try:
-                    self.metadata = json.load(f)
-                except Exception:
-                    self.metadata = {}
+            meta = self._read_metadata()
+            if meta.get("version", 1) >= 2:
+                self.snapshot_lsn = meta.get("lsn", 0)
+                self.next_seq = meta.get("next_seq", 1)
+                self._tombstones = set(meta.get("tombstones", []))
+                self.index_info.update(meta.get("index", {}))
+            else:
+                if "counts" in meta:  # WAL, but ids were still student ids
+                    self.snapshot_lsn = meta.get("lsn", 0)
+                    legacy_ntotal = meta.get("ntotal")
+                    self.index_info.update(meta.get("index", {}))
+                self._relabel_legacy()
+                migrated = True
         else:
             print("Creating new FAISS index...")
+            self.index = build_index("flat", self.dim, encoding=self._encoding_for("flat", 0))
             self._ensure_parent_dirs()
             self._save()
+        self.index_info["type"] = index_type(self.index)
+        self.index_info["encoding"] = index_encoding(self.index)
+        configure_search(self.index, settings.FAISS_IVF_NPROBE, settings.FAISS_HNSW_EF_SEARCH, settings.FAISS_PQ_RERANK)
+        self.next_lsn = self.snapshot_lsn + 1
+        self._replay(legacy_ntotal)
+        self._recount()
+        if settings.FAISS_GALLERY_MODE == "centroids":
+            self.gallery = self._gallery_of(self.index, self._tombstones)
+        if migrated:
+            self.snapshot(force=True)
+            print(f"Assigned per-embedding ids to {self.index.ntotal} stored vector(s)")
+        self._serve_readers()
 
     def _ensure_parent_dirs(self):
-        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
-        os.makedirs(os.path.dirname(self.metadata_file), exist_ok=True)
+        for path in (self.index_file, self.metadata_file, self.wal_file):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _read_metadata(self):
+        with open(self.metadata_file, 'r', encoding='utf-8') as f:
+            try:
+                return json.load(f)
+            except Exception:
+                return {}
 
     def _save(self):
+        # Full snapshot of the current state; the WAL is left as is
+        self._ensure_parent_dirs()
+        _write_atomic(self.index_file, faiss.serialize_index(self.index).tobytes())
+        _write_atomic(self.metadata_file, json.dumps(self._metadata_document(self.next_lsn - 1)).encode("utf-8"))
+
+    def _metadata_document(self, lsn: int):
+        return {
+            "version": 2,
+            "counts": self.metadata,
+            "lsn": lsn,
+            "ntotal": int(self.index.ntotal),
+            "next_seq": self.next_seq,
+            "tombstones": sorted(self._tombstones),
+            "index": self.index_info,
+        }
+
+    def _relabel_legacy(self):
+        # The index was written when FAISS ids were student ids: give each stored vector its own id
+        students = faiss.vector_to_array(self.index.id_map).astype(np.int64)
+        seqs = np.arange(self.next_seq, self.next_seq + len(students), dtype=np.int64)
+        faiss.copy_array_to_vector((students << _STUDENT_SHIFT) | seqs, self.index.id_map)
+        self.next_seq += len(students)
+
+    def _recount(self):
+        stored = id_map(self.index)
+        if self._tombstones:
+            tombstones = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+            self._tombstones = set(tombstones[np.isin(tombstones, stored)].tolist())  # compacted away since
+            stored = stored[~np.isin(stored, tombstones)]
+        students, counts = np.unique(student_of(stored), return_counts=True)
+        self.metadata = {str(s): int(c) for s, c in zip(students.tolist(), counts.tolist())}
+        if self.index.ntotal:
+            self.next_seq = max(self.next_seq, int((id_map(self.index) & _SEQ_MASK).max()) + 1)
+
+    # ---- Writer and readers ----
+
+    def _claim_writer(self):
+        # True if this process is the writer. The lock is released when the process exits.
+        role = settings.FAISS_ROLE or "reader"
+        if role == "reader":
+            return False
         self._ensure_parent_dirs()
-        faiss.write_index(self.index, self.index_file)
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(self.metadata, f)
+        path = f"{self.index_file}.lock"
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            if role == "writer":
+                raise RuntimeError(f"FAISS_ROLE=writer, but another process holds {path}")
+            return False
+        self._writer_lock = fd
+        return True
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyVectorDB(f"this process only reads the face gallery; the process holding "
+                                   f"{self.index_file}.lock makes all changes")
+
+    def _serve_readers(self):
+        # Writer: accept the adds and removals of reader processes on a Unix socket only this user can open.
+        # Holding the writer lock makes a socket left at the path stale, so it is replaced.
+        path = self.writer_socket
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        old_umask = os.umask(0o177)
+        try:
+            self._listener = Listener(path, family="AF_UNIX", authkey=_writer_authkey())
+        except OSError as e:
+            print(f"[WARN] FAISS writer cannot listen on {path}: {e}; readers cannot change the gallery")
+            return
+        finally:
+            os.umask(old_umask)
+        threading.Thread(target=self._accept_readers, args=(self._listener,), name="faiss-writer", daemon=True).start()
+
+    def _accept_readers(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                print(f"[WARN] FAISS writer rejected a connection on {self.writer_socket}: bad authkey")
+                continue
+            except OSError:
+                return  # closed
+            threading.Thread(target=self._serve_reader, args=(conn,), name="faiss-writer-conn", daemon=True).start()
+
+    def _serve_reader(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if op not in _FORWARDED:
+                        raise ValueError(f"unknown vector db op {op!r}")
+                    reply = (True, getattr(self, op)(*args))
+                except Exception as e:
+                    # Built-in and gallery errors go back as they are; anything else may not survive pickling, and a
+                    # reply that cannot be sent or loaded would leave the reader waiting, so it becomes a RuntimeError
+                    if type(e).__module__ != "builtins" and not isinstance(e, ReadOnlyVectorDB):
+                        e = RuntimeError(f"{type(e).__name__}: {e}")
+                    reply = (False, e)
+                try:
+                    try:
+                        conn.send(reply)
+                    except (pickle.PicklingError, TypeError, AttributeError) as e:
+                        # The result would not pickle; the reader still gets an answer instead of a timeout
+                        conn.send((False, RuntimeError(f"cannot return the result of {op}: {e}")))
+                except OSError:
+                    return
+
+    def _connect_writer(self):
+        if self._writer_conn is None:
+            self._writer_conn = Client(self.writer_socket, family="AF_UNIX", authkey=_writer_authkey())
+        return self._writer_conn
+
+    def _forward(self, op: str, *args):
+        # Readers: run a change on the writer, then pick it up from the log so this process sees it at once
+        with self._writer_conn_lock:
+            try:
+                reused = self._writer_conn is not None
+                try:
+                    self._connect_writer().send((op, args))
+                except OSError:
+                    if not reused:
+                        raise
+                    # A connection kept from before a writer restart: nothing was sent, so resend once on a new one
+                    self._writer_conn.close()
+                    self._writer_conn = None
+                    self._connect_writer().send((op, args))
+                if not self._writer_conn.poll(settings.FAISS_WRITER_TIMEOUT_SEC):
+                    raise TimeoutError(f"no answer within {settings.FAISS_WRITER_TIMEOUT_SEC:.0f}s")
+                ok, payload = self._writer_conn.recv()
+            except (OSError, EOFError, TimeoutError, AuthenticationError) as e:
+                # A timed-out connection may still receive the late reply, so it is never reused
+                if self._writer_conn is not None:
+                    self._writer_conn.close()
+                    self._writer_conn = None
+                raise WriterUnavailable(f"the face gallery writer at {self.writer_socket} is unreachable "
+                                        f"({type(e).__name__}: {e})") from e
+        if not ok:
+            raise payload
+        self._next_refresh = 0.0
+        self._refresh()
+        return payload
+
+    def close(self):
+        # Stop serving readers and let go of the log and the writer lock, without a final snapshot
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            try:
+                os.unlink(self.writer_socket)
+            except FileNotFoundError:
+                pass
+        with self._writer_conn_lock:
+            if self._writer_conn is not None:
+                self._writer_conn.close()
+                self._writer_conn = None
+        with self._lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+        if self._writer_lock is not None:
+            os.close(self._writer_lock)
+            self._writer_lock = None
+
+    def _open_published(self):
+        # Readers: (re)open the published snapshot, then apply the records logged after it. metadata.json is
+        # replaced after the index file, so if it did not change while the index was read, the index is at
+        # least as new as its lsn.
+        version, index, meta = None, None, {}
+        for _ in range(5):
+            version = _file_version(self.metadata_file)
+            if version is None or not os.path.exists(self.index_file):
+                index = None
+                break
+            index = read_index(self.index_file, mmap=settings.FAISS_MMAP)
+            meta = self._read_metadata()
+            if _file_version(self.metadata_file) == version:
+                break
+        if index is not None and meta.get("version", 1) < 2:
+            print("[WARN] FAISS index predates per-embedding ids; waiting for the writer to migrate it")
+            index = None
+        if index is None:
+            index, meta = build_index("flat", self.dim), {}
+        configure_search(index, settings.FAISS_IVF_NPROBE, settings.FAISS_HNSW_EF_SEARCH, settings.FAISS_PQ_RERANK)
+        tombstones = set(meta.get("tombstones", []))
+        gallery = self._gallery_of(index, tombstones) if settings.FAISS_GALLERY_MODE == "centroids" else None
+        with self._lock:
+            self.index = index
+            self._delta = build_index("flat", self.dim)
+            self._present = None
+            self._published = version
+            self.snapshot_lsn = meta.get("lsn", 0)
+            self.next_lsn = self.snapshot_lsn + 1
+            self.next_seq = meta.get("next_seq", 1)
+            self._tombstones = tombstones
+            self._exclude = {}
+            self._wal_pos = None
+            self.index_info = {"type": "flat", "encoding": "float32", "trained_on": 0, "recall": None}
+            self.index_info.update(meta.get("index", {}))
+            self.index_info["type"] = index_type(index)
+            self.index_info["encoding"] = index_encoding(index)
+            self._recount()
+            self.gallery = gallery
+            self._wal_seen = _file_version(self.wal_file)
+            self._catch_up()
+
+    def _catch_up(self):
+        # Readers, lock held: apply the records logged after the last one seen to the delta index. The log is
+        # only ever opened for reading here and read on from the end of the last complete record, so a torn
+        # tail (a record the writer is still appending) is neither applied nor touched, and is read whole by
+        # the next refresh. Compaction replaces the file, which starts the read over from its beginning.
+        try:
+            f = open(self.wal_file, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if self._wal_pos is not None and self._wal_pos[0] == stat.st_ino and self._wal_pos[1] <= stat.st_size:
+                f.seek(self._wal_pos[1])
+            end = f.tell()
+            for op, lsn, faiss_id, payload, end in self._wal_records(f):
+                self._apply_logged(op, lsn, faiss_id, payload)
+            self._wal_pos = (stat.st_ino, end)
+
+    def _apply_logged(self, op, lsn, faiss_id, payload):
+        # Readers, lock held: one record to the delta index
+        if lsn < self.next_lsn:
+            return
+        self.next_lsn = lsn + 1
+        if faiss_id <= _SEQ_MASK:
+            return  # legacy record, absorbed by the writer's migration snapshot
+        if self._present is None:
+            self._present = set(self._stored_ids().tolist())
+        if op == WAL_ADD and faiss_id not in self._present:
+            ids = np.array([faiss_id], dtype=np.int64)
+            start = self._ntotal()
+            vec = np.frombuffer(payload, dtype='float32').reshape(1, self.dim)
+            self._delta.add_with_ids(vec, ids)
+            self._present.add(faiss_id)
+            self._note_added(ids, vec, start)
+        elif op == WAL_REMOVE and faiss_id in self._present and faiss_id not in self._tombstones:
+            positions = np.flatnonzero(self._stored_ids() == faiss_id)
+            self._note_removed(np.array([faiss_id], dtype=np.int64), positions)
+
+    def _refresh(self):
+        # Readers: at most every FAISS_READER_REFRESH_SEC, reopen a newer snapshot or read newer log records.
+        # A search never waits for another thread's refresh.
+        if not self.read_only or time.monotonic() < self._next_refresh:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_refresh = time.monotonic() + settings.FAISS_READER_REFRESH_SEC
+            if _file_version(self.metadata_file) != self._published:
+                self._open_published()
+            elif _file_version(self.wal_file) != self._wal_seen:
+                with self._lock:
+                    self._wal_seen = _file_version(self.wal_file)
+                    self._catch_up()
+        except Exception as e:
+            print(f"[WARN] FAISS reader refresh failed: {e}")
+        finally:
+            self._refresh_lock.release()
+
+    def _ntotal(self):
+        return self.index.ntotal + (self._delta.ntotal if self._delta is not None else 0)
+
+    def _stored_ids(self):
+        # Lock held: ids by position, across the index and the delta
+        if self._delta is None or self._delta.ntotal == 0:
+            return id_map(self.index)
+        return np.concatenate([id_map(self.index), id_map(self._delta)])
+
+    def _note_added(self, ids, vecs, start):
+        # Lock held: counts and centroid gallery for embeddings stored from position `start` on
+        students = student_of(ids)
+        if self.gallery is not None:
+            self.gallery.add(students, np.arange(start, start + len(ids)), vecs)
+        for student_id in students.tolist():
+            sid = str(student_id)
+            self.metadata[sid] = self.metadata.get(sid, 0) + 1
+
+    def _note_removed(self, found, positions):
+        # Lock held: tombstone live embeddings stored at the given positions
+        self._tombstones.update(found.tolist())
+        self._exclude = {}
+        students = student_of(found)
+        if self.gallery is not None:
+            self.gallery.remove(students, positions, self._reconstruct(positions))
+        for student_id in students.tolist():
+            sid = str(student_id)
+            self.metadata[sid] = self.metadata.get(sid, 0) - 1
+            if self.metadata[sid] <= 0:
+                del self.metadata[sid]
+
+    # ---- Write-ahead log ----
+
+    def _payload_size(self, op: int):
+        return {WAL_ADD: self.dim * 4, WAL_REMOVE: 0}.get(op)
+
+    def _wal_records(self, f):
+        # (op, lsn, embedding id, payload, end offset) of the complete records from f's position on, in log
+        # order; stops at a torn or corrupt tail
+        end = f.tell()
+        while True:
+            header = f.read(_WAL_HEADER.size)
+            if len(header) < _WAL_HEADER.size:
+                return
+            op, lsn, faiss_id, crc = _WAL_HEADER.unpack(header)
+            size = self._payload_size(op)
+            if size is None:
+                return
+            payload = f.read(size)
+            if len(payload) < size or zlib.crc32(header[:-4] + payload) != crc:
+                return
+            end += _WAL_HEADER.size + size
+            yield op, lsn, faiss_id, payload, end
+
+    def _replay(self, legacy_ntotal):
+        if not os.path.exists(self.wal_file):
+            return
+        # Legacy records carry a student id and cannot be matched by id: the adds already in the index file
+        # (crash between the two snapshot replaces) are skipped by count instead
+        skip = max(0, self.index.ntotal - legacy_ntotal) if legacy_ntotal is not None else 0
+        present = None
+        applied = 0
+        good_bytes = 0
+        with open(self.wal_file, "rb") as f:
+            for op, lsn, faiss_id, payload, good_bytes in self._wal_records(f):
+                self.next_lsn = max(self.next_lsn, lsn + 1)
+                if lsn <= self.snapshot_lsn:
+                    continue
+                if faiss_id <= _SEQ_MASK:
+                    if op == WAL_ADD and skip:
+                        skip -= 1
+                        continue
+                    faiss_id = (faiss_id << _STUDENT_SHIFT) | self.next_seq
+                    self.next_seq += 1
+                if present is None:
+                    present = set(id_map(self.index).tolist())
+                if op == WAL_ADD and faiss_id not in present:
+                    vec = np.frombuffer(payload, dtype='float32').reshape(1, self.dim)
+                    self.index.add_with_ids(vec, np.array([faiss_id], dtype=np.int64))
+                    present.add(faiss_id)
+                elif op == WAL_REMOVE and faiss_id in present:
+                    self._tombstones.add(faiss_id)
+                applied += 1
+        # Anything past the last complete record is a torn tail from a crash mid-append. Only the writer gets
+        # here, holding the lock that every appending process holds, so no append can be in flight.
+        if self._writer_lock is not None and good_bytes < os.path.getsize(self.wal_file):
+            with open(self.wal_file, "r+b") as f:
+                f.truncate(good_bytes)
+        if applied:
+            print(f"Replayed {applied} logged record(s). Total vectors: {self.index.ntotal}")
+
+    def _append(self, op: int, faiss_ids, vecs: np.ndarray = None):
+        # Caller holds the lock; all records go out in one write(), fsync'd once unless FAISS_WAL_FSYNC is off
+        self._check_writable()
+        if self._wal is None:
+            self._ensure_parent_dirs()
+            self._wal = open(self.wal_file, "ab", buffering=0)
+        records = []
+        for i, faiss_id in enumerate(faiss_ids):
+            payload = np.ascontiguousarray(vecs[i], dtype='float32').tobytes() if vecs is not None else b""
+            head = struct.pack("<Bqq", op, self.next_lsn, int(faiss_id))
+            records.append(head + struct.pack("<I", zlib.crc32(head + payload)) + payload)
+            self.next_lsn += 1
+        self._wal.write(b"".join(records))
+        if settings.FAISS_WAL_FSYNC:
+            os.fsync(self._wal.fileno())
+        self._pending += len(records)
+        self._ensure_snapshot_thread()
+        if self._pending >= settings.FAISS_SNAPSHOT_EVERY:
+            self._snapshot_wanted.set()
+
+    # ---- Snapshots ----
+
+    def _ensure_snapshot_thread(self):
+        if self._snapshot_thread is None:
+            self._snapshot_thread = threading.Thread(target=self._snapshot_loop, name="faiss-snapshot", daemon=True)
+            self._snapshot_thread.start()
+            atexit.register(self.snapshot)
+
+    def _snapshot_loop(self):
+        while True:
+            self._snapshot_wanted.wait(timeout=settings.FAISS_SNAPSHOT_INTERVAL_SEC)
+            self._snapshot_wanted.clear()
+            try:
+                self.snapshot()
+            except Exception as e:
+                print(f"[WARN] FAISS snapshot failed: {e}")
+
+    def snapshot(self, force: bool = False):
+        # Serialize under the lock (a memory copy), write and swap the files outside it, then drop the
+        # log records the new files contain. Inserts continue while the files are written.
+        if self.read_only:
+            return False  # readers have nothing to publish
+        with self._snapshot_lock:
+            return self._snapshot(force)
+
+    def _snapshot(self, force: bool = False):
+        with self._lock:
+            if self._pending == 0 and not force:
+                return False
+            index_bytes = faiss.serialize_index(self.index).tobytes()
+            lsn = self.next_lsn - 1
+            meta = json.dumps(self._metadata_document(lsn)).encode("utf-8")
+            pending = self._pending
+            wal_offset = self._wal.tell() if self._wal is not None else 0
+        self._ensure_parent_dirs()
+        _write_atomic(self.index_file, index_bytes)
+        _write_atomic(self.metadata_file, meta)
+        with self._lock:
+            self._compact_wal(wal_offset)
+            self.snapshot_lsn = lsn
+            self._pending -= pending
+        return True
+
+    def _compact_wal(self, offset: int):
+        # Keep only the records appended after the snapshot was taken
+        if self._wal is None:
+            return
+        with open(self.wal_file, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        self._wal.close()
+        _write_atomic(self.wal_file, tail)
+        self._wal = open(self.wal_file, "ab", buffering=0)
+
+    # ---- Centroid gallery ----
+
+    def _gallery_of(self, index, tombstones):
+        started = time.perf_counter()
+        enable_reconstruct(index)
+        vectors, ids = export_vectors(index)
+        positions = np.arange(len(ids))
+        if tombstones:
+            live = ~np.isin(ids, np.fromiter(tombstones, dtype=np.int64, count=len(tombstones)))
+            vectors, ids, positions = vectors[live], ids[live], positions[live]
+        gallery = CentroidGallery(self.dim)
+        gallery.add(student_of(ids), positions, vectors)
+        print(f"Built centroid gallery for {len(gallery)} student(s) in {time.perf_counter() - started:.2f}s")
+        return gallery
+
+    def _reconstruct(self, positions):
+        # Positions past the end of the index are in the delta (readers)
+        positions = np.asarray(positions, dtype=np.int64)
+        base = self.index.ntotal
+        if self._delta is None or len(positions) == 0 or positions.max() < base:
+            return reconstruct_positions(self.index, positions)
+        vectors = np.empty((len(positions), self.dim), dtype='float32')
+        in_base = positions < base
+        if in_base.any():
+            vectors[in_base] = reconstruct_positions(self.index, positions[in_base])
+        vectors[~in_base] = reconstruct_positions(self._delta, positions[~in_base] - base)
+        return vectors
+
+    # ---- Index tiers and compaction ----
+
+    def _encoding_for(self, kind: str, n: int):
+        # FAISS_ENCODING once it applies to a `kind` index of n vectors, else the current encoding if `kind` can
+        # keep it. Trained encodings wait for FAISS_PROMOTE_AT vectors; PQ needs IVF.
+        wanted = settings.FAISS_ENCODING
+        current = self.index_info.get("encoding", "float32")
+        if wanted in ENCODINGS and (wanted != "pq" or kind == "ivf") and (
+                wanted not in TRAINED_ENCODINGS or n >= settings.FAISS_PROMOTE_AT):
+            return wanted
+        return "float32" if current == "pq" and kind != "ivf" else current
+
+    def _rebuild_target(self):
+        # (index type, reason) the gallery should be rebuilt as right now, or None
+        target = settings.FAISS_INDEX_TYPE
+        kind = self.index_info["type"]
+        encoding = self.index_info.get("encoding", "float32")
+        n = self.index.ntotal
+        if target not in INDEX_TYPES or n < self._rebuild_after:
+            return None
+        if target != kind and (target == "flat" or n >= settings.FAISS_PROMOTE_AT):
+            return target, f"{kind} -> {target}"
+        if self._encoding_for(kind, n) != encoding:
+            return kind, f"{encoding} -> {self._encoding_for(kind, n)} vectors"
+        trained = kind == "ivf" or encoding in TRAINED_ENCODINGS
+        if trained and n >= max(1, self.index_info.get("trained_on", 0)) * settings.FAISS_RETRAIN_GROWTH:
+            return kind, f"retrain at {n} vectors"
+        if n and len(self._tombstones) / n >= settings.FAISS_COMPACT_RATIO:
+            return kind, f"compact {len(self._tombstones)} tombstone(s)"
+        return None
+
+    def rebuild_index(self, kind: str = None, reason: str = "manual", wait: bool = False, encoding: str = None):
+        # Rebuild the gallery as `kind` (default FAISS_INDEX_TYPE) with `encoding` (default: see _encoding_for)
+        # on a background thread, without tombstones
+        self._check_writable()
+        kind = kind or settings.FAISS_INDEX_TYPE
+        if kind not in INDEX_TYPES:
+            raise ValueError(f"unknown index type {kind!r}")
+        if encoding is not None and encoding not in ENCODINGS:
+            raise ValueError(f"unknown encoding {encoding!r}")
+        with self._lock:
+            if self._rebuild_backlog is not None:
+                return None  # one rebuild at a time
+            self._rebuild_backlog = []
+            encoding = encoding or self._encoding_for(kind, self.index.ntotal)
+            vectors, ids = export_vectors(self.index)
+            dropped = set(self._tombstones)
+        if dropped:
+            live = ~np.isin(ids, np.fromiter(dropped, dtype=np.int64, count=len(dropped)))
+            vectors, ids = vectors[live], ids[live]
+        thread = threading.Thread(target=self._rebuild, args=(kind, encoding, vectors, ids, dropped, reason),
+                                  name="faiss-rebuild", daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def _rebuild(self, kind, encoding, vectors, ids, dropped, reason):
+        if len(vectors) == 0:
+            kind = "flat"  # nothing left to train on
+            encoding = "fp16" if encoding == "fp16" else "float32"
+        try:
+            started = time.perf_counter()
+            index = build_index(kind, self.dim, vectors, ids, nlist=settings.FAISS_IVF_NLIST,
+                                hnsw_m=settings.FAISS_HNSW_M, ef_construction=settings.FAISS_HNSW_EF_CONSTRUCTION,
+                                encoding=encoding, pq_m=settings.FAISS_PQ_M, rerank=settings.FAISS_PQ_RERANK)
+            configure_search(index, settings.FAISS_IVF_NPROBE, settings.FAISS_HNSW_EF_SEARCH)
+            build_sec = time.perf_counter() - started
+            exact = kind == "flat" and encoding == "float32"
+            recall = measure_recall(index, vectors, ids, label=student_of) if not exact else None
+            gallery = None
+            if self.gallery is not None:
+                # Positions change when tombstones are dropped, so the gallery is rebuilt alongside
+                enable_reconstruct(index)
+                gallery = CentroidGallery(self.dim)
+                gallery.add(student_of(ids), np.arange(len(ids)), vectors)
+        except Exception as e:
+            with self._lock:
+                self._rebuild_backlog = None
+                self._rebuild_after = int(self.index.ntotal * settings.FAISS_RETRAIN_GROWTH) + 1
+            print(f"[WARN] FAISS index rebuild ({reason}) failed: {e}")
+            return
+        if recall is not None and recall["recall_at_1"] < settings.FAISS_PROMOTE_MIN_RECALL:
+            with self._lock:
+                self._rebuild_backlog = None
+                self._rebuild_after = int(self.index.ntotal * settings.FAISS_RETRAIN_GROWTH) + 1
+            print(f"[WARN] FAISS {kind} {encoding} index kept out of service ({reason}): "
+                  f"recall@1 {recall['recall_at_1']:.3f} "
+                  f"< {settings.FAISS_PROMOTE_MIN_RECALL}; next attempt at {self._rebuild_after} vectors")
+            return
+        with self._lock:
+            backlog, self._rebuild_backlog = self._rebuild_backlog, None
+            for batch_ids, batch in backlog:
+                start = index.ntotal
+                index.add_with_ids(batch, batch_ids)
+                if gallery is not None:
+                    gallery.add(student_of(batch_ids), np.arange(start, start + len(batch_ids)), batch)
+            self._tombstones -= dropped
+            if gallery is not None and self._tombstones:
+                # Removed while the rebuild ran: still stored in the new index
+                stored = id_map(index)
+                positions = np.flatnonzero(np.isin(stored, list(self._tombstones)))
+                gallery.remove(student_of(stored[positions]), positions, reconstruct_positions(index, positions))
+            self.index = index
+            if gallery is not None:
+                self.gallery = gallery
+            self._exclude = {}
+            self.index_info = {"type": kind, "encoding": encoding, "trained_on": len(vectors), "recall": recall}
+            self._rebuild_after = 0
+        print(f"Rebuilt FAISS index as {kind} {encoding} ({reason}) in {build_sec:.1f}s. Total vectors: {index.ntotal}"
+              + (f", recall@1 {recall['recall_at_1']:.3f} vs flat" if recall else ""))
+        self.snapshot(force=True)
+
+    def index_status(self):
+        self._refresh()
+        with self._lock:
+            return {**self.index_info, "ntotal": int(self._ntotal()), "tombstones": len(self._tombstones),
+                    "rebuilding": self._rebuild_backlog is not None,
+                    "role": "reader" if self.read_only else "writer",
+                    "mmap": bool(self.read_only and settings.FAISS_MMAP),
+                    "delta": int(self._delta.ntotal) if self._delta is not None else 0}
+
+    # ---- Public API ----
 
     def add_embedding(self, student_id: int, vector: np.ndarray):
-        vec = vector.astype('float32')
-        faiss.normalize_L2(vec)
-        faiss_id = np.array([student_id], dtype=np.int64)
-        self.index.add_with_ids(vec, faiss_id)
-        sid = str(student_id)
-        self.metadata[sid] = self.metadata.get(sid, 0) + 1
-        self._save()
-        print(f"Added embedding for student {student_id}. Total vectors: {self.index.ntotal}")
+        return int(self.add_embeddings([student_id], vector)[0])
+
+    def add_embeddings(self, student_ids, vectors: np.ndarray):
+        # Row i of vectors belongs to student_ids[i]; one normalization, one index add and one log write.
+        # Returns the new embedding ids, in row order.
+        if self.read_only:
+            return self._forward("add_embeddings", np.asarray(student_ids, dtype=np.int64),
+                                 np.asarray(vectors, dtype='float32'))
+        vecs = np.array(vectors, dtype='float32', copy=True).reshape(-1, self.dim)
+        students = np.asarray(student_ids, dtype=np.int64).reshape(-1)
+        if len(students) != len(vecs):
+            raise ValueError(f"{len(students)} student ids for {len(vecs)} vectors")
+        if len(vecs) == 0:
+            return np.empty(0, dtype=np.int64)
+        if students.min() < 1 or students.max() >= 1 << 31:
+            raise ValueError("student ids must be in [1, 2**31)")
+        faiss.normalize_L2(vecs)
+        with self._lock:
+            ids = (students << _STUDENT_SHIFT) | np.arange(self.next_seq, self.next_seq + len(students), dtype=np.int64)
+            self.next_seq += len(ids)
+            self._append(WAL_ADD, ids, vecs)
+            start = self.index.ntotal
+            self.index.add_with_ids(vecs, ids)
+            self._note_added(ids, vecs, start)
+            if self._rebuild_backlog is not None:
+                self._rebuild_backlog.append((ids, vecs))
+            target = self._rebuild_target() if self._rebuild_backlog is None else None
+        if len(ids) == 1:
+            print(f"Added embedding for student {students[0]}. Total vectors: {self.index.ntotal}")
+        else:
+            print(f"Added {len(ids)} embeddings for {len(set(students.tolist()))} student(s). Total vectors: {self.index.ntotal}")
+        if target is not None:
+            self.rebuild_index(*target)
+        return ids
+
+    def remove_embeddings(self, embedding_ids):
+        # Tombstones the given embeddings (unknown or already removed ids are ignored); returns how many
+        if self.read_only:
+            return self._forward("remove_embeddings", np.asarray(embedding_ids, dtype=np.int64))
+        ids = np.unique(np.asarray(embedding_ids, dtype=np.int64).reshape(-1))
+        if len(ids) == 0:
+            return 0
+        with self._lock:
+            stored = self._stored_ids()
+            positions = np.flatnonzero(np.isin(stored, ids))
+            found = stored[positions]
+            live = np.fromiter((i not in self._tombstones for i in found.tolist()), dtype=bool, count=len(found))
+            positions, found = positions[live], found[live]
+            if len(found) == 0:
+                return 0
+            self._append(WAL_REMOVE, found)
+            self._note_removed(found, positions)
+            target = self._rebuild_target() if self._rebuild_backlog is None else None
+        print(f"Removed {len(found)} embedding(s). Tombstones: {len(self._tombstones)}/{self.index.ntotal}")
+        if target is not None:
+            self.rebuild_index(*target)
+        return len(found)
+
+    def remove_student(self, student_id: int):
+        if self.read_only:
+            return self._forward("remove_student", int(student_id))
+        with self._lock:
+            stored = self._stored_ids()
+            ids = stored[student_of(stored) == student_id]
+        return self.remove_embeddings(ids)
+
+    def _search_params(self, index):
+        # Caller holds the lock
+        if not self._tombstones:
+            return None
+        params = self._exclude.get(id(index))
+        if params is None:
+            params = self._exclude[id(index)] = exclusion(index, list(self._tombstones))
+        return params
 
     def search_embedding(self, vector: np.ndarray, k: int = 1):
-        if self.index.ntotal == 0:
-            return None, 0.0
-        vec = vector.astype('float32')
-        faiss.normalize_L2(vec)
-        distances, faiss_ids = self.index.search(vec, k)
-        if faiss_ids.size == 0:
-            return None, 0.0
-        student_id = int(faiss_ids[0][0])
-        similarity = float(distances[0][0])
-        if similarity < settings.FAISS_THRESHOLD_COSINE:
-            return None, similarity
-        return student_id, similarity
+        return self.search_embeddings(vector, k)[0]
+
+    def search_embeddings(self, vectors: np.ndarray, k: int = 1):
+        # Best match per row as (student_id or None, similarity), one FAISS call for the whole matrix
+        vecs = np.array(vectors, dtype='float32', copy=True).reshape(-1, self.dim)
+        if len(vecs) == 0:
+            return []
+        self._refresh()
+        if self._ntotal() == 0:
+            return [(None, 0.0)] * len(vecs)
+        faiss.normalize_L2(vecs)
+        with self._lock:
+            if self.gallery is not None:
+                matches = self.gallery.identify(vecs, self._reconstruct, settings.FAISS_GALLERY_CANDIDATES,
+                                                settings.FAISS_GALLERY_VOTE_K)
+            else:
+                distances, faiss_ids = self.index.search(vecs, k, params=self._search_params(self.index))
+                if self._delta is not None and self._delta.ntotal:
+                    more, more_ids = self._delta.search(vecs, k, params=self._search_params(self._delta))
+                    distances, faiss_ids = np.hstack([distances, more]), np.hstack([faiss_ids, more_ids])
+                    best = np.argsort(-distances, axis=1)[:, :k]
+                    distances = np.take_along_axis(distances, best, axis=1)
+                    faiss_ids = np.take_along_axis(faiss_ids, best, axis=1)
+        if self.gallery is not None:
+            return [(student_id if similarity >= settings.FAISS_THRESHOLD_COSINE else None, similarity)
+                    for student_id, similarity in matches]
+        similarities = distances[:, 0]
+        ids = faiss_ids[:, 0]
+        accepted = (ids >= 0) & (similarities >= settings.FAISS_THRESHOLD_COSINE)
+        return [
+            (int(student_of(embedding_id)) if ok else None, float(similarity))
+            for embedding_id, similarity, ok in zip(ids, similarities, accepted)
+        ]
 
 vector_db_instance = VectorDB()
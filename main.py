@@ -1,23 +1,42 @@
 from fastapi import FastAPI
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
-from core.database import engine, Base
+from core.database import engine, Base, add_missing_columns
 from core.config import settings
+# The API workers own the face gallery: one of them takes the writer lock and the others forward their
+# changes to it. Set before the routers import db.vector_db, which opens the gallery.
+settings.FAISS_ROLE = settings.FAISS_ROLE or "auto"
 from api import routers as app_router_api
 from web.router import router_web
 from fastapi.staticfiles import StaticFiles
 from core.middleware import apply_middlewares
 from db import models as db_models  # noqa: F401
+from services.jobs import job_manager
+from services.ai_loader import ai_engine
 
 # Create tables
 try:
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine, Base.metadata)
     print("Database tables created successfully (if not exist).")
 except Exception as e:
     print(f"Error creating database tables: {e}")
     print("Please ensure MySQL server is running and database is created.")
 
-app = FastAPI(title="Student Behavior AI Web", docs_url="/docs", redoc_url="/redoc")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Models load on a background thread; the server answers (and /api/health/ready reports 503) meanwhile
+    if settings.MODEL_PRELOAD:
+        ai_engine.start_preload(settings.MODEL_PRELOAD, warmup=settings.MODEL_WARMUP)
+    if settings.JOBS_ENABLED:
+        job_manager.start()
+    yield
+    job_manager.stop()
+
+
+app = FastAPI(title="Student Behavior AI Web", docs_url="/docs", redoc_url="/redoc", lifespan=lifespan)
 
 # Middlewares (CORS, Request ID)
 apply_middlewares(app, settings)
@@ -1,60 +1,292 @@
-import os
-import torch
-from ultralytics import YOLO
-from torchvision import models
+import threading
+import time
 from pathlib import Path
+import numpy as np
+from core.config import settings
+from core.constants import ModelState
+
+# torch, ultralytics, torchvision and insightface are imported by the loaders below, so importing
+# this module (and every API module that uses ai_engine) stays cheap; each model is loaded on first
+# use, or ahead of time by AIEngine.start_preload().
+
+MODELS_DIR = Path(__file__).resolve().parents[1] / "models"
+YOLO_WEIGHTS = MODELS_DIR / "yolov8_best.pt"
+EMOTION_WEIGHTS = MODELS_DIR / "resnet18_best.ckpt"
+EMOTION_CLASSES = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
+WARMUP_IMAGE_SIZE = 640
+
+
+def build_emotion_transform():
+    from torchvision import models
+    return models.ResNet18_Weights.IMAGENET1K_V1.transforms()
+
+
+def load_emotion_checkpoint(path, device):
+    import torch
+    from torchvision import models
+    model = models.resnet18(weights=None)
+    model.fc = torch.nn.Linear(model.fc.in_features, len(EMOTION_CLASSES))
+    ckpt = torch.load(str(path), map_location=device)
+    state = ckpt.get("model", ckpt)
+    model.load_state_dict(state)
+    model.to(device)
+    model.eval()
+    return model
+
+
+class ModelSlot:
+    # Load state of one model; `lock` is held for the whole load + warmup so concurrent callers wait for it
+    __slots__ = ("name", "state", "model", "error", "load_sec", "warmup_sec", "lock")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = ModelState.NOT_LOADED
+        self.model = None
+        self.error = None
+        self.load_sec = None
+        self.warmup_sec = None
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            "state": self.state.value,
+            "error": self.error,
+            "load_sec": round(self.load_sec, 3) if self.load_sec is not None else None,
+            "warmup_sec": round(self.warmup_sec, 3) if self.warmup_sec is not None else None,
+        }
+
 
 class AIEngine:
+    MODEL_NAMES = ("behavior", "identity", "emotion")
+    _TERMINAL = (ModelState.READY, ModelState.UNAVAILABLE, ModelState.FAILED)
+
     def __init__(self):
-        print("Loading AI Engine...")
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print(f"Using device: {self.device}")
-
-        # 1. Load YOLOv8 (Behavior)
-        base_dir = Path(__file__).resolve().parents[1]
-        models_dir = base_dir / "models"
-        yolo_path = str(models_dir / "yolov8_best.pt")
-        self.behavior_model = None
+        self.backend = settings.INFERENCE_BACKEND
+        self.emotion_classes = EMOTION_CLASSES
+        self._device = None
+        self._emotion_transform = None
+        self._slots = {name: ModelSlot(name) for name in self.MODEL_NAMES}
+        self._preload = ()
+        self._preload_thread = None
+
+    @property
+    def device(self):
+        if self._device is None:
+            import torch
+            self._device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            print(f"Using device: {self._device}")
+        return self._device
+
+    @property
+    def behavior_model(self):
+        return self.get_model("behavior")
+
+    @property
+    def identity_model(self):
+        return self.get_model("identity")
+
+    @property
+    def emotion_model(self):
+        return self.get_model("emotion")
+
+    @property
+    def emotion_transform(self):
+        if self._emotion_transform is None:
+            self._emotion_transform = build_emotion_transform()
+        return self._emotion_transform
+
+    def get_model(self, name: str, warmup: bool = False):
+        # The model, loading it first if needed; None when it is unavailable or failed to load
+        slot = self._slots[name]
+        if slot.state in self._TERMINAL:
+            return slot.model
+        with slot.lock:
+            if slot.state == ModelState.NOT_LOADED:
+                self._load(slot, warmup)
+        return slot.model
+
+    def model_state(self, name: str):
+        return self._slots[name].state
+
+    def _load(self, slot: ModelSlot, warmup: bool):
+        slot.state = ModelState.LOADING
+        started = time.perf_counter()
         try:
-            if os.path.exists(yolo_path):
-                self.behavior_model = YOLO(yolo_path)
-                print("YOLOv8 model loaded.")
-            else:
-                print(f"[WARN] YOLO weights not found at {yolo_path}. Behavior detection disabled.")
+            model = getattr(self, f"_load_{slot.name}")()
+        except (FileNotFoundError, ImportError) as e:
+            print(f"[WARN] {slot.name} model unavailable: {e}")
+            slot.error, slot.state = str(e), ModelState.UNAVAILABLE
+            return
         except Exception as e:
-            print(f"[WARN] Failed to load YOLOv8: {e}. Behavior detection disabled.")
+            print(f"[WARN] Failed to load {slot.name} model: {e}")
+            slot.error, slot.state = str(e), ModelState.FAILED
+            return
+        finally:
+            slot.load_sec = time.perf_counter() - started
+        slot.model = model
+        if warmup:
+            # Dummy passes so allocator pools, kernels and lazy initialisation are paid before real traffic
+            started = time.perf_counter()
+            try:
+                getattr(self, f"_warmup_{slot.name}")(model)
+            except Exception as e:
+                print(f"[WARN] Warmup of {slot.name} model failed: {e}")
+            slot.warmup_sec = time.perf_counter() - started
+        slot.state = ModelState.READY
 
-        # 2. Load InsightFace (Identity) - optional
-        self.identity_model = None
+    def start_preload(self, names=None, warmup: bool = True):
+        # Loads (and warms) the models on a daemon thread; requests that need one meanwhile wait on its slot
+        if self._preload_thread is not None:
+            return
+        self._preload = tuple(name for name in (names or self.MODEL_NAMES) if name in self._slots)
+
+        def run():
+            for name in self._preload:
+                self.get_model(name, warmup=warmup)
+            print("AI Engine ready: " + ", ".join(f"{n}={self._slots[n].state.value}" for n in self._preload))
+
+        self._preload_thread = threading.Thread(target=run, name="model-preload", daemon=True)
+        self._preload_thread.start()
+
+    def is_ready(self):
+        # Every preloaded model has finished loading (successfully or not); lazy models never block readiness
+        return all(self._slots[name].state in self._TERMINAL for name in self._preload)
+
+    def status(self):
+        return {
+            "ready": self.is_ready(),
+            "backend": self.backend,
+            "device": str(self._device) if self._device is not None else None,
+            "preload": list(self._preload),
+            "models": {name: slot.to_dict() for name, slot in self._slots.items()},
+        }
+
+    # ---- Loaders ----
+
+    def _load_behavior(self):
+        if self.backend == "onnx":
+            model = self._load_onnx_behavior()
+            if model is not None:
+                return model
+        if not YOLO_WEIGHTS.exists():
+            raise FileNotFoundError(f"YOLO weights not found at {YOLO_WEIGHTS}. Behavior detection disabled.")
+        from ultralytics import YOLO
+        model = YOLO(str(YOLO_WEIGHTS))
+        print("YOLOv8 model loaded.")
+        return model
+
+    def _load_identity(self):
+        import insightface  # optional dependency
+        cuda = self.device.type == 'cuda'
+        provider = 'CUDAExecutionProvider' if cuda else 'CPUExecutionProvider'
+        model = insightface.app.FaceAnalysis(providers=[provider])
+        model.prepare(ctx_id=0 if cuda else -1, det_size=(640, 640))
+        print("InsightFace model loaded.")
+        return model
+
+    def _load_emotion(self):
+        model = None
+        if EMOTION_WEIGHTS.exists():
+            model = load_emotion_checkpoint(EMOTION_WEIGHTS, self.device)
+            print("Emotion model loaded.")
+        if self.backend == "onnx":
+            model = self._load_onnx_emotion(model) or model
+        if model is None:
+            raise FileNotFoundError(f"Emotion model checkpoint not found at {EMOTION_WEIGHTS}. Emotion classification disabled.")
+        return model
+
+    def _load_onnx_behavior(self):
+        from services import onnx_backend
         try:
-            import insightface  # lazy optional import
-            provider = 'CUDAExecutionProvider' if self.device.type == 'cuda' else 'CPUExecutionProvider'
-            self.identity_model = insightface.app.FaceAnalysis(providers=[provider])
-            self.identity_model.prepare(ctx_id=0 if self.device.type == 'cuda' else -1, det_size=(640, 640))
-            print("InsightFace model loaded.")
+            model = onnx_backend.load_behavior_model(YOLO_WEIGHTS, quantize=settings.ONNX_QUANTIZE)
+            print(f"YOLOv8 model loaded (onnxruntime{', int8' if settings.ONNX_QUANTIZE else ''}).")
+            return model
         except Exception as e:
-            print(f"[WARN] Failed to load InsightFace: {e}. Identity recognition disabled.")
+            print(f"[WARN] ONNX YOLOv8 unavailable: {e}. Falling back to PyTorch.")
+            return None
 
-        # 3. Load Emotion Model (ResNet18)
-        emotion_path = str(models_dir / "resnet18_best.ckpt")
-        self.emotion_model = None
+    def _load_onnx_emotion(self, torch_model):
+        import torch
+        from services import onnx_backend
         try:
-            if os.path.exists(emotion_path):
-                self.emotion_model = models.resnet18(weights=None)
-                self.emotion_model.fc = torch.nn.Linear(self.emotion_model.fc.in_features, 7)
-                ckpt = torch.load(emotion_path, map_location=self.device)
-                state = ckpt.get("model", ckpt)
-                self.emotion_model.load_state_dict(state)
-                self.emotion_model.to(self.device)
-                self.emotion_model.eval()
-                print("Emotion model loaded.")
-            else:
-                print(f"[WARN] Emotion model checkpoint not found at {emotion_path}. Emotion classification disabled.")
+            model = onnx_backend.load_emotion_model(torch_model, EMOTION_WEIGHTS, self.device, quantize=settings.ONNX_QUANTIZE)
         except Exception as e:
-            print(f"[WARN] Failed to load Emotion model: {e}. Emotion classification disabled.")
+            print(f"[WARN] ONNX emotion model unavailable: {e}. Falling back to PyTorch.")
+            return None
+        if torch_model is not None and settings.ONNX_PARITY_CHECK:
+            # Quick check on a fixed random batch; the full check on real frames is `python -m services.onnx_backend`
+            generator = torch.Generator().manual_seed(0)
+            batch = torch.randn(8, 3, onnx_backend.EMOTION_INPUT_SIZE, onnx_backend.EMOTION_INPUT_SIZE, generator=generator)
+            parity = onnx_backend.compare_emotion(torch_model, model, batch.to(self.device))
+            print(f"Emotion ONNX parity: top-1 agreement {parity['top1_agreement']:.2f}, max abs diff {parity['max_abs_diff']:.4f}")
+            if parity["top1_agreement"] < settings.ONNX_PARITY_MIN_AGREEMENT:
+                print("[WARN] ONNX emotion model disagrees with PyTorch. Falling back to PyTorch.")
+                return None
+        print(f"Emotion model loaded (onnxruntime{', int8' if settings.ONNX_QUANTIZE else ''}).")
+        return model
+
+    # ---- Warmup ----
+
+    def _warmup_behavior(self, model):
+        frame = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+        model([frame], device=self.device, verbose=False)
+
+    def _warmup_identity(self, model):
+        frame = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+        model.det_model.detect(frame, max_num=0, metric='default')
+        rec = model.models['recognition']
+        rec.get_feat([np.zeros((rec.input_size[1], rec.input_size[0], 3), dtype=np.uint8)])
+
+    def _warmup_emotion(self, model):
+        import torch
+        with torch.no_grad():
+            model(torch.zeros(1, 3, 224, 224).to(self.device))
+
+    # ---- Face helpers ----
+
+    def detect_faces(self, img):
+        # Detection only (what FaceAnalysis.get does before its per-face models), so callers
+        # can discard faces before paying for recognition
+        from insightface.app.common import Face
+        bboxes, kpss = self.identity_model.det_model.detect(img, max_num=0, metric='default')
+        faces = []
+        for i in range(bboxes.shape[0]):
+            kps = kpss[i] if kpss is not None else None
+            faces.append(Face(bbox=bboxes[i, 0:4], kps=kps, det_score=bboxes[i, 4]))
+        return faces
+
+    def embed_faces(self, img, faces):
+        # One batched ArcFace pass over the aligned crops; sets face.embedding like FaceAnalysis.get
+        self.embed_faces_batch([(img, faces)])
+        return faces
+
+    def embed_faces_batch(self, items):
+        # embed_faces over several (img, faces) pairs with a single recognition call
+        pairs = [(img, face) for img, faces in items for face in faces]
+        if not pairs:
+            return items
+        from insightface.utils import face_align
+        rec = self.identity_model.models['recognition']
+        crops = [face_align.norm_crop(img, landmark=face.kps, image_size=rec.input_size[0]) for img, face in pairs]
+        feats = rec.get_feat(crops)
+        for (_, face), feat in zip(pairs, feats):
+            face.embedding = feat.flatten()
+        return items
+
+
+def create_engine():
+    # With MODEL_SERVER_MODE=client the models live in the shared model server; this process keeps a
+    # lazily-loading AIEngine only as the fallback for when the server is unreachable
+    engine = AIEngine()
+    if settings.MODEL_SERVER_MODE == "client":
+        from services.model_client import RemoteEngine
+        return RemoteEngine(
+            settings.MODEL_SERVER_SOCKET, engine,
+            allow_fallback=settings.MODEL_SERVER_FALLBACK,
+            timeout=settings.MODEL_SERVER_TIMEOUT_SEC,
+            retry_sec=settings.MODEL_SERVER_RETRY_SEC,
+        )
+    return engine
 
-        self.emotion_transform = models.ResNet18_Weights.IMAGENET1K_V1.transforms()
-        self.emotion_classes = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
-        
 
-ai_engine = AIEngine()
+ai_engine = create_engine()
@@ -2,32 +2,56 @@ import cv2
 import numpy as np
 from sqlalchemy.orm import Session
 from db import crud
-from db.vector_db import vector_db_instance
-from services.ai_loader import ai_engine
+from db.vector_db import ReadOnlyVectorDB, vector_db_instance
+from services.face_batcher import face_batcher
 
 def enroll_new_student(db: Session, name: str, image_bytes: bytes):
-    db_student = crud.get_student_by_name(db, name=name)
-    if not db_student:
-        db_student = crud.create_student(db, name=name)
+    return enroll_students(db, [(name, image_bytes)])[0]
 
-    student_id = db_student.id
+def enroll_students(db: Session, entries):
+    # entries: [(name, image_bytes)]; returns (student or None, message) per entry, in order.
+    # All portraits go through the face batcher together and the accepted embeddings are
+    # written to the index in one add_embeddings call. Raises ReadOnlyVectorDB (after deleting the students
+    # it created) when the face gallery cannot take the embeddings.
+    results = [None] * len(entries)
+    pending = []
+    created = []
+    for i, (name, image_bytes) in enumerate(entries):
+        db_student = crud.get_student_by_name(db, name=name)
+        if not db_student:
+            db_student = crud.create_student(db, name=name)
+            created.append(db_student.id)
 
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        return None, "Invalid image file."
+        nparr = np.frombuffer(image_bytes, np.uint8)
+        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        if img is None:
+            results[i] = (None, "Invalid image file.")
+            continue
+        pending.append((i, db_student, face_batcher.submit(img)))
 
-    if ai_engine.identity_model is None:
-        return None, "Identity model unavailable. Please ensure InsightFace is installed and configured."
-    faces = ai_engine.identity_model.get(img)
-    if not faces or len(faces) == 0:
-        return None, "No face found in the image."
-    if len(faces) > 1:
-        return None, "Multiple faces found. Please upload a clear portrait."
+    student_ids, embeddings, accepted = [], [], []
+    for i, db_student, future in pending:
+        faces = future.result()
+        if faces is None:
+            results[i] = (None, "Identity model unavailable. Please ensure InsightFace is installed and configured.")
+        elif not faces or len(faces) == 0:
+            results[i] = (None, "No face found in the image.")
+        elif len(faces) > 1:
+            results[i] = (None, "Multiple faces found. Please upload a clear portrait.")
+        elif faces[0].embedding is None:
+            results[i] = (None, "Could not extract embedding.")
+        else:
+            student_ids.append(db_student.id)
+            embeddings.append(faces[0].embedding.reshape(-1))
+            accepted.append((i, db_student))
 
-    embedding = faces[0].embedding
-    if embedding is None:
-        return None, "Could not extract embedding."
-
-    vector_db_instance.add_embedding(student_id, embedding.reshape(1, -1))
-    return db_student, "Enrollment successful."
+    if embeddings:
+        try:
+            vector_db_instance.add_embeddings(student_ids, np.stack(embeddings))
+        except ReadOnlyVectorDB:
+            for student_id in created:
+                crud.delete_student(db, student_id)
+            raise
+    for i, db_student in accepted:
+        results[i] = (db_student, "Enrollment successful.")
+    return results
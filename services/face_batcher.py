@@ -0,0 +1,94 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from core.config import settings
+from core.fastapi_logger import log_data
+from services.ai_loader import ai_engine
+
+
+class _Request:
+    __slots__ = ("image", "future", "enqueued")
+
+    def __init__(self, image):
+        self.image = image
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class FaceEmbeddingBatcher:
+    # Face detection + recognition for every request handler runs on one worker thread, so concurrent
+    # uploads no longer fight over the same CPU threads. Requests that arrive within max_wait_ms of the
+    # oldest queued one (up to max_batch_size images) share a single recognition call; detection stays
+    # per image. Each caller gets the faces of its own image, or None when the identity model is unavailable.
+    def __init__(self, engine, max_batch_size: int = 16, max_wait_ms: float = 5.0):
+        self.engine = engine
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, image) -> Future:
+        self._ensure_started()
+        request = _Request(image)
+        self._queue.put(request)
+        return request.future
+
+    async def embed(self, image):
+        return await asyncio.wrap_future(self.submit(image))
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="face-batcher", daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        batch = [first]
+        # The window starts when the oldest request was queued, so requests that piled up behind a
+        # running batch go out immediately instead of waiting another window
+        deadline = first.enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._process([r for r in batch if r.future.set_running_or_notify_cancel()])
+            except Exception as e:
+                log_data.exception('face_batch_failed|size=%s', len(batch))
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _process(self, batch):
+        if not batch:
+            return
+        if self.engine.identity_model is None:
+            for request in batch:
+                request.future.set_result(None)
+            return
+        detected = []
+        for request in batch:
+            try:
+                detected.append((request, self.engine.detect_faces(request.image)))
+            except Exception as e:
+                request.future.set_exception(e)
+        self.engine.embed_faces_batch([(request.image, faces) for request, faces in detected])
+        for request, faces in detected:
+            request.future.set_result(faces)
+
+
+face_batcher = FaceEmbeddingBatcher(ai_engine, settings.FACE_BATCH_MAX_SIZE, settings.FACE_BATCH_MAX_WAIT_MS)
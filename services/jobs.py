@@ -0,0 +1,259 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from core.config import settings
+from core.constants import JobStatus
+from core.database import SessionLocal
+from core.fastapi_logger import log_data
+from db import crud
+
+
+def _init_worker(num_threads: int):
+    # Analysis processes run below the API workers' priority and split the cores between them
+    try:
+        os.nice(settings.JOB_WORKER_NICE)
+    except (AttributeError, OSError):
+        pass
+    # Jobs only search the face gallery; the API process is its writer. Shard processes inherit the variable.
+    os.environ["FAISS_ROLE"] = "reader"
+    settings.FAISS_ROLE = "reader"
+    import torch
+    torch.set_num_threads(num_threads)
+
+
+def _execute_job(job_id: int, cpu_budget: int = None):
+    # Runs inside a pool process; the pipeline (and its AIEngine) is only imported here, never in the API process.
+    # cpu_budget is the number of cores the dispatcher granted this job for its shards.
+    from services.pipeline import analyze_video, analyze_video_sharded, AnalysisCancelled
+
+    db = SessionLocal()
+    try:
+        job = crud.get_job(db, job_id)
+        if job is None:
+            return
+        last_report = 0.0
+
+        def on_progress(progress):
+            nonlocal last_report
+            now = time.monotonic()
+            if now - last_report < settings.JOB_PROGRESS_INTERVAL_SEC:
+                return
+            last_report = now
+            duration = progress["duration_sec"]
+            status = crud.update_job_progress(
+                db, job_id,
+                frames_processed=progress["frames_processed"],
+                position_sec=progress["position_sec"],
+                duration_sec=duration,
+                progress=min(1.0, progress["position_sec"] / duration) if duration else 0.0,
+                fps=progress["fps"],
+                eta_sec=progress["eta_sec"],
+            )
+            if status == JobStatus.CANCELLING.value:
+                raise AnalysisCancelled()
+
+        try:
+            if settings.PIPELINE_SHARDS > 1:
+                result = analyze_video_sharded(job.video_path, job.video_id, on_progress=on_progress, db=db,
+                                               cpu_budget=cpu_budget)
+            else:
+                result = analyze_video(job.video_path, job.video_id, on_progress=on_progress, db=db)
+        except AnalysisCancelled:
+            # Drop the buckets and rollups flushed before the cancellation, so the video has no partial results
+            crud.delete_analysis_results(db, job.video_id)
+            crud.finish_job(db, job_id, JobStatus.CANCELLED.value)
+            return
+        except Exception as e:
+            log_data.exception('analysis_job_failed|job_id=%s', job_id)
+            crud.finish_job(db, job_id, JobStatus.FAILED.value, error=str(e))
+            return
+
+        crud.update_job_progress(
+            db, job_id,
+            frames_processed=result["frames_processed"],
+            duration_sec=result["duration_sec"],
+            fps=result["frames_processed"] / result["elapsed_sec"] if result["elapsed_sec"] > 0 else None,
+        )
+        result.pop("buckets", None)  # already persisted to the analysis tables
+        crud.finish_job(db, job_id, JobStatus.COMPLETED.value, result=json.dumps(result))
+    finally:
+        db.close()
+
+
+class JobManager:
+    # Pulls queued jobs from the analysis_jobs table (priority first) into a pool of worker processes.
+    # The dispatcher is a plain thread, so nothing here runs on the FastAPI event loop.
+    # Every uvicorn worker starts a JobManager, but only the one holding JOB_LOCK_FILE runs the pool (so the
+    # host gets JOB_WORKERS analysis processes, not one pool per API worker); the others wait on the lock
+    # and take over if that worker exits.
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or settings.JOB_WORKERS or max(1, (os.cpu_count() or 2) - 1)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._executor = None
+        self._running = {}  # job_id -> Future
+        self._cores = {}  # job_id -> cores granted to the running job
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool_broken = False
+        self._dispatcher_lock = None  # fd of JOB_LOCK_FILE while this process is the dispatcher
+
+    @property
+    def is_dispatcher(self):
+        return self._dispatcher_lock is not None
+
+    def _worker_threads(self):
+        return max(1, (os.cpu_count() or 1) // self.max_workers)
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self._worker_threads(),),
+        )
+
+    def _grant_cores(self, claimed: int):
+        # Cores for each of `claimed` jobs about to start. Unsharded jobs run on their worker's share; sharded
+        # jobs split the cores not held by running jobs, so a lone job spreads its shards over the machine.
+        # Must be called with self._lock held.
+        if settings.PIPELINE_SHARDS <= 1:
+            return [self._worker_threads()] * claimed
+        idle = (os.cpu_count() or 1) - sum(self._cores.get(job_id, 0) for job_id in self._running)
+        share, extra = divmod(max(idle, claimed), claimed)
+        return [share + (i < extra) for i in range(claimed)]
+
+    def _claim_dispatcher(self):
+        # True once this process holds the dispatcher lock; it is released when the process exits
+        if self._dispatcher_lock is not None:
+            return True
+        path = settings.JOB_LOCK_FILE
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._dispatcher_lock = fd
+        return True
+
+    def _release_dispatcher(self):
+        if self._dispatcher_lock is not None:
+            os.close(self._dispatcher_lock)
+            self._dispatcher_lock = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="job-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        standby = False
+        while not self._claim_dispatcher():
+            if not standby:
+                print("Job manager on standby: another API worker runs the analysis pool.")
+                standby = True
+            if self._stop.wait(timeout=settings.JOB_POLL_INTERVAL_SEC):
+                return
+        db = SessionLocal()
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=settings.JOB_STALE_SEC)
+            requeued = crud.requeue_stale_jobs(db, cutoff)
+            if requeued:
+                log_data.info('analysis_jobs_requeued|count=%s', requeued)
+        except Exception:
+            log_data.exception('analysis_jobs_requeue_failed')
+        finally:
+            db.close()
+        self._executor = self._new_executor()
+        print(f"Job manager started with {self.max_workers} analysis worker(s).")
+        self._dispatch_loop()
+
+    def stop(self, wait: bool = False):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+        self._release_dispatcher()
+
+    def wake(self):
+        self._wake.set()
+
+    def running_jobs(self):
+        with self._lock:
+            return [job_id for job_id, future in self._running.items() if not future.done()]
+
+    def _dispatch_loop(self):
+        while not self._stop.is_set():
+            try:
+                self._dispatch()
+            except Exception:
+                log_data.exception('analysis_job_dispatch_failed')
+            self._wake.wait(timeout=settings.JOB_POLL_INTERVAL_SEC)
+            self._wake.clear()
+
+    def _dispatch(self):
+        if self._pool_broken:
+            # Every future of a broken pool fails together; replace the pool once, before claiming more work
+            self._pool_broken = False
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._new_executor()
+        with self._lock:
+            self._running = {job_id: f for job_id, f in self._running.items() if not f.done()}
+            self._cores = {job_id: n for job_id, n in self._cores.items() if job_id in self._running}
+            free = self.max_workers - len(self._running)
+        if free <= 0:
+            return
+        db = SessionLocal()
+        try:
+            # Claim the whole round first, so the idle cores are split between every job starting now
+            jobs = []
+            while len(jobs) < free and not self._stop.is_set():
+                job = crud.claim_next_job(db, self.name)
+                if job is None:
+                    break
+                jobs.append(job.id)
+        finally:
+            db.close()
+        if not jobs:
+            return
+        with self._lock:
+            grants = self._grant_cores(len(jobs))
+            for job_id, cores in zip(jobs, grants):
+                future = self._executor.submit(_execute_job, job_id, cores)
+                future.add_done_callback(lambda f, job_id=job_id: self._on_done(job_id, f))
+                self._running[job_id] = future
+                self._cores[job_id] = cores
+
+    def _on_done(self, job_id: int, future):
+        exc = None if future.cancelled() else future.exception()
+        if exc is not None:
+            # The worker died without reporting (crash, OOM kill): record it and replace the broken pool
+            log_data.error('analysis_job_worker_died|job_id=%s,error=%s', job_id, exc)
+            db = SessionLocal()
+            try:
+                crud.finish_job(db, job_id, JobStatus.FAILED.value, error=f"worker process failed: {exc}")
+            finally:
+                db.close()
+            if isinstance(exc, BrokenProcessPool):
+                self._pool_broken = True
+        self._wake.set()
+
+
+job_manager = JobManager()
@@ -0,0 +1,364 @@
+import atexit
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client
+
+import numpy as np
+
+from core.config import settings
+from core.fastapi_logger import log_data
+
+# Client side of the shared model server (services/model_server.py), plus the wire helpers both sides use.
+# Requests are (op, shm_name, array_specs, kwargs) tuples over a Unix socket; image and tensor buffers are
+# written into a per-connection shared memory block and only their (offset, shape, dtype) travel on the socket.
+
+_ALIGN = 64
+_LOAD_POLL_SEC = 0.5  # how often get_model asks the server whether a model it is loading is ready
+_LOADED_STATES = ("ready", "unavailable", "failed")
+
+
+class ModelServerUnavailable(Exception):
+    pass
+
+
+class RemoteInferenceError(Exception):
+    # The server was reached but the model call itself failed; not a reason to fall back
+    pass
+
+
+class ModelUnavailable(RuntimeError):
+    # The server is unreachable and the in-process fallback could not load the model either
+    pass
+
+
+def authkey():
+    return settings.MODEL_SERVER_AUTHKEY.encode() if settings.MODEL_SERVER_AUTHKEY else None
+
+
+def attach_shm(name: str):
+    shm = shared_memory.SharedMemory(name=name)
+    if sys.version_info < (3, 13):
+        # Before 3.13 attaching also registers the block with this process's resource tracker,
+        # which would unlink the client's buffer when the server exits
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _padded(nbytes: int):
+    return (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def pack_arrays(shm, arrays):
+    specs, offset = [], 0
+    for array in arrays:
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf, offset=offset)[...] = array
+        specs.append((offset, array.shape, array.dtype.str))
+        offset += _padded(array.nbytes)
+    return specs
+
+
+def unpack_arrays(shm, specs):
+    return [np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset) for offset, shape, dtype in specs]
+
+
+class _Channel:
+    # One socket connection and its shared memory block; used by one thread at a time
+    def __init__(self, path: str):
+        self.conn = Client(path, family="AF_UNIX", authkey=authkey())
+        self.shm = None
+
+    def _ensure_capacity(self, nbytes: int):
+        if self.shm is not None and self.shm.size >= nbytes:
+            return
+        self._free_shm()
+        self.shm = shared_memory.SharedMemory(create=True, size=1 << max(20, (nbytes - 1).bit_length()))
+
+    def request(self, op: str, arrays, kwargs, timeout: float):
+        specs = None
+        if arrays:
+            arrays = [np.ascontiguousarray(a) for a in arrays]
+            self._ensure_capacity(sum(_padded(a.nbytes) for a in arrays))
+            specs = pack_arrays(self.shm, arrays)
+        self.conn.send((op, self.shm.name if specs else None, specs, kwargs))
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"model server did not answer '{op}' within {timeout:.0f}s")
+        ok, payload = self.conn.recv()
+        if not ok:
+            raise RemoteInferenceError(payload)
+        return payload
+
+    def _free_shm(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def close(self):
+        try:
+            self.conn.close()
+        finally:
+            self._free_shm()
+
+
+class _Box:
+    __slots__ = ("xyxy", "cls")
+
+    def __init__(self, xyxy, cls_id):
+        self.xyxy = [xyxy]
+        self.cls = [cls_id]
+
+
+class _Result:
+    __slots__ = ("boxes",)
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class RemoteFace:
+    # The attributes of insightface's Face that the callers use
+    def __init__(self, bbox, kps, det_score):
+        self.bbox = bbox
+        self.kps = kps
+        self.det_score = det_score
+        self.embedding = None
+
+
+class _RemoteBehaviorModel:
+    def __init__(self, engine, names):
+        self.engine = engine
+        self.names = names
+
+    def __call__(self, frames, device=None, verbose=False):
+        frames = list(frames)
+        try:
+            out = self.engine._call("behavior", frames)
+        except ModelServerUnavailable as e:
+            local, model = self.engine._local_model(e, "behavior")
+            return model(frames, device=local.device, verbose=verbose)
+        return [_Result([_Box(xyxy, cls_id) for xyxy, cls_id in zip(boxes, classes)]) for boxes, classes in out]
+
+
+class _RemoteIdentityModel:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def get(self, img):
+        faces = self.engine.detect_faces(img)
+        return self.engine.embed_faces(img, faces)
+
+
+class _RemoteEmotionModel:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __call__(self, batch):
+        import torch
+        try:
+            logits = self.engine._call("emotion", [batch.detach().cpu().numpy().astype(np.float32, copy=False)])
+        except ModelServerUnavailable as e:
+            local, model = self.engine._local_model(e, "emotion")
+            return model(batch.to(local.device))
+        return torch.from_numpy(logits)
+
+
+class RemoteEngine:
+    # AIEngine drop-in that sends inference to the model server. When the server cannot be reached (or stops
+    # answering), calls run on the in-process `fallback` engine, which loads its models on first use, and the
+    # server is retried after MODEL_SERVER_RETRY_SEC. A model error reported by the server is raised as is.
+    def __init__(self, path: str, fallback, allow_fallback: bool = True, timeout: float = 60.0, retry_sec: float = 10.0):
+        self.path = path
+        self.fallback = fallback
+        self.allow_fallback = allow_fallback
+        self.timeout = timeout
+        self.retry_sec = retry_sec
+        self.backend = "remote"
+        self.device = "cpu"  # tensors are handed over as host memory
+        self.emotion_classes = fallback.emotion_classes
+        self._idle = []
+        self._lock = threading.Lock()
+        self._down_until = 0.0
+        self._last_error = None
+        self._models = {}  # server-side load state of the models that finished loading, until the server goes down
+        self._fallback_logged = False
+        atexit.register(self.close)
+
+    # ---- Transport ----
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return _Channel(self.path)
+
+    def _release(self, channel):
+        with self._lock:
+            self._idle.append(channel)
+
+    def _mark_down(self, error):
+        with self._lock:
+            self._down_until = time.monotonic() + self.retry_sec
+            self._last_error = str(error)
+            self._models = {}
+            idle, self._idle = self._idle, []
+        for channel in idle:
+            channel.close()
+        log_data.warning('model_server_unavailable|socket=%s,error=%s', self.path, error)
+
+    def _call(self, op: str, arrays=None, **kwargs):
+        if time.monotonic() < self._down_until:
+            raise ModelServerUnavailable(self._last_error)
+        try:
+            channel = self._acquire()
+        except OSError as e:
+            self._mark_down(e)
+            raise ModelServerUnavailable(str(e)) from e
+        try:
+            result = channel.request(op, arrays, kwargs, self.timeout)
+        except RemoteInferenceError:
+            self._release(channel)
+            raise
+        except (OSError, EOFError, TimeoutError) as e:
+            # A timed-out connection may still receive the late reply, so it is never reused
+            channel.close()
+            self._mark_down(e)
+            raise ModelServerUnavailable(str(e)) from e
+        self._release(channel)
+        if self._fallback_logged:
+            self._fallback_logged = False
+            log_data.info('model_server_reconnected|socket=%s', self.path)
+        return result
+
+    def _local(self, error):
+        if not self.allow_fallback:
+            raise error
+        if not self._fallback_logged:
+            self._fallback_logged = True
+            log_data.warning('model_server_fallback|socket=%s,error=%s', self.path, error)
+        return self.fallback
+
+    def _local_model(self, error, name: str):
+        # (fallback engine, its model) for a call the server could not take
+        local = self._local(error)
+        model = local.get_model(name)
+        if model is None:
+            raise ModelUnavailable(f"the {name} model is unavailable: the model server is unreachable ({error}) "
+                                   f"and it could not be loaded in-process") from error
+        return local, model
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for channel in idle:
+            channel.close()
+
+    def ping(self):
+        return self._call("ping") == "pong"
+
+    # ---- AIEngine interface ----
+
+    def _model_info(self, name: str):
+        # The server's entry for `name` once it has finished loading. A model that is still loading is waited
+        # for (as AIEngine.get_model waits on its slot) instead of being loaded here as well; an unreachable
+        # server, or one that has not finished loading within the request timeout, falls back.
+        info = self._models.get(name)
+        deadline = time.monotonic() + self.timeout
+        while info is None:
+            models = self._call("models", load=name)
+            for other, entry in models.items():
+                if entry["state"] in _LOADED_STATES:
+                    self._models[other] = entry
+            info = self._models.get(name)
+            if info is None:
+                if time.monotonic() >= deadline:
+                    error = TimeoutError(f"model server did not finish loading '{name}' within {self.timeout:.0f}s "
+                                         f"(state: {models.get(name, {}).get('state', 'not reported')})")
+                    self._mark_down(error)
+                    raise ModelServerUnavailable(str(error)) from error
+                time.sleep(_LOAD_POLL_SEC)
+        return info
+
+    def get_model(self, name: str, warmup: bool = False):
+        try:
+            info = self._model_info(name)
+        except ModelServerUnavailable as e:
+            return self._local(e).get_model(name, warmup)
+        if info["state"] != "ready":
+            return None
+        if name == "behavior":
+            return _RemoteBehaviorModel(self, info["names"])
+        if name == "identity":
+            return _RemoteIdentityModel(self)
+        return _RemoteEmotionModel(self)
+
+    @property
+    def behavior_model(self):
+        return self.get_model("behavior")
+
+    @property
+    def identity_model(self):
+        return self.get_model("identity")
+
+    @property
+    def emotion_model(self):
+        return self.get_model("emotion")
+
+    @property
+    def emotion_transform(self):
+        return self.fallback.emotion_transform
+
+    def detect_faces(self, img):
+        try:
+            found = self._call("detect_faces", [img])
+        except ModelServerUnavailable as e:
+            return self._local_model(e, "identity")[0].detect_faces(img)
+        return [RemoteFace(bbox, kps, det_score) for bbox, kps, det_score in found]
+
+    def embed_faces(self, img, faces):
+        self.embed_faces_batch([(img, faces)])
+        return faces
+
+    def embed_faces_batch(self, items):
+        items = [(img, faces) for img, faces in items if faces]
+        if not items:
+            return items
+        try:
+            embeddings = self._call("embed_faces", [img for img, _ in items],
+                                    kps=[[face.kps for face in faces] for _, faces in items])
+        except ModelServerUnavailable as e:
+            return self._local_model(e, "identity")[0].embed_faces_batch(items)
+        for (_, faces), vectors in zip(items, embeddings):
+            for face, vector in zip(faces, vectors):
+                face.embedding = vector
+        return items
+
+    # ---- Lifecycle / health ----
+
+    def start_preload(self, names=None, warmup: bool = True):
+        # The server preloads its own models; this process only loads them when the server is not there
+        try:
+            self.ping()
+        except ModelServerUnavailable as e:
+            if self.allow_fallback:
+                self._local(e).start_preload(names, warmup)
+
+    def status(self):
+        try:
+            server = self._call("status")
+        except ModelServerUnavailable as e:
+            local = self.fallback.status() if self.allow_fallback else None
+            return {
+                "ready": bool(local and local["ready"]),
+                "backend": "remote",
+                "socket": self.path,
+                "server": None,
+                "server_error": str(e),
+                "fallback": local,
+            }
+        return {"ready": server["ready"], "backend": "remote", "socket": self.path, "server": server}
+
+    def is_ready(self):
+        return self.status()["ready"]
@@ -0,0 +1,172 @@
+import argparse
+import os
+import signal
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from types import SimpleNamespace
+
+from core.config import settings
+from core.constants import ModelState
+from core.fastapi_logger import log_data
+from services.ai_loader import AIEngine
+from services.model_client import attach_shm, authkey, unpack_arrays
+
+# One process owns the models; every API worker (and its job processes) sends inference here over a
+# Unix socket instead of loading its own copy. Start it before the API:
+#
+#   python -m services.model_server
+#
+# and set MODEL_SERVER_MODE=client for the API. Each connection is served on its own thread; calls to
+# the same model are serialized (ultralytics predictors are not thread-safe), different models run concurrently.
+
+
+class ModelServer:
+    def __init__(self, path: str, engine: AIEngine = None):
+        self.path = path
+        self.engine = engine or AIEngine()
+        self.started = time.time()
+        self.requests = 0
+        self._locks = {name: threading.Lock() for name in AIEngine.MODEL_NAMES}
+        self._loading = set()  # models a "models" request started loading in the background
+        self._loading_lock = threading.Lock()
+        self._listener = None
+        self._stop = threading.Event()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over from a server that did not shut down cleanly
+        old_umask = os.umask(0o177)  # socket readable/writable by this user only
+        try:
+            self._listener = Listener(self.path, family="AF_UNIX", authkey=authkey())
+        finally:
+            os.umask(old_umask)
+        self.engine.start_preload(settings.MODEL_SERVER_PRELOAD, warmup=settings.MODEL_WARMUP)
+        print(f"Model server listening on {self.path}")
+        try:
+            while not self._stop.is_set():
+                try:
+                    conn = self._listener.accept()
+                except AuthenticationError:
+                    log_data.warning('model_server_auth_failed|socket=%s', self.path)
+                    continue
+                except OSError:
+                    if self._stop.is_set():
+                        break
+                    raise
+                threading.Thread(target=self._serve, args=(conn,), name="model-server-conn", daemon=True).start()
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.close()
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _serve(self, conn):
+        shm = None
+        try:
+            while True:
+                try:
+                    op, shm_name, specs, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    break
+                if specs and (shm is None or shm.name != shm_name.lstrip("/")):
+                    # The client replaces its block when it needs a bigger one
+                    if shm is not None:
+                        shm.close()
+                    shm = attach_shm(shm_name)
+                arrays = unpack_arrays(shm, specs) if specs else []
+                try:
+                    reply = (True, self._handle(op, arrays, kwargs or {}))
+                except Exception as e:
+                    log_data.exception('model_server_request_failed|op=%s', op)
+                    reply = (False, f"{type(e).__name__}: {e}")
+                del arrays  # views into the client's block must not outlive the request
+                self.requests += 1
+                try:
+                    conn.send(reply)
+                except OSError:
+                    break
+        finally:
+            conn.close()
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:
+                    pass
+
+    def _load_in_background(self, name: str):
+        with self._loading_lock:
+            if name in self._loading:
+                return
+            self._loading.add(name)
+        threading.Thread(target=self.engine.get_model, args=(name, settings.MODEL_WARMUP),
+                         name=f"model-load-{name}", daemon=True).start()
+
+    def _handle(self, op: str, arrays, kwargs):
+        engine = self.engine
+        if op == "ping":
+            return "pong"
+        if op == "status":
+            status = engine.status()
+            status.update(pid=os.getpid(), uptime_sec=round(time.time() - self.started, 1), requests=self.requests)
+            return status
+        if op == "models":
+            # Answered from the load state, never by loading: a cold server would otherwise hold this request
+            # past the client's timeout. A requested model outside MODEL_SERVER_PRELOAD starts loading in the
+            # background and the client polls until it is ready.
+            wanted = kwargs.get("load")
+            info = {}
+            for name in AIEngine.MODEL_NAMES:
+                if name == wanted and engine.model_state(name) == ModelState.NOT_LOADED:
+                    self._load_in_background(name)
+                state = engine.model_state(name)
+                info[name] = {"state": state.value}
+                if name == "behavior" and state == ModelState.READY:
+                    info[name]["names"] = dict(engine.get_model(name).names)
+            return info
+        if op == "behavior":
+            with self._locks["behavior"]:
+                results = engine.behavior_model(arrays, device=engine.device, verbose=False)
+            return [(r.boxes.xyxy.cpu().numpy(), r.boxes.cls.cpu().numpy().astype(int)) for r in results]
+        if op == "detect_faces":
+            with self._locks["identity"]:
+                faces = engine.detect_faces(arrays[0])
+            return [(face.bbox, face.kps, float(face.det_score)) for face in faces]
+        if op == "embed_faces":
+            items = [(img, [SimpleNamespace(kps=kps, embedding=None) for kps in kpss])
+                     for img, kpss in zip(arrays, kwargs["kps"])]
+            with self._locks["identity"]:
+                engine.embed_faces_batch(items)
+            return [[face.embedding for face in faces] for _, faces in items]
+        if op == "emotion":
+            import torch
+            with self._locks["emotion"], torch.no_grad():
+                logits = engine.emotion_model(torch.from_numpy(arrays[0]).to(engine.device))
+            return logits.cpu().numpy()
+        raise ValueError(f"unknown op {op!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the AI models to the API workers over a Unix socket.")
+    parser.add_argument("--socket", default=settings.MODEL_SERVER_SOCKET)
+    args = parser.parse_args()
+    server = ModelServer(args.socket)
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
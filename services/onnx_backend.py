@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+from core.config import settings
+
+# ONNX Runtime inference for the emotion (ResNet18) and behavior (YOLOv8) models.
+# Exports are cached next to the source weights and rebuilt when the weights are newer:
+#   resnet18_best.ckpt -> resnet18_best.onnx (-> resnet18_best.int8.onnx)
+#   yolov8_best.pt     -> yolov8_best.onnx   (-> yolov8_best.int8.onnx)
+# A pre-built .onnx file is used as-is when the PyTorch weights are not shipped.
+
+EMOTION_INPUT_SIZE = 224
+ONNX_OPSET = 17
+
+
+def _providers(device):
+    if device is not None and torch.device(device).type == "cuda":
+        return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    return ["CPUExecutionProvider"]
+
+
+def session_options():
+    import onnxruntime as ort
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    if settings.ONNX_INTRA_OP_THREADS > 0:
+        opts.intra_op_num_threads = settings.ONNX_INTRA_OP_THREADS
+    return opts
+
+
+def _is_stale(target: Path, source: Path):
+    if not target.exists():
+        return True
+    return source.exists() and source.stat().st_mtime > target.stat().st_mtime
+
+
+def quantize_int8(src: Path, dst: Path):
+    # Dynamic quantization: int8 weights, activations quantized per batch at run time (no calibration set)
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(str(src), str(dst), weight_type=QuantType.QInt8)
+    return dst
+
+
+def _quantized_path(path: Path):
+    return path.with_name(f"{path.stem}.int8.onnx")
+
+
+def export_emotion_model(model, onnx_path: Path):
+    device = next(model.parameters()).device
+    dummy = torch.zeros(1, 3, EMOTION_INPUT_SIZE, EMOTION_INPUT_SIZE)
+    try:
+        torch.onnx.export(
+            model.to("cpu").eval(), dummy, str(onnx_path),
+            input_names=["input"], output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+        )
+    finally:
+        model.to(device)
+    return onnx_path
+
+
+class OnnxEmotionModel:
+    # Drop-in for the eager ResNet18: takes the same normalized (N, 3, 224, 224) tensor and returns logits
+    def __init__(self, path: Path, device=None):
+        import onnxruntime as ort
+        self.path = Path(path)
+        self.session = ort.InferenceSession(str(self.path), sess_options=session_options(), providers=_providers(device))
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        array = batch.detach().cpu().numpy().astype(np.float32, copy=False)
+        logits = self.session.run(None, {self.input_name: array})[0]
+        return torch.from_numpy(logits)
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
+def load_emotion_model(torch_model, ckpt_path, device=None, quantize: bool = False):
+    ckpt_path = Path(ckpt_path)
+    onnx_path = ckpt_path.with_suffix(".onnx")
+    if torch_model is not None and _is_stale(onnx_path, ckpt_path):
+        export_emotion_model(torch_model, onnx_path)
+        print(f"Emotion model exported to {onnx_path}.")
+    if not onnx_path.exists():
+        raise FileNotFoundError(onnx_path)
+    if quantize:
+        quant_path = _quantized_path(onnx_path)
+        if _is_stale(quant_path, onnx_path):
+            quantize_int8(onnx_path, quant_path)
+        onnx_path = quant_path
+    return OnnxEmotionModel(onnx_path, device)
+
+
+def load_behavior_model(weights_path, quantize: bool = False):
+    # ultralytics runs .onnx weights through onnxruntime itself (letterbox, NMS and Results unchanged),
+    # so the exported model keeps the YOLO call signature the pipeline uses. The export has a dynamic
+    # batch axis for the batched detect stage; class names travel in the ONNX metadata.
+    from ultralytics import YOLO
+    weights_path = Path(weights_path)
+    onnx_path = weights_path.with_suffix(".onnx")
+    if weights_path.exists() and _is_stale(onnx_path, weights_path):
+        exported = YOLO(str(weights_path)).export(format="onnx", dynamic=True, simplify=True, opset=ONNX_OPSET)
+        if Path(exported) != onnx_path:
+            os.replace(exported, onnx_path)
+        print(f"YOLOv8 model exported to {onnx_path}.")
+    if not onnx_path.exists():
+        raise FileNotFoundError(onnx_path)
+    if quantize:
+        quant_path = _quantized_path(onnx_path)
+        if _is_stale(quant_path, onnx_path):
+            quantize_int8(onnx_path, quant_path)
+        onnx_path = quant_path
+    return YOLO(str(onnx_path), task="detect")
+
+
+# ---- Parity check ----
+
+def compare_emotion(reference, candidate, batch):
+    with torch.no_grad():
+        expected = reference(batch).cpu().numpy()
+    actual = candidate(batch).numpy()
+    return {
+        "samples": int(batch.shape[0]),
+        "max_abs_diff": float(np.abs(expected - actual).max()),
+        "mean_abs_diff": float(np.abs(expected - actual).mean()),
+        "top1_agreement": float((expected.argmax(1) == actual.argmax(1)).mean()),
+    }
+
+
+def _box_iou(a, b):
+    x1, y1 = np.maximum(a[:, None, 0], b[None, :, 0]), np.maximum(a[:, None, 1], b[None, :, 1])
+    x2, y2 = np.minimum(a[:, None, 2], b[None, :, 2]), np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def compare_behavior(reference, candidate, frames, iou_threshold: float = 0.5):
+    # A reference box counts as reproduced when the candidate has a box of the same class at IoU >= threshold
+    matched = expected_total = candidate_total = 0
+    for ref, cand in zip(reference(frames, verbose=False), candidate(frames, verbose=False)):
+        ref_boxes, ref_cls = ref.boxes.xyxy.cpu().numpy(), ref.boxes.cls.cpu().numpy()
+        cand_boxes, cand_cls = cand.boxes.xyxy.cpu().numpy(), cand.boxes.cls.cpu().numpy()
+        expected_total += len(ref_boxes)
+        candidate_total += len(cand_boxes)
+        if len(ref_boxes) and len(cand_boxes):
+            ious = _box_iou(ref_boxes, cand_boxes)
+            ious[ref_cls[:, None] != cand_cls[None, :]] = 0.0
+            used = set()
+            for i in np.argsort(-ious.max(1)):
+                j = int(ious[i].argmax())
+                if ious[i, j] >= iou_threshold and j not in used:
+                    used.add(j)
+                    matched += 1
+    return {
+        "frames": len(frames),
+        "reference_boxes": expected_total,
+        "candidate_boxes": candidate_total,
+        "recall": matched / expected_total if expected_total else 1.0,
+        "precision": matched / candidate_total if candidate_total else 1.0,
+    }
+
+
+def _sample_frames(video_path, count):
+    cap = cv2.VideoCapture(video_path)
+    try:
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or count
+        frames = []
+        for index in np.linspace(0, total - 1, count).astype(int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+            ok, frame = cap.read()
+            if ok:
+                frames.append(frame)
+        return frames
+    finally:
+        cap.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the ONNX Runtime models against the PyTorch originals.")
+    parser.add_argument("--video", required=True, help="video to sample frames from")
+    parser.add_argument("--frames", type=int, default=32)
+    parser.add_argument("--quantize", action="store_true", default=settings.ONNX_QUANTIZE,
+                        help="check the int8 models (default: ONNX_QUANTIZE)")
+    args = parser.parse_args()
+
+    from ultralytics import YOLO
+    from services.ai_loader import EMOTION_WEIGHTS, YOLO_WEIGHTS, build_emotion_transform, load_emotion_checkpoint
+
+    frames = _sample_frames(args.video, args.frames)
+    if not frames:
+        parser.error(f"no frames could be read from {args.video}")
+    report = {"quantize": args.quantize}
+    if EMOTION_WEIGHTS.exists():
+        reference = load_emotion_checkpoint(EMOTION_WEIGHTS, torch.device("cpu"))
+        candidate = load_emotion_model(reference, EMOTION_WEIGHTS, quantize=args.quantize)
+        # Whole frames through the emotion transform: parity is about the numerics, not the faces
+        emotion_transform = build_emotion_transform()
+        batch = torch.stack([emotion_transform(cv2.cvtColor(f, cv2.COLOR_BGR2RGB)) for f in frames])
+        report["emotion"] = compare_emotion(reference, candidate, batch)
+    if YOLO_WEIGHTS.exists():
+        report["behavior"] = compare_behavior(
+            YOLO(str(YOLO_WEIGHTS)), load_behavior_model(YOLO_WEIGHTS, quantize=args.quantize), frames
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
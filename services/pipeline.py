@@ -1,88 +1,947 @@
 import os
+import queue
+import math
+import multiprocessing
+import threading
+import time
 import cv2
-import torch
+import numpy as np
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from sqlalchemy.orm import Session
+from db import crud
 from db.vector_db import vector_db_instance
-from services.ai_loader import ai_engine
+from core.config import settings
 from core.database import SessionLocal
+from core.fastapi_logger import log_data
+from services.profiling import PipelineProfiler
 
 
-def run_analysis_pipeline(video_path: str, video_id: str):
-    print(f"[{video_id}] Pipeline started for: {video_path}")
-    db: Session = SessionLocal()
-    try:
-        if ai_engine.behavior_model is None:
-            print(f"[{video_id}] YOLO model unavailable. Skipping processing.")
-            return
-        cap = cv2.VideoCapture(video_path)
-        fps = cap.get(cv2.CAP_PROP_FPS) or 0
-        frame_interval = int(fps) if fps > 0 else 1
-        frame_count = 0
+class Detection:
+    __slots__ = ("box", "behavior", "student_id", "similarity", "face_crop", "emotion", "track")
+
+    def __init__(self, box, behavior):
+        self.box = box
+        self.behavior = behavior
+        self.student_id = None
+        self.similarity = 0.0
+        self.face_crop = None
+        self.emotion = "unknown"
+        self.track = None
+
+
+class FrameItem:
+    __slots__ = ("index", "timestamp", "duration", "frame", "detections", "motion", "reuse")
+
+    def __init__(self, index, timestamp, frame, duration=1.0):
+        self.index = index
+        self.timestamp = timestamp
+        self.duration = duration  # seconds of video this sample accounts for
+        self.frame = frame
+        self.detections = []
+        self.motion = None
+        self.reuse = False  # static scene: take the previous analyzed frame's detections instead of inferring
+
+
+class AnalysisContext:
+    # Per-run state shared by the stages
+    def __init__(self, engine, tracker=None, profiler: PipelineProfiler = None):
+        self.engine = engine
+        self.tracker = tracker
+        self.profiler = profiler or PipelineProfiler(enabled=False)
+
+
+# === Geometry ===
+def _overlap(a, b):
+    # Pairwise intersection areas (len(a) x len(b)) plus the area of each box
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    iw = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    ih = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    area_a = np.clip((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), 1e-6, None)
+    area_b = np.clip((b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]), 1e-6, None)
+    return iw * ih, area_a, area_b
+
+
+def _iou_matrix(a, b):
+    inter, area_a, area_b = _overlap(a, b)
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def assign_faces_to_boxes(face_boxes, person_boxes, min_containment: float = 0.6):
+    # For each person box, the index of the largest face that lies inside it (-1 if none).
+    # A face belongs to the eligible box (>= min_containment of the face inside) it overlaps best (IoU).
+    inter, face_area, box_area = _overlap(face_boxes, person_boxes)
+    assigned = np.full(len(box_area), -1, dtype=np.int64)
+    if len(face_area) == 0 or len(box_area) == 0:
+        return assigned
+
+    containment = inter / face_area[:, None]
+    iou = inter / (face_area[:, None] + box_area[None, :] - inter)
+
+    eligible = containment >= min_containment
+    owner = np.where(eligible, iou, -1.0).argmax(axis=1)
+    owner[~eligible.any(axis=1)] = -1
+
+    # Largest face wins each box: walk faces by area (descending) and keep the first per owner
+    order = np.argsort(-face_area, kind="stable")
+    order = order[owner[order] >= 0]
+    boxes, first = np.unique(owner[order], return_index=True)
+    assigned[boxes] = order[first]
+    return assigned
+
+
+# === Tracking ===
+class Track:
+    __slots__ = ("track_id", "box", "velocity", "last_seen", "student_id", "similarity",
+                 "identified_at", "emotion", "emotion_at")
+
+    def __init__(self, track_id, box, timestamp):
+        self.track_id = track_id
+        self.box = np.asarray(box, dtype=np.float32)
+        self.velocity = np.zeros(4, dtype=np.float32)  # box coordinates per second
+        self.last_seen = timestamp
+        self.student_id = None
+        self.similarity = 0.0
+        self.identified_at = None
+        self.emotion = None
+        self.emotion_at = None
+
+    def predict(self, timestamp):
+        return self.box + self.velocity * (timestamp - self.last_seen)
+
+    def needs_identity(self, timestamp, refresh_sec, min_similarity):
+        return (
+            self.student_id is None
+            or self.similarity < min_similarity
+            or timestamp - self.identified_at >= refresh_sec
+        )
+
+    def needs_emotion(self, timestamp, refresh_sec):
+        return self.emotion is None or timestamp - self.emotion_at >= refresh_sec
+
+
+class IoUTracker:
+    # Greedy IoU matching against constant-velocity predictions; tracks unseen for max_age_sec are dropped
+    def __init__(self, iou_threshold: float = 0.3, max_age_sec: float = 5.0):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age_sec
+        self.tracks = []
+        self._next_id = 1
+
+    def hold(self, timestamp):
+        # Nothing moved since the last update: tracks seen then are still present at timestamp
+        latest = max((t.last_seen for t in self.tracks), default=None)
+        for track in self.tracks:
+            if track.last_seen == latest:
+                track.last_seen = timestamp
+                track.velocity[:] = 0
+
+    def update(self, boxes, timestamp):
+        # The Track for each box, in order; unmatched boxes start new tracks
+        self.tracks = [t for t in self.tracks if timestamp - t.last_seen <= self.max_age]
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        matched = [None] * len(boxes)
+
+        if self.tracks and len(boxes):
+            iou = _iou_matrix(np.stack([t.predict(timestamp) for t in self.tracks]), boxes)
+            pairs = np.argwhere(iou >= self.iou_threshold)
+            pairs = pairs[np.argsort(-iou[pairs[:, 0], pairs[:, 1]], kind="stable")]
+            used = set()
+            for ti, bi in pairs:
+                if ti in used or matched[bi] is not None:
+                    continue
+                used.add(ti)
+                track = self.tracks[ti]
+                dt = timestamp - track.last_seen
+                if dt > 0:
+                    track.velocity = 0.5 * track.velocity + 0.5 * (boxes[bi] - track.box) / dt
+                track.box = boxes[bi]
+                track.last_seen = timestamp
+                matched[bi] = track
+
+        for bi in range(len(boxes)):
+            if matched[bi] is None:
+                track = Track(self._next_id, boxes[bi], timestamp)
+                self._next_id += 1
+                self.tracks.append(track)
+                matched[bi] = track
+        return matched
+
+
+def create_tracker():
+    if not settings.PIPELINE_TRACKING:
+        return None
+    return IoUTracker(settings.PIPELINE_TRACK_IOU, settings.PIPELINE_TRACK_MAX_AGE_SEC)
+
+
+# === Stages (each takes the run context and mutates a batch of FrameItem) ===
+def _detect_stage(ctx, items):
+    engine = ctx.engine
+    items = [item for item in items if not item.reuse]
+    if not items:
+        return
+    # One YOLO call for the whole batch; ultralytics returns one Results per input image, in order
+    with ctx.profiler.stage("yolo", len(items)):
+        results = engine.behavior_model([item.frame for item in items], device=engine.device, verbose=False)
+    for item, result in zip(items, results):
+        for box in result.boxes:
+            x1, y1, x2, y2 = map(int, box.xyxy[0])
+            cls_id = int(box.cls[0])
+            item.detections.append(Detection((x1, y1, x2, y2), engine.behavior_model.names[cls_id]))
+
+
+def _largest_face(faces):
+    return max(faces, key=lambda f: (f.bbox[2]-f.bbox[0])*(f.bbox[3]-f.bbox[1]))
 
-        student_behavior_time = defaultdict(lambda: defaultdict(float))
-        student_emotion_time = defaultdict(lambda: defaultdict(float))
 
-        while cap.isOpened():
-            ret, frame = cap.read()
+def _locate_faces_per_box(engine, item, dets):
+    # Detector pass on each person crop; the chosen face is shifted back to frame coordinates
+    located = []
+    for det in dets:
+        x1, y1, x2, y2 = det.box
+        student_crop = item.frame[y1:y2, x1:x2]
+        if student_crop.size == 0:
+            continue
+        faces = engine.detect_faces(student_crop)
+        if not faces:
+            continue
+        face = _largest_face(faces)
+        face.bbox = face.bbox + np.array([x1, y1, x1, y1], dtype=face.bbox.dtype)
+        if face.kps is not None:
+            face.kps = face.kps + np.array([x1, y1], dtype=face.kps.dtype)
+        located.append((det, face))
+    return located
+
+
+def _locate_faces_full_frame(engine, item, dets):
+    # One detector pass over the whole frame instead of one per (overlapping) person crop.
+    # Assignment always considers every box so a skipped box cannot lose its face to a neighbour.
+    faces = engine.detect_faces(item.frame)
+    if not faces:
+        return []
+    assigned = assign_faces_to_boxes(
+        [f.bbox[:4] for f in faces],
+        [det.box for det in item.detections],
+        settings.PIPELINE_FACE_MIN_CONTAINMENT,
+    )
+    wanted = set(dets)
+    return [(det, faces[i]) for det, i in zip(item.detections, assigned) if i >= 0 and det in wanted]
+
+
+def _apply_tracks(tracker, item):
+    # Seed each detection from its track; returns the detections that still need identity / emotion
+    ts = item.timestamp
+    need_identity, need_emotion = set(), set()
+    tracks = tracker.update([det.box for det in item.detections], ts)
+    for det, track in zip(item.detections, tracks):
+        det.track = track
+        det.student_id, det.similarity = track.student_id, track.similarity
+        det.emotion = track.emotion or "unknown"
+        if track.needs_identity(ts, settings.PIPELINE_TRACK_REFRESH_SEC, settings.PIPELINE_TRACK_MIN_SIMILARITY):
+            need_identity.add(det)
+        if track.needs_emotion(ts, settings.PIPELINE_TRACK_EMOTION_REFRESH_SEC):
+            need_emotion.add(det)
+    return need_identity, need_emotion
+
+
+def _identify_stage(ctx, items):
+    engine = ctx.engine
+    if engine.identity_model is None:
+        return
+    locate = _locate_faces_full_frame if settings.PIPELINE_FACE_MODE == "full_frame" else _locate_faces_per_box
+    to_resolve = []
+    for item in items:
+        if item.reuse and ctx.tracker is not None:
+            ctx.tracker.hold(item.timestamp)
+        if not item.detections:
+            continue
+        if ctx.tracker is not None:
+            with ctx.profiler.stage("track", len(item.detections)):
+                need_identity, need_emotion = _apply_tracks(ctx.tracker, item)
+        else:
+            need_identity = need_emotion = set(item.detections)
+        pending = [det for det in item.detections if det in need_identity or det in need_emotion]
+        if not pending:
+            continue
+
+        with ctx.profiler.stage("face_detect", len(pending)):
+            located = locate(engine, item, pending)
+        # Faces whose identity is still trusted (or unassigned) never reach recognition
+        to_embed = [face for det, face in located if det in need_identity]
+        if to_embed:
+            with ctx.profiler.stage("face_embed", len(to_embed)):
+                engine.embed_faces(item.frame, to_embed)
+
+        height, width = item.frame.shape[:2]
+        for det, face in located:
+            if det in need_identity and getattr(face, 'embedding', None) is not None:
+                to_resolve.append((item, det, face.embedding))
+            if det in need_emotion:
+                fx1, fy1, fx2, fy2 = map(int, face.bbox)
+                face_crop = item.frame[max(0, fy1):min(fy2, height), max(0, fx1):min(fx2, width)]
+                if face_crop.size > 0:
+                    det.face_crop = face_crop
+
+    if not to_resolve:
+        return
+    # Every embedding from the batch is resolved in one FAISS search
+    with ctx.profiler.stage("faiss", len(to_resolve)):
+        matches = vector_db_instance.search_embeddings(np.stack([emb.reshape(-1) for _, _, emb in to_resolve]))
+    for (item, det, _), (student_id, similarity) in zip(to_resolve, matches):
+        if student_id is None:
+            continue
+        det.student_id, det.similarity = student_id, similarity
+        if det.track is not None:
+            det.track.student_id, det.track.similarity = student_id, similarity
+            det.track.identified_at = item.timestamp
+
+
+def _emotion_stage(ctx, items):
+    engine = ctx.engine
+    if engine.emotion_model is None:
+        return
+    # Every face in the frame window goes through the ResNet in one batched forward pass
+    # (chunked by PIPELINE_EMOTION_BATCH_SIZE to bound memory)
+    pending = [(item, det) for item in items for det in item.detections if det.face_crop is not None]
+    if not pending:
+        return
+    import torch  # only needed once there are faces to classify; the rest of the pipeline is torch-free
+    chunk = max(1, settings.PIPELINE_EMOTION_BATCH_SIZE)
+    with torch.no_grad():
+        for start in range(0, len(pending), chunk):
+            part = pending[start:start + chunk]
+            with ctx.profiler.stage("emotion_preprocess", len(part)):
+                batch = torch.stack([
+                    engine.emotion_transform(cv2.cvtColor(det.face_crop, cv2.COLOR_BGR2RGB)) for _, det in part
+                ]).to(engine.device)
+            with ctx.profiler.stage("emotion", len(part)):
+                logits = engine.emotion_model(batch)
+            for (item, det), emotion_idx in zip(part, logits.argmax(1).tolist()):
+                det.emotion = engine.emotion_classes[emotion_idx]
+                if det.track is not None:
+                    det.track.emotion, det.track.emotion_at = det.emotion, item.timestamp
+
+
+class AnalysisAggregate:
+    # Per-student totals for the whole run, plus time-bucketed durations not yet persisted
+    def __init__(self, bucket_sec: int):
+        self.bucket_sec = max(1, int(bucket_sec))
+        self.behavior_time = defaultdict(lambda: defaultdict(float))
+        self.emotion_time = defaultdict(lambda: defaultdict(float))
+        self.buckets = defaultdict(float)  # (student_id, bucket_start, category, label) -> seconds
+        self.last_detections = []
+
+    def bucket_of(self, item):
+        # A sample stands for (timestamp - duration, timestamp]; bucket it by the midpoint
+        midpoint = max(0.0, item.timestamp - item.duration / 2)
+        return int(midpoint // self.bucket_sec) * self.bucket_sec
+
+    def add(self, items):
+        for item in items:
+            # Items arrive in order, so a reused sample repeats the latest analyzed one
+            if item.reuse:
+                item.detections = self.last_detections
+            else:
+                self.last_detections = item.detections
+            bucket = self.bucket_of(item)
+            for det in item.detections:
+                if det.student_id is None:
+                    continue
+                self.behavior_time[det.student_id][det.behavior] += item.duration
+                self.emotion_time[det.student_id][det.emotion] += item.duration
+                self.buckets[(det.student_id, bucket, "behavior", det.behavior)] += item.duration
+                self.buckets[(det.student_id, bucket, "emotion", det.emotion)] += item.duration
+
+    def take_buckets(self, before: int = None):
+        # Removes and returns (student_id, bucket_start, category, label, seconds) rows, in key order,
+        # for buckets starting before `before` (all of them if None)
+        keys = sorted(k for k in self.buckets if before is None or k[1] < before)
+        return [(*key, self.buckets.pop(key)) for key in keys]
+
+
+def _accumulate(items, aggregate):
+    aggregate.add(items)
+    for item in items:
+        # Release the decoded image as soon as the batch is accounted for
+        item.frame = None
+        for det in item.detections:
+            det.face_crop = None
+
+
+# === Decode backends ===
+class MotionSampler:
+    # Adapts the sampling interval to scene motion, scored as the mean absolute difference between
+    # small grayscale copies of this frame and the last analyzed one. Static frames are marked for
+    # reuse and stretch the interval; a motion spike drops it to the minimum.
+    def __init__(self, base_interval: float, min_interval: float, max_interval: float,
+                 static_threshold: float, spike_threshold: float, max_reuse_sec: float, size=(64, 36)):
+        self.base_interval = base_interval
+        self.min_interval = min(min_interval, base_interval)
+        self.max_interval = max(max_interval, base_interval)
+        self.static_threshold = static_threshold
+        self.spike_threshold = spike_threshold
+        self.max_reuse_sec = max_reuse_sec
+        self.size = size
+        self.interval = base_interval
+        self._reference = None
+        self._reference_ts = None
+
+    def observe(self, item):
+        # Scores item, sets item.motion / item.reuse, and returns the interval to the next target
+        small = cv2.resize(cv2.cvtColor(item.frame, cv2.COLOR_BGR2GRAY), self.size, interpolation=cv2.INTER_AREA)
+        if self._reference is None:
+            motion = float("inf")
+        else:
+            motion = float(cv2.absdiff(small, self._reference).mean())
+        item.motion = motion
+        stale = self._reference_ts is not None and item.timestamp - self._reference_ts >= self.max_reuse_sec
+        if motion < self.static_threshold and not stale:
+            item.reuse = True
+            self.interval = min(self.max_interval, self.interval * 2)
+        else:
+            # The reference only moves on analyzed frames, so slow drift still adds up to a re-analysis
+            self._reference = small
+            self._reference_ts = item.timestamp
+            spike = motion >= self.spike_threshold and motion != float("inf")
+            self.interval = self.min_interval if spike else self.base_interval
+        return self.interval
+
+
+class FrameSource:
+    # Yields FrameItem for each target timestamp (start + k * interval, k >= 1, up to end).
+    # Subclasses only differ in how they get from one target to the next.
+    name = "read"
+
+    def __init__(self, video_path: str, interval_sec: float = 1.0, max_width: int = 0,
+                 start_sec: float = 0.0, end_sec: float = None, sampler: MotionSampler = None):
+        self.video_path = video_path
+        self.interval = interval_sec if interval_sec > 0 else 1.0
+        self.sampler = sampler
+        self.max_width = max_width
+        self.cap = cv2.VideoCapture(video_path)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS) or 0
+        frame_total = self.cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+        self.duration = frame_total / self.fps if self.fps > 0 and frame_total > 0 else None
+        # Timestamp of the last frame; a target after it but within the duration is served by that frame
+        self.last_ts = (frame_total - 1) / self.fps if self.duration else None
+        self.start = max(0.0, start_sec or 0.0)
+        self.end = end_sec if end_sec is not None else float("inf")
+
+    def close(self):
+        self.cap.release()
+
+    def _timestamp(self, index):
+        if self.fps > 0:
+            return index / self.fps
+        return self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+
+    def _due(self, target):
+        # Frame timestamp that serves `target`: a 30 s clip has its last frame at 29.96 s, which stands for the
+        # sample at 30 s as well (the baseline, counting every fps-th frame, got that sample too)
+        if self.last_ts is not None and self.last_ts < target <= self.duration + 1e-6:
+            return self.last_ts
+        return target
+
+    def _resize(self, frame):
+        # Only after the full-resolution decode: OpenCV's VideoCapture has no decoder-side scaling, so this
+        # saves the colour conversion and inference cost downstream but not the decode itself
+        if self.max_width and frame.shape[1] > self.max_width:
+            scale = self.max_width / frame.shape[1]
+            frame = cv2.resize(frame, (self.max_width, int(round(frame.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def _next_interval(self, item):
+        if self.sampler is None:
+            return self.interval
+        return self.sampler.observe(item)
+
+    def _seek_start(self):
+        # Index of the first frame to read
+        if self.start <= 0:
+            return 0
+        self.cap.set(cv2.CAP_PROP_POS_MSEC, self.start * 1000.0)
+        return int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def _frames(self, index):
+        # (index, timestamp, fetch) for every frame from index on; fetch() returns the decoded image
+        while True:
+            ret, frame = self.cap.read()
             if not ret:
-                break
+                return
+            yield index, self._timestamp(index), (lambda f=frame: f)
+            index += 1
 
-            frame_count += 1
-            if frame_count % frame_interval != 0:
+    def __iter__(self):
+        # Half a frame of tolerance so a target that falls between two frames picks the nearest later one
+        tol = 0.5 / self.fps if self.fps > 0 else 0.0
+        step = self.interval
+        target = self.start + step
+        prev = self.start
+        for index, ts, fetch in self._frames(self._seek_start()):
+            if ts + tol < self._due(target):
+                continue
+            if target > self.end + 1e-6:
+                return
+            last = target
+            while self._due(last + step) <= ts + tol and last + step <= self.end + 1e-6:
+                last += step
+            frame = fetch()
+            if frame is None:
+                target = last + step
                 continue
+            # A sample stands for every target consumed since the previous sample
+            item = FrameItem(index, ts, self._resize(frame), duration=last - prev)
+            prev = last
+            step = self._next_interval(item)
+            target = last + step
+            yield item
+
+
+class GrabFrameSource(FrameSource):
+    # grab() demuxes and decodes without the colour conversion/copy; retrieve() only for kept frames
+    name = "grab"
+
+    def _frames(self, index):
+        while self.cap.grab():
+            yield index, self._timestamp(index), self._retrieve
+            index += 1
+
+    def _retrieve(self):
+        ret, frame = self.cap.retrieve()
+        return frame if ret else None
 
-            behavior_results = ai_engine.behavior_model(frame, device=ai_engine.device, verbose=False)
-            for result in behavior_results:
-                boxes = result.boxes
-                for box in boxes:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    cls_id = int(box.cls[0])
-                    behavior_name = ai_engine.behavior_model.names[cls_id]
-
-                    student_crop = frame[y1:y2, x1:x2]
-                    if student_crop.size == 0:
-                        continue
-
-                    student_id = None
-                    emotion_name = "unknown"
-
-                    faces = []
-                    if ai_engine.identity_model is not None:
-                        faces = ai_engine.identity_model.get(student_crop)
-                    if faces and len(faces) > 0:
-                        face = sorted(
-                            faces,
-                            key=lambda f: (f.bbox[2]-f.bbox[0])*(f.bbox[3]-f.bbox[1]),
-                            reverse=True
-                        )[0]
-
-                        if getattr(face, 'embedding', None) is not None:
-                            embedding = face.embedding.reshape(1, -1)
-                            student_id, similarity = vector_db_instance.search_embedding(embedding)
-
-                        fx1, fy1, fx2, fy2 = map(int, face.bbox)
-                        face_crop = student_crop[max(0, fy1):min(fy2, student_crop.shape[0]), max(0, fx1):min(fx2, student_crop.shape[1])]
-
-                        if face_crop.size > 0 and ai_engine.emotion_model is not None:
-                            with torch.no_grad():
-                                rgb = cv2.cvtColor(face_crop, cv2.COLOR_BGR2RGB)
-                                img_tensor = ai_engine.emotion_transform(rgb).unsqueeze(0).to(ai_engine.device)
-                                logits = ai_engine.emotion_model(img_tensor)
-                                emotion_idx = logits.argmax(1).item()
-                                emotion_name = ai_engine.emotion_classes[emotion_idx]
-
-                    if student_id is not None:
-                        student_behavior_time[student_id][behavior_name] += 1.0
-                        student_emotion_time[student_id][emotion_name] += 1.0
-
-        cap.release()
-
-        # Per current design, persisting analysis results is deferred and handled elsewhere
+
+class SeekFrameSource(FrameSource):
+    # Jumps straight to each target; only frames from the preceding keyframe onwards get decoded.
+    # Best when the sampling interval spans several GOPs.
+    name = "seek"
+
+    def __iter__(self):
+        target = self.start + self.interval
+        prev = self.start
+        while target <= self.end + 1e-6:
+            if not self.cap.set(cv2.CAP_PROP_POS_MSEC, self._due(target) * 1000.0):
+                return
+            ret, frame = self.cap.read()
+            if not ret:
+                return
+            index = int(round(self._due(target) * self.fps)) if self.fps > 0 else 0
+            item = FrameItem(index, target, self._resize(frame), duration=target - prev)
+            prev = target
+            target += self._next_interval(item)
+            yield item
+
+
+FRAME_SOURCES = {cls.name: cls for cls in (FrameSource, GrabFrameSource, SeekFrameSource)}
+
+
+def open_frame_source(video_path: str, backend: str = None, start_sec: float = 0.0, end_sec: float = None):
+    backend = backend or settings.PIPELINE_DECODE_BACKEND
+    cls = FRAME_SOURCES.get(backend)
+    if cls is None:
+        raise ValueError(f"Unknown decode backend: {backend}")
+    sampler = None
+    if settings.PIPELINE_ADAPTIVE_SAMPLING:
+        sampler = MotionSampler(
+            base_interval=settings.PIPELINE_SAMPLE_INTERVAL_SEC,
+            min_interval=settings.PIPELINE_MOTION_MIN_INTERVAL_SEC,
+            max_interval=settings.PIPELINE_MOTION_MAX_INTERVAL_SEC,
+            static_threshold=settings.PIPELINE_MOTION_STATIC_THRESHOLD,
+            spike_threshold=settings.PIPELINE_MOTION_SPIKE_THRESHOLD,
+            max_reuse_sec=settings.PIPELINE_MOTION_MAX_REUSE_SEC,
+        )
+    return cls(
+        video_path,
+        interval_sec=settings.PIPELINE_SAMPLE_INTERVAL_SEC,
+        max_width=settings.PIPELINE_DECODE_MAX_WIDTH,
+        start_sec=start_sec,
+        end_sec=end_sec,
+        sampler=sampler,
+    )
+
+
+def _iter_batches(source, batch_size, profiler: PipelineProfiler = None):
+    profiler = profiler or PipelineProfiler(enabled=False)
+    batch = []
+    frames = iter(source)
+    while True:
+        # Decode time is whatever the source spends reaching (and decoding) the next sample
+        with profiler.stage("decode"):
+            item = next(frames, None)
+        if item is None:
+            break
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# === Execution modes ===
+_STOP = object()
+
+
+def _put(q, value, abort):
+    # Blocking put that gives up once another stage has failed, so a full queue cannot deadlock shutdown
+    while not abort.is_set():
+        try:
+            q.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, abort):
+    while not abort.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _STOP
+
+
+def process_items(ctx, items):
+    # All model stages, inline, for one batch of FrameItem
+    _detect_stage(ctx, items)
+    _identify_stage(ctx, items)
+    _emotion_stage(ctx, items)
+
+
+def _run_sequential(ctx, batches, consume):
+    for items in batches:
+        process_items(ctx, items)
+        consume(items)
+
+
+def _run_threaded(ctx, batches, consume):
+    # decode -> detect -> identify -> emotion -> consume (caller thread), linked by bounded queues.
+    # One worker per stage keeps batches in order (the tracker relies on it); a full queue blocks the
+    # upstream stage (backpressure).
+    queue_size = max(1, settings.PIPELINE_QUEUE_SIZE)
+    stages = [
+        ("detect", _detect_stage),
+        ("identify", _identify_stage),
+        ("emotion", _emotion_stage),
+    ]
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    abort = threading.Event()
+    errors = []
+
+    def decode_worker():
+        try:
+            for items in batches:
+                if not _put(queues[0], items, abort):
+                    return
+        except BaseException as e:
+            errors.append(("decode", e))
+            abort.set()
+        finally:
+            _put(queues[0], _STOP, abort)
+
+    def stage_worker(name, fn, inbox, outbox):
+        try:
+            while True:
+                items = _get(inbox, abort)
+                if items is _STOP:
+                    return
+                ctx.profiler.queue_depth(name, inbox.qsize())
+                fn(ctx, items)
+                if not _put(outbox, items, abort):
+                    return
+        except BaseException as e:
+            errors.append((name, e))
+            abort.set()
+        finally:
+            _put(outbox, _STOP, abort)
+
+    threads = [threading.Thread(target=decode_worker, name="pipeline-decode", daemon=True)]
+    for i, (name, fn) in enumerate(stages):
+        threads.append(threading.Thread(
+            target=stage_worker, args=(name, fn, queues[i], queues[i + 1]),
+            name=f"pipeline-{name}", daemon=True,
+        ))
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            items = _get(queues[-1], abort)
+            if items is _STOP:
+                break
+            ctx.profiler.queue_depth("aggregate", queues[-1].qsize())
+            consume(items)
+    except BaseException:
+        abort.set()
+        raise
+    finally:
+        if errors:
+            abort.set()
+        for t in threads:
+            t.join()
+
+    if errors:
+        name, err = errors[0]
+        raise RuntimeError(f"pipeline stage '{name}' failed: {err}") from err
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+def _progress(frames_processed, position_sec, duration_sec, elapsed_sec):
+    fps = frames_processed / elapsed_sec if elapsed_sec > 0 else 0.0
+    eta_sec = None
+    if duration_sec and position_sec > 0:
+        eta_sec = max(0.0, (duration_sec - position_sec) * elapsed_sec / position_sec)
+    return {
+        "frames_processed": frames_processed,
+        "position_sec": position_sec,
+        "duration_sec": duration_sec,
+        "elapsed_sec": elapsed_sec,
+        "fps": fps,
+        "eta_sec": eta_sec,
+    }
+
+
+def _save_buckets(db, video_id, rows):
+    # One transaction per ANALYSIS_PERSIST_CHUNK_SEC of video
+    chunk_sec = max(1, settings.ANALYSIS_PERSIST_CHUNK_SEC)
+    chunk = []
+    for row in rows:
+        if chunk and row[1] // chunk_sec != chunk[-1][1] // chunk_sec:
+            crud.save_analysis_chunk(db, video_id, chunk)
+            chunk = []
+        chunk.append(row)
+    if chunk:
+        crud.save_analysis_chunk(db, video_id, chunk)
+
+
+def _default_engine():
+    # Imported on first use, so callers that bring their own engine (benchmarks) never load the models
+    from services.ai_loader import ai_engine
+    return ai_engine
+
+
+def analyze_video(video_path: str, video_id: str, on_progress=None, start_sec: float = 0.0, end_sec: float = None,
+                  db: Session = None, engine=None):
+    # Runs the pipeline over [start_sec, end_sec] and returns the aggregates; unlike run_analysis_pipeline,
+    # errors propagate. on_progress(progress_dict) is called after every batch and may raise
+    # AnalysisCancelled to stop the run. With a db session, bucketed durations are written (replacing any
+    # earlier results for video_id) every ANALYSIS_PERSIST_CHUNK_SEC of video; without one they are
+    # returned under "buckets". engine defaults to the process-wide AIEngine.
+    engine = engine if engine is not None else _default_engine()
+    if engine.behavior_model is None:
+        raise RuntimeError("YOLO model unavailable")
+    source = open_frame_source(video_path, start_sec=start_sec, end_sec=end_sec)
+    batch_size = max(1, settings.PIPELINE_BATCH_SIZE)
+    started = time.monotonic()
+    frames_processed = 0
+    aggregate = AnalysisAggregate(settings.ANALYSIS_BUCKET_SEC)
+    profiler = PipelineProfiler(enabled=settings.PIPELINE_PROFILING)
+    next_flush = start_sec + settings.ANALYSIS_PERSIST_CHUNK_SEC
+    if db is not None:
+        crud.delete_analysis_results(db, video_id)
+
+    def consume(items):
+        nonlocal frames_processed, next_flush
+        position_sec = items[-1].timestamp
+        with profiler.stage("aggregate", len(items)):
+            _accumulate(items, aggregate)
+        frames_processed += len(items)
+        if db is not None and position_sec >= next_flush:
+            # Only buckets before the current one are complete
+            rows = aggregate.take_buckets(before=aggregate.bucket_of(items[-1]))
+            with profiler.stage("persist", len(rows)):
+                crud.save_analysis_chunk(db, video_id, rows)
+            next_flush += settings.ANALYSIS_PERSIST_CHUNK_SEC
+        if on_progress is not None:
+            on_progress(_progress(frames_processed, position_sec, source.duration, time.monotonic() - started))
+
+    try:
+        ctx = AnalysisContext(engine, tracker=create_tracker(), profiler=profiler)
+        batches = _iter_batches(source, batch_size, profiler)
+        if settings.PIPELINE_MODE == "threaded":
+            _run_threaded(ctx, batches, consume)
+        else:
+            _run_sequential(ctx, batches, consume)
+    finally:
+        source.close()
+
+    buckets = aggregate.take_buckets()
+    if db is not None:
+        with profiler.stage("persist", len(buckets)):
+            crud.save_analysis_chunk(db, video_id, buckets)
+        buckets = []
+    profile = profiler.report(frames_processed)
+    profiler.log(video_id, profile)
+    return {
+        "video_id": video_id,
+        "start_sec": start_sec,
+        "end_sec": end_sec,
+        "frames_processed": frames_processed,
+        "duration_sec": source.duration,
+        "elapsed_sec": time.monotonic() - started,
+        "student_behavior_time": {sid: dict(v) for sid, v in aggregate.behavior_time.items()},
+        "student_emotion_time": {sid: dict(v) for sid, v in aggregate.emotion_time.items()},
+        "buckets": buckets,
+        "profile": profile if profiler.enabled else None,
+    }
+
+
+# === Time-sharded analysis ===
+_shard_cancel = None
+
+
+def _init_shard_worker(num_threads: int, cancel_event):
+    global _shard_cancel
+    _shard_cancel = cancel_event
+    import torch
+    torch.set_num_threads(num_threads)
+
+
+def _check_shard_cancel(progress):
+    if _shard_cancel is not None and _shard_cancel.is_set():
+        raise AnalysisCancelled()
+
+
+def _analyze_shard(video_path: str, video_id: str, start_sec: float, end_sec: float):
+    # Runs in a shard process, which loads its own AIEngine on the first call
+    return analyze_video(video_path, video_id, on_progress=_check_shard_cancel, start_sec=start_sec, end_sec=end_sec)
+
+
+def job_cpu_share():
+    # Cores one analysis job gets when the pool is busy: JOB_WORKERS (default cores - 1) jobs split the machine.
+    # The job manager passes a larger budget when it dispatches a job onto otherwise idle cores.
+    cores = os.cpu_count() or 1
+    workers = settings.JOB_WORKERS or max(1, cores - 1)
+    return max(1, cores // workers)
+
+
+def plan_shards(duration_sec: float, shards: int, interval_sec: float, min_shard_sec: float = 0.0):
+    # [start, end] ranges on sampling-interval boundaries, so every target timestamp falls in exactly one
+    # shard; the last range is open-ended to absorb container duration errors
+    if not duration_sec or shards <= 1:
+        return [(0.0, None)]
+    steps = max(1, math.ceil(duration_sec / interval_sec))
+    per_shard = max(math.ceil(steps / shards), math.ceil(min_shard_sec / interval_sec), 1)
+    ranges = []
+    for first in range(0, steps, per_shard):
+        ranges.append((first * interval_sec, (first + per_shard) * interval_sec))
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+
+def merge_results(video_id: str, results):
+    # Results are summed in shard (time) order with sorted keys, so the float totals are identical
+    # no matter which shard finished first
+    behavior = defaultdict(lambda: defaultdict(float))
+    emotion = defaultdict(lambda: defaultdict(float))
+    buckets = defaultdict(float)
+    for result in results:
+        for totals, merged in ((result["student_behavior_time"], behavior), (result["student_emotion_time"], emotion)):
+            for student_id in sorted(totals):
+                for name in sorted(totals[student_id]):
+                    merged[student_id][name] += totals[student_id][name]
+        # A bucket cut by a shard boundary is summed back together
+        for student_id, bucket_start, category, label, seconds in result.get("buckets", []):
+            buckets[(student_id, bucket_start, category, label)] += seconds
+    return {
+        "video_id": video_id,
+        "start_sec": results[0]["start_sec"] if results else 0.0,
+        "end_sec": results[-1]["end_sec"] if results else None,
+        "frames_processed": sum(r["frames_processed"] for r in results),
+        "duration_sec": next((r["duration_sec"] for r in results if r["duration_sec"]), None),
+        "elapsed_sec": max((r["elapsed_sec"] for r in results), default=0.0),
+        "shards": len(results),
+        "student_behavior_time": {sid: dict(sorted(v.items())) for sid, v in sorted(behavior.items())},
+        "student_emotion_time": {sid: dict(sorted(v.items())) for sid, v in sorted(emotion.items())},
+        "buckets": [(*key, buckets[key]) for key in sorted(buckets)],
+        "profile": {"shards": [r.get("profile") for r in results]},
+    }
+
+
+def analyze_video_sharded(video_path: str, video_id: str, shards: int = None, on_progress=None, db: Session = None,
+                          cpu_budget: int = None):
+    # Splits the video into time ranges and analyzes each in its own process (own AIEngine, own tracker).
+    # Shards never write to the database; the merged buckets are persisted here once, in time order.
+    # on_progress is polled about once a second (progress counts finished shards) and may raise
+    # AnalysisCancelled, which stops the running shards at their next batch.
+    # cpu_budget is the number of cores this job may use (the job manager grants the cores idle at dispatch);
+    # without one the job assumes a full pool and takes job_cpu_share().
+    budget = max(1, cpu_budget or job_cpu_share())
+    requested = shards or settings.PIPELINE_SHARDS or budget
+    shards = min(requested, budget)
+    if shards < requested:
+        log_data.warning('analysis_shards_reduced|video_id=%s,requested=%s,shards=%s,cpu_budget=%s',
+                         video_id, requested, shards, budget)
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0
+    frame_total = cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+    cap.release()
+    duration = frame_total / fps if fps > 0 and frame_total > 0 else None
+    ranges = plan_shards(duration, shards, settings.PIPELINE_SAMPLE_INTERVAL_SEC, settings.PIPELINE_SHARD_MIN_SEC)
+    if len(ranges) == 1:
+        return analyze_video(video_path, video_id, on_progress=on_progress, db=db)
+
+    started = time.monotonic()
+    threads = max(1, budget // len(ranges))
+    mp_context = multiprocessing.get_context("spawn")
+    cancel_event = mp_context.Event()
+    executor = ProcessPoolExecutor(
+        max_workers=len(ranges),
+        mp_context=mp_context,
+        initializer=_init_shard_worker,
+        initargs=(threads, cancel_event),
+    )
+    try:
+        futures = [executor.submit(_analyze_shard, video_path, video_id, start, end) for start, end in ranges]
+        results = [None] * len(futures)
+        index_of = {future: i for i, future in enumerate(futures)}
+        pending = set(futures)
+        frames_processed = 0
+        covered = 0.0
+        while pending:
+            done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results[index_of[future]] = result
+                frames_processed += result["frames_processed"]
+                covered += (result["end_sec"] if result["end_sec"] is not None else (duration or 0.0)) - result["start_sec"]
+            if on_progress is not None:
+                on_progress(_progress(frames_processed, covered, duration, time.monotonic() - started))
+    except BaseException:
+        cancel_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    merged = merge_results(video_id, results)
+    if db is not None:
+        crud.delete_analysis_results(db, video_id)
+        _save_buckets(db, video_id, merged["buckets"])
+        merged["buckets"] = []
+    merged["elapsed_sec"] = time.monotonic() - started
+    return merged
+
+
+def run_analysis_pipeline(video_path: str, video_id: str, engine=None):
+    print(f"[{video_id}] Pipeline started for: {video_path}")
+    db: Session = SessionLocal()
+    try:
+        engine = engine if engine is not None else _default_engine()
+        if engine.behavior_model is None:
+            print(f"[{video_id}] YOLO model unavailable. Skipping processing.")
+            return None
+        result = analyze_video(video_path, video_id, db=db, engine=engine)
 
         print(f"[{video_id}] Pipeline finished and insights saved.")
+        return result
     except Exception as e:
         print(f"[{video_id}] Pipeline FAILED: {e}")
+        return None
     finally:
         try:
             db.close()
@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from core.fastapi_logger import log_data
+
+
+class StageStats:
+    __slots__ = ("calls", "total_sec", "items", "max_batch", "samples", "_seen")
+
+    def __init__(self):
+        self.calls = 0
+        self.total_sec = 0.0
+        self.items = 0
+        self.max_batch = 0
+        self.samples = []  # reservoir of call durations for the percentiles
+        self._seen = 0
+
+
+class PipelineProfiler:
+    # Per-stage wall time, call counts, batch sizes and queue depths for one pipeline run.
+    # Recording is a lock plus a few additions; percentiles come from a fixed-size reservoir,
+    # so memory stays flat on long videos.
+    def __init__(self, enabled: bool = True, max_samples: int = 1024):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.stages = {}
+        self.queues = {}  # name -> [samples, total depth, max depth]
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self.started = time.perf_counter()
+
+    def record(self, name: str, seconds: float, batch_size: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.calls += 1
+            stats.total_sec += seconds
+            stats.items += batch_size
+            stats.max_batch = max(stats.max_batch, batch_size)
+            stats._seen += 1
+            if len(stats.samples) < self.max_samples:
+                stats.samples.append(seconds)
+            else:
+                slot = self._rng.randrange(stats._seen)
+                if slot < self.max_samples:
+                    stats.samples[slot] = seconds
+
+    @contextmanager
+    def stage(self, name: str, batch_size: int = 1):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, batch_size)
+
+    def queue_depth(self, name: str, depth: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.queues.setdefault(name, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += depth
+            entry[2] = max(entry[2], depth)
+
+    def report(self, frames_processed: int = 0):
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            stages = {}
+            for name, stats in self.stages.items():
+                samples = np.array(stats.samples) if stats.samples else np.zeros(1)
+                p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+                stages[name] = {
+                    "calls": stats.calls,
+                    "total_sec": round(stats.total_sec, 4),
+                    "share": round(stats.total_sec / elapsed, 4) if elapsed > 0 else 0.0,
+                    "avg_batch": round(stats.items / stats.calls, 2) if stats.calls else 0.0,
+                    "max_batch": stats.max_batch,
+                    "p50_ms": round(p50 * 1000, 3),
+                    "p95_ms": round(p95 * 1000, 3),
+                    "p99_ms": round(p99 * 1000, 3),
+                }
+            queues = {
+                name: {"avg_depth": round(total / count, 2) if count else 0.0, "max_depth": peak}
+                for name, (count, total, peak) in self.queues.items()
+            }
+        return {
+            "elapsed_sec": round(elapsed, 4),
+            "frames_processed": frames_processed,
+            "fps": round(frames_processed / elapsed, 3) if elapsed > 0 else 0.0,
+            "stages": stages,
+            "queues": queues,
+        }
+
+    def log(self, video_id: str, report: dict):
+        if not self.enabled:
+            return
+        stages = ",".join(
+            f"{name}:{s['calls']}/{s['total_sec']:.3f}s/p95={s['p95_ms']:.1f}ms/b={s['avg_batch']}"
+            for name, s in sorted(report["stages"].items(), key=lambda kv: -kv[1]["total_sec"])
+        )
+        queues = ",".join(f"{name}:{q['avg_depth']}/{q['max_depth']}" for name, q in sorted(report["queues"].items()))
+        log_data.data('pipeline_profile|video_id=%s,frames=%d,elapsed=%.3f,fps=%.3f,stages=%s,queues=%s',
+                      video_id, report["frames_processed"], report["elapsed_sec"], report["fps"], stages, queues)
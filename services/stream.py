@@ -0,0 +1,222 @@
+import argparse
+import os
+import threading
+import time
+import cv2
+import numpy as np
+from sqlalchemy.orm import Session
+from core.config import settings
+from core.database import SessionLocal
+from core.fastapi_logger import log_data
+from db import crud
+from services.ai_loader import ai_engine
+from services.pipeline import AnalysisAggregate, AnalysisContext, FrameItem, create_tracker, process_items
+
+
+class LatestFrameBuffer:
+    # Single-slot hand-off between the capture thread and the analyzer: a new frame replaces the one
+    # waiting, so when inference falls behind the backlog is dropped instead of growing
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._entry = None
+        self._closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, index, timestamp, frame):
+        with self._cond:
+            if self._entry is not None:
+                self.dropped += 1
+            self._entry = (index, timestamp, time.monotonic(), frame)
+            self.received += 1
+            self._cond.notify()
+
+    def get(self, timeout: float = None):
+        # (index, timestamp, captured_at, frame), or None on timeout / once closed and empty
+        with self._cond:
+            if self._entry is None and not self._closed:
+                self._cond.wait(timeout)
+            entry, self._entry = self._entry, None
+            return entry
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+class StreamReader(threading.Thread):
+    # Reads a continuous source (RTSP/HTTP URL, camera index) as fast as it delivers frames.
+    # A local file is replayed at its own frame rate when realtime=True, standing in for a camera.
+    def __init__(self, source: str, buffer: LatestFrameBuffer, stop_event: threading.Event, realtime: bool = False):
+        super().__init__(name="stream-reader", daemon=True)
+        self.source = source
+        self.buffer = buffer
+        self.stop_event = stop_event
+        self.realtime = realtime
+        self.is_file = os.path.isfile(source)
+        self.error = None
+
+    def _open(self):
+        source = int(self.source) if self.source.isdigit() else self.source
+        return cv2.VideoCapture(source)
+
+    def run(self):
+        try:
+            self._read_loop()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.buffer.close()
+
+    def _read_loop(self):
+        index = 0
+        started = time.monotonic()
+        while not self.stop_event.is_set():
+            cap = self._open()
+            fps = cap.get(cv2.CAP_PROP_FPS) or 0
+            while not self.stop_event.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if self.is_file and fps > 0:
+                    timestamp = index / fps
+                    if self.realtime:
+                        delay = started + timestamp - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                else:
+                    timestamp = time.monotonic() - started
+                self.buffer.put(index, timestamp, frame)
+                index += 1
+            cap.release()
+            if self.is_file:
+                return
+            # Live source dropped: reconnect after a pause, keeping the stream clock running
+            log_data.warning('stream_reconnect|source=%s', self.source)
+            self.stop_event.wait(settings.STREAM_RECONNECT_SEC)
+
+
+def run_stream_analysis(source: str, stream_id: str, stop_event: threading.Event = None, realtime: bool = False,
+                        db: Session = None, on_flush=None):
+    # Analyzes a continuous source until stop_event is set (or a file source ends).
+    # Every STREAM_FLUSH_SEC the completed buckets are persisted under video_id=stream_id (when a db session
+    # is given) and on_flush(window_summary) receives the per-student totals of the elapsed window.
+    engine = ai_engine
+    if engine.behavior_model is None:
+        raise RuntimeError("YOLO model unavailable")
+    stop_event = stop_event or threading.Event()
+    buffer = LatestFrameBuffer()
+    reader = StreamReader(source, buffer, stop_event, realtime=realtime)
+    ctx = AnalysisContext(engine, tracker=create_tracker())
+    interval = settings.PIPELINE_SAMPLE_INTERVAL_SEC
+    budget = settings.STREAM_LATENCY_BUDGET_SEC
+
+    window = AnalysisAggregate(settings.ANALYSIS_BUCKET_SEC)
+    window_started = time.monotonic()
+    last_ts = None
+    processed = 0
+    stale = 0
+    over_budget = 0
+    latencies = []
+
+    def flush(final=False):
+        nonlocal window, window_started
+        current = None if final or last_ts is None else int(last_ts // window.bucket_sec) * window.bucket_sec
+        rows = window.take_buckets(before=current)
+        if db is not None and rows:
+            crud.save_analysis_chunk(db, stream_id, rows)
+        summary = {
+            "stream_id": stream_id,
+            "position_sec": last_ts,
+            "window_sec": time.monotonic() - window_started,
+            "frames_processed": processed,
+            "frames_dropped": buffer.dropped,
+            "frames_stale": stale,
+            "student_behavior_time": {sid: dict(v) for sid, v in window.behavior_time.items()},
+            "student_emotion_time": {sid: dict(v) for sid, v in window.emotion_time.items()},
+        }
+        log_data.data('stream_flush|stream_id=%s,position=%.1f,processed=%d,dropped=%d,stale=%d,students=%d',
+                      stream_id, last_ts or 0.0, processed, buffer.dropped, stale, len(window.behavior_time))
+        if on_flush is not None:
+            on_flush(summary)
+        # Buckets still in progress carry over into the next window
+        carry = window.buckets
+        window = AnalysisAggregate(settings.ANALYSIS_BUCKET_SEC)
+        window.buckets = carry
+        window_started = time.monotonic()
+
+    reader.start()
+    try:
+        while not stop_event.is_set():
+            entry = buffer.get(timeout=0.5)
+            if entry is None:
+                if buffer.closed:
+                    break
+                continue
+            index, timestamp, captured_at, frame = entry
+            if last_ts is not None and timestamp - last_ts < interval:
+                continue
+            if time.monotonic() - captured_at > budget:
+                # Already too old to report within the latency budget
+                stale += 1
+                continue
+
+            # The sample accounts for the time since the previous one, capped so an outage is not attributed
+            duration = interval if last_ts is None else min(timestamp - last_ts, settings.STREAM_MAX_SAMPLE_GAP_SEC)
+            item = FrameItem(index, timestamp, frame, duration=duration)
+            process_items(ctx, [item])
+            window.add([item])
+            item.frame = None
+            last_ts = timestamp
+            processed += 1
+
+            latency = time.monotonic() - captured_at
+            latencies.append(latency)
+            if latency > budget:
+                over_budget += 1
+            if time.monotonic() - window_started >= settings.STREAM_FLUSH_SEC:
+                flush()
+    finally:
+        stop_event.set()
+        reader.join(timeout=5)
+        flush(final=True)
+
+    if reader.error is not None:
+        raise RuntimeError(f"stream reader failed: {reader.error}") from reader.error
+    lat = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        "stream_id": stream_id,
+        "frames_received": buffer.received,
+        "frames_processed": processed,
+        "frames_dropped": buffer.dropped,
+        "frames_stale": stale,
+        "frames_over_budget": over_budget,
+        "latency_p50_sec": float(np.percentile(lat, 50)),
+        "latency_p95_sec": float(np.percentile(lat, 95)),
+        "latency_max_sec": float(lat.max()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze a live stream (or replay a file at real-time pace).")
+    parser.add_argument("source", help="RTSP/HTTP URL, camera index, or a local video file")
+    parser.add_argument("--stream-id", default="live")
+    parser.add_argument("--realtime", action="store_true", help="pace a file source at its frame rate")
+    parser.add_argument("--persist", action="store_true", help="write buckets/rollups to the database")
+    args = parser.parse_args()
+
+    session = SessionLocal() if args.persist else None
+    try:
+        stats = run_stream_analysis(args.source, args.stream_id, realtime=args.realtime, db=session,
+                                    on_flush=lambda summary: print(summary))
+        print(stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if session is not None:
+            session.close()
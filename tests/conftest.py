@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+import pytest
+
+# Importing db.vector_db opens the gallery at FAISS_INDEX_FILE, so every path the settings hold points into a
+# scratch directory before anything reads them
+_DATA_DIR = tempfile.mkdtemp(prefix="student-behavior-tests-")
+for _name, _file in (("FAISS_INDEX_FILE", "faiss_index.bin"), ("METADATA_FILE", "metadata.json"),
+                     ("FAISS_WAL_FILE", "faiss_index.wal"), ("UPLOAD_DIR", "uploads"),
+                     ("VIDEO_UPLOAD_DIR", "videos"), ("JOB_LOCK_FILE", "jobs.lock")):
+    os.environ[_name] = os.path.join(_DATA_DIR, _file)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DATA_DIR, 'app.db')}"
+
+
+@pytest.fixture
+def vector_settings(tmp_path, monkeypatch):
+    # A small flat gallery of 8-d vectors in tmp_path; rebuilds and snapshots only happen when a test asks
+    from core.config import settings
+    for name, value in (
+        ("FAISS_INDEX_FILE", str(tmp_path / "faiss_index.bin")),
+        ("METADATA_FILE", str(tmp_path / "metadata.json")),
+        ("FAISS_WAL_FILE", str(tmp_path / "faiss_index.wal")),
+        ("EMBEDDING_DIM", 8),
+        ("FAISS_WAL_FSYNC", False),
+        ("FAISS_SNAPSHOT_EVERY", 10 ** 9),
+        ("FAISS_SNAPSHOT_INTERVAL_SEC", 10 ** 9),
+        ("FAISS_INDEX_TYPE", "flat"),
+        ("FAISS_ENCODING", "float32"),
+        ("FAISS_COMPACT_RATIO", 2.0),
+        ("FAISS_GALLERY_MODE", "photos"),
+        ("FAISS_ROLE", "auto"),
+        ("FAISS_MMAP", False),
+        ("FAISS_READER_REFRESH_SEC", 0.0),
+        ("FAISS_THRESHOLD_COSINE", 0.9),
+    ):
+        monkeypatch.setattr(settings, name, value)
+    return settings
+
+
+@pytest.fixture
+def db_session():
+    # Every table on a private in-memory SQLite database, shared with the threads the API runs handlers on
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from core.database import Base
+    import db.models  # noqa: F401 (registers the tables)
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
@@ -0,0 +1,62 @@
+import pytest
+
+from db import crud, models
+
+
+def _rollups(db, video_id):
+    minutes = {(r.student_id, r.minute, r.category, r.label): r.seconds for r in crud.get_minute_rollups(db, video_id)}
+    session = {(r.student_id, r.category, r.label): r.seconds for r in crud.get_session_rollups(db, video_id)}
+    return minutes, session
+
+
+def _save_run(db, video_id):
+    crud.save_analysis_chunk(db, video_id, [
+        (1, 0, "behavior", "writing", 20.0),
+        (1, 30, "behavior", "writing", 10.0),
+        (2, 0, "emotion", "happy", 5.0),
+    ])
+    # Same minute and student as the first chunk: the existing rollup rows are incremented
+    crud.save_analysis_chunk(db, video_id, [
+        (1, 50, "behavior", "writing", 5.0),
+        (1, 60, "behavior", "writing", 7.0),
+        (2, 30, "emotion", "happy", 1.5),
+    ])
+
+
+def test_chunks_add_up_in_the_rollups(db_session):
+    _save_run(db_session, "video")
+    minutes, session = _rollups(db_session, "video")
+    assert minutes == {
+        (1, 0, "behavior", "writing"): pytest.approx(35.0),
+        (1, 1, "behavior", "writing"): pytest.approx(7.0),
+        (2, 0, "emotion", "happy"): pytest.approx(6.5),
+    }
+    assert session == {(1, "behavior", "writing"): pytest.approx(42.0), (2, "emotion", "happy"): pytest.approx(6.5)}
+    assert db_session.query(models.AnalysisDuration).count() == 6
+
+
+def test_rerun_replaces_earlier_results(db_session):
+    _save_run(db_session, "video")
+    crud.save_analysis_chunk(db_session, "other", [(1, 0, "behavior", "reading", 3.0)])
+    expected = _rollups(db_session, "video")
+
+    # A requeued job clears the video's rows before writing its chunks again
+    crud.delete_analysis_results(db_session, "video")
+    assert _rollups(db_session, "video") == ({}, {})
+    _save_run(db_session, "video")
+    assert _rollups(db_session, "video") == expected
+    assert db_session.query(models.AnalysisDuration).filter_by(video_id="video").count() == 6
+    assert _rollups(db_session, "other")[1] == {(1, "behavior", "reading"): 3.0}
+
+
+def test_deleting_a_student_takes_its_photos(db_session):
+    kept = crud.create_student(db_session, name="Kept")
+    gone = crud.create_student(db_session, name="Gone")
+    for student in (kept, gone, gone):
+        crud.create_student_photo(db_session, student.id, f"/uploads/{student.id}.jpg")
+
+    assert crud.delete_student(db_session, gone.id)
+    assert crud.get_student(db_session, gone.id) is None
+    assert crud.get_student_photos(db_session, gone.id) == []
+    assert [photo.student_id for photo in crud.get_student_photos(db_session, kept.id)] == [kept.id]
+
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from db.gallery import CentroidGallery
+
+DIM = 16
+
+
+def normalized(rows):
+    rows = np.asarray(rows, dtype='float32')
+    return rows / np.linalg.norm(rows, axis=-1, keepdims=True)
+
+
+def enrolled(students=12, photos=4, noise=0.15, seed=0):
+    # (student ids, photo vectors): each student's photos scatter around their own random direction
+    rng = np.random.default_rng(seed)
+    centers = normalized(rng.normal(size=(students, DIM)))
+    owners = np.repeat(np.arange(1, students + 1), photos)
+    vectors = normalized(centers[owners - 1] + noise * rng.normal(size=(len(owners), DIM)))
+    return owners, vectors
+
+
+def test_incremental_adds_match_one_batch():
+    owners, vectors = enrolled()
+    batch = CentroidGallery(DIM)
+    batch.add(owners, np.arange(len(owners)), vectors)
+    incremental = CentroidGallery(DIM)
+    for position in np.random.default_rng(1).permutation(len(owners)):
+        incremental.add(owners[[position]], [position], vectors[[position]])
+
+    assert len(incremental) == len(batch) == 12
+    for student_id in range(1, 13):
+        mine = vectors[owners == student_id]
+        expected = normalized(mine.sum(axis=0))
+        for gallery in (batch, incremental):
+            row = gallery._rows[student_id]
+            assert gallery._centroids[row] == pytest.approx(expected, abs=1e-5)
+            assert sorted(gallery._positions[row]) == np.flatnonzero(owners == student_id).tolist()
+
+
+def test_removed_photos_leave_the_centroid_and_empty_students_drop_out():
+    owners, vectors = enrolled(students=3, photos=2)
+    gallery = CentroidGallery(DIM)
+    gallery.add(owners, np.arange(6), vectors)
+
+    gallery.remove([1], [0], vectors[[0]])
+    assert gallery._centroids[gallery._rows[1]] == pytest.approx(vectors[1], abs=1e-5)
+    gallery.remove([1, 2], [1, 3], vectors[[1, 3]])
+    gallery.remove([2], [3], vectors[[3]])  # already gone: ignored
+    assert len(gallery) == 2 and 1 not in gallery._rows
+    assert gallery._centroids[gallery._rows[2]] == pytest.approx(vectors[2], abs=1e-5)
+
+    reconstruct = lambda positions: vectors[positions]
+    students, _ = gallery.candidates(vectors[[0]], 3)
+    assert sorted(students[0].tolist()) == [-1, 2, 3]  # the emptied row is still scored, as nobody
+    assert all(student_id in (2, 3) for student_id, _ in gallery.identify(vectors[:2], reconstruct))
+    assert gallery.identify(vectors[[2]], reconstruct)[0] == (2, pytest.approx(1.0))
+
+    # Re-enrolling a student who dropped out starts from their new photos only
+    gallery.add([1], [6], vectors[[0]])
+    assert gallery._centroids[gallery._rows[1]] == pytest.approx(vectors[0], abs=1e-5)
+
+
+def test_voting_agrees_with_a_flat_scan():
+    owners, vectors = enrolled(students=20, photos=5, noise=0.05)
+    gallery = CentroidGallery(DIM)
+    gallery.add(owners, np.arange(len(owners)), vectors)
+    queries = normalized(vectors + 0.05 * np.random.default_rng(2).normal(size=vectors.shape))
+    reconstruct = lambda positions: vectors[positions]
+
+    similarities = queries @ vectors.T
+    nearest = owners[similarities.argmax(axis=1)].tolist()
+    best = pytest.approx(similarities.max(axis=1).tolist(), abs=1e-5)
+    # One vote is exactly the flat scan, as long as the nearest photo's owner made the shortlist
+    matches = gallery.identify(queries, reconstruct, candidates=5, vote_k=1)
+    assert [student_id for student_id, _ in matches] == nearest
+    assert [similarity for _, similarity in matches] == best
+    # With separated students the vote picks the same owner, reporting their best photo
+    matches = gallery.identify(queries, reconstruct, candidates=5, vote_k=5)
+    assert [student_id for student_id, _ in matches] == nearest
+    assert [similarity for _, similarity in matches] == best
+
+
+def test_close_photos_outvote_more_distant_ones():
+    query = normalized(np.eye(DIM)[0])
+    close = normalized([np.eye(DIM)[0] + 0.1 * np.eye(DIM)[1], np.eye(DIM)[0] + 0.1 * np.eye(DIM)[2]])
+    distant = normalized([np.eye(DIM)[0] + 1.2 * np.eye(DIM)[i] for i in (3, 4, 5)])
+    vectors = np.vstack([close, distant])
+    gallery = CentroidGallery(DIM)
+    gallery.add([7, 7, 9, 9, 9], np.arange(5), vectors)
+
+    student_id, similarity = gallery.identify(query[None], lambda positions: vectors[positions], vote_k=5)[0]
+    assert student_id == 7
+    assert similarity == pytest.approx(float(close[0] @ query))
+    assert gallery.identify(query[None], lambda positions: vectors[positions], vote_k=1)[0][0] == 7
+    assert CentroidGallery(DIM).identify(query[None], lambda positions: vectors[positions]) == [(None, 0.0)]
@@ -0,0 +1,24 @@
+from concurrent.futures import Future
+
+from services.jobs import JobManager
+
+
+def test_lone_sharded_job_gets_the_idle_cores(monkeypatch):
+    from core.config import settings
+    monkeypatch.setattr(settings, "PIPELINE_SHARDS", 4)
+    monkeypatch.setattr("services.jobs.os.cpu_count", lambda: 8)
+    manager = JobManager(max_workers=7)
+    assert manager._grant_cores(1) == [8]
+    assert manager._grant_cores(3) == [3, 3, 2]
+
+    # A job already holding six cores leaves two for the next one, and never less than one each
+    manager._running, manager._cores = {1: Future()}, {1: 6}
+    assert manager._grant_cores(1) == [2]
+    assert manager._grant_cores(4) == [1, 1, 1, 1]
+
+
+def test_unsharded_jobs_run_on_their_worker_share(monkeypatch):
+    from core.config import settings
+    monkeypatch.setattr(settings, "PIPELINE_SHARDS", 0)
+    monkeypatch.setattr("services.jobs.os.cpu_count", lambda: 8)
+    assert JobManager(max_workers=4)._grant_cores(2) == [2, 2]
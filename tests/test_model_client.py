@@ -0,0 +1,53 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from services.ai_loader import AIEngine
+from services.model_client import ModelUnavailable, RemoteEngine, _RemoteBehaviorModel
+from services.model_server import ModelServer
+
+
+class _LocalEngine:
+    # Stands in for the in-process fallback; `models` maps a name to what get_model returns
+    emotion_classes = []
+    device = "cpu"
+
+    def __init__(self, **models):
+        self.models = models
+
+    def get_model(self, name, warmup=False):
+        return self.models.get(name)
+
+
+def test_model_stuck_loading_falls_back_after_the_timeout(tmp_path, monkeypatch):
+    from core.config import settings
+    monkeypatch.setattr(settings, "MODEL_SERVER_PRELOAD", [])
+    release = threading.Event()
+
+    class StuckEngine(AIEngine):
+        def _load_behavior(self):
+            release.wait()
+            return None
+
+    server = ModelServer(str(tmp_path / "models.sock"), StuckEngine())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for _ in range(100):
+            if (tmp_path / "models.sock").exists():
+                break
+            time.sleep(0.02)
+        local_model = object()
+        engine = RemoteEngine(server.path, _LocalEngine(behavior=local_model), timeout=1.0)
+        assert engine.get_model("behavior") is local_model
+    finally:
+        release.set()
+        server.stop()
+
+
+def test_fallback_without_a_local_model_raises_a_clear_error(tmp_path):
+    engine = RemoteEngine(str(tmp_path / "missing.sock"), _LocalEngine(), timeout=1.0)
+    model = _RemoteBehaviorModel(engine, {0: "writing"})
+    with pytest.raises(ModelUnavailable, match="behavior model is unavailable"):
+        model([np.zeros((8, 8, 3), dtype=np.uint8)])
@@ -0,0 +1,196 @@
+import cv2
+import numpy as np
+import pytest
+
+from services.pipeline import (FRAME_SOURCES, AnalysisAggregate, Detection, FrameItem, IoUTracker, MotionSampler,
+                              assign_faces_to_boxes, merge_results, plan_shards)
+
+
+def test_faces_go_to_the_box_that_contains_them():
+    people = np.array([[0, 0, 100, 200], [100, 0, 200, 200], [200, 0, 300, 200]], dtype=np.float32)
+    faces = np.array([
+        [130, 10, 170, 50],   # inside the second person
+        [20, 10, 60, 50],     # inside the first
+        [290, 10, 330, 50],   # only a quarter inside the third
+    ], dtype=np.float32)
+    assert assign_faces_to_boxes(faces, people).tolist() == [1, 0, -1]
+    assert assign_faces_to_boxes(faces, people, min_containment=0.2).tolist() == [1, 0, 2]
+
+
+def test_largest_face_wins_a_box():
+    people = np.array([[0, 0, 200, 200]], dtype=np.float32)
+    faces = np.array([[10, 10, 30, 30], [50, 10, 110, 70], [150, 150, 160, 160]], dtype=np.float32)
+    assert assign_faces_to_boxes(faces, people).tolist() == [1]
+
+
+def test_straddling_face_goes_to_the_better_overlap():
+    people = np.array([[0, 0, 100, 100], [60, 0, 400, 300]], dtype=np.float32)
+    face = np.array([[60, 10, 100, 50]], dtype=np.float32)  # fully inside both boxes
+    assert assign_faces_to_boxes(face, people).tolist() == [0, -1]
+
+
+def test_no_faces_or_no_boxes():
+    people = np.array([[0, 0, 100, 200]], dtype=np.float32)
+    assert assign_faces_to_boxes(np.empty((0, 4), dtype=np.float32), people).tolist() == [-1]
+    assert assign_faces_to_boxes(people, np.empty((0, 4), dtype=np.float32)).tolist() == []
+
+
+def test_tracks_keep_their_ids_while_moving():
+    tracker = IoUTracker(iou_threshold=0.3, max_age_sec=5.0)
+    ids = None
+    for step in range(6):
+        # Two people walk towards each other, 15 px a second; the detector lists them in either order
+        left = [10 + 15 * step, 0, 60 + 15 * step, 100]
+        right = [200 - 15 * step, 0, 250 - 15 * step, 100]
+        boxes = [right, left] if step % 2 else [left, right]
+        tracks = tracker.update(boxes, timestamp=float(step))
+        by_side = dict(zip(("right", "left") if step % 2 else ("left", "right"), (t.track_id for t in tracks)))
+        if ids is None:
+            ids = by_side
+        assert by_side == ids
+    assert len(tracker.tracks) == 2
+
+
+def test_track_id_handoff_after_max_age():
+    tracker = IoUTracker(iou_threshold=0.3, max_age_sec=2.0)
+    box = [0, 0, 50, 100]
+    first = tracker.update([box], 0.0)[0]
+    assert tracker.update([], 1.0) == []
+    assert tracker.update([box], 2.0)[0] is first  # gone for a moment: same track and identity cache
+    assert tracker.update([box], 5.0)[0].track_id != first.track_id  # unseen past max_age: a new person
+
+
+def test_hold_keeps_static_tracks_alive():
+    tracker = IoUTracker(iou_threshold=0.3, max_age_sec=2.0)
+    track = tracker.update([[0, 0, 50, 100]], 0.0)[0]
+    tracker.hold(3.0)  # a reused (static) sample counts as seeing the same boxes
+    assert tracker.update([[0, 0, 50, 100]], 4.0)[0] is track
+
+
+def test_plan_shards_cuts_on_sample_boundaries():
+    assert plan_shards(100.0, 4, 1.0) == [(0.0, 25.0), (25.0, 50.0), (50.0, 75.0), (75.0, None)]
+    assert plan_shards(100.0, 4, 1.0, min_shard_sec=40.0) == [(0.0, 40.0), (40.0, 80.0), (80.0, None)]
+    assert plan_shards(10.0, 3, 2.0) == [(0.0, 4.0), (4.0, 8.0), (8.0, None)]
+    assert plan_shards(None, 4, 1.0) == [(0.0, None)]
+    assert plan_shards(100.0, 1, 1.0) == [(0.0, None)]
+
+
+def _shard(start, end, frames, behavior, buckets):
+    return {
+        "start_sec": start, "end_sec": end, "frames_processed": frames, "duration_sec": 60.0,
+        "elapsed_sec": frames / 10, "student_behavior_time": behavior, "student_emotion_time": {},
+        "buckets": buckets, "profile": {"frames": frames},
+    }
+
+
+def test_merge_results_sums_shards_and_rejoins_cut_buckets():
+    first = _shard(0.0, 30.0, 30, {1: {"writing": 20.0}, 2: {"sleeping": 5.0}},
+                   [(1, 0.0, "behavior", "writing", 20.0), (1, 30.0, "behavior", "writing", 0.0)])
+    second = _shard(30.0, None, 31, {1: {"writing": 10.0, "reading": 3.0}},
+                    [(1, 0.0, "behavior", "writing", 2.0), (1, 30.0, "behavior", "reading", 3.0)])
+    merged = merge_results("video", [first, second])
+    assert merged["frames_processed"] == 61
+    assert (merged["start_sec"], merged["end_sec"], merged["shards"]) == (0.0, None, 2)
+    assert merged["student_behavior_time"] == {1: {"reading": 3.0, "writing": 30.0}, 2: {"sleeping": 5.0}}
+    assert merged["buckets"] == [
+        (1, 0.0, "behavior", "writing", 22.0),
+        (1, 30.0, "behavior", "reading", 3.0),
+        (1, 30.0, "behavior", "writing", 0.0),
+    ]
+
+
+def _gray(level, timestamp):
+    return FrameItem(0, timestamp, np.full((72, 128, 3), level, dtype=np.uint8))
+
+
+def _observe(sampler, level, timestamp):
+    item = _gray(level, timestamp)
+    interval = sampler.observe(item)
+    return item.reuse, interval
+
+
+def test_static_scene_doubles_the_interval_up_to_the_max_and_reuses():
+    sampler = MotionSampler(1.0, 0.5, 4.0, static_threshold=2.0, spike_threshold=12.0, max_reuse_sec=10.0)
+    assert _observe(sampler, 100, 0.0) == (False, 1.0)  # nothing to compare with: analyzed, no spike
+    assert _observe(sampler, 100, 1.0) == (True, 2.0)
+    assert _observe(sampler, 100, 3.0) == (True, 4.0)
+    assert _observe(sampler, 100, 7.0) == (True, 4.0)
+    assert _observe(sampler, 100, 11.0) == (False, 1.0)  # max_reuse_sec since the last analysis
+
+
+def test_motion_spike_drops_to_the_min_interval():
+    sampler = MotionSampler(1.0, 0.5, 4.0, static_threshold=2.0, spike_threshold=12.0, max_reuse_sec=10.0)
+    _observe(sampler, 100, 0.0)
+    assert _observe(sampler, 100, 1.0) == (True, 2.0)
+    assert _observe(sampler, 150, 3.0) == (False, 0.5)
+    assert _observe(sampler, 155, 3.5) == (False, 1.0)  # moving, but no longer a spike: back to the base interval
+
+
+def test_reference_only_moves_on_analyzed_frames():
+    sampler = MotionSampler(1.0, 0.5, 4.0, static_threshold=2.0, spike_threshold=12.0, max_reuse_sec=10.0)
+    _observe(sampler, 100, 0.0)
+    assert _observe(sampler, 101, 1.0)[0]
+    # One level from the previous frame, but two from the last analyzed one: the drift adds up
+    assert not _observe(sampler, 102, 3.0)[0]
+    assert _observe(sampler, 103, 4.0)[0]
+
+
+def _seen(student_id, behavior, emotion):
+    det = Detection([0, 0, 10, 10], behavior)
+    det.student_id, det.emotion = student_id, emotion
+    return det
+
+
+def test_reused_samples_repeat_the_last_analyzed_detections():
+    aggregate = AnalysisAggregate(bucket_sec=60)
+    analyzed = _gray(0, 1.0)
+    analyzed.detections = [_seen(1, "writing", "happy"), _seen(None, "reading", "neutral")]
+    reused = _gray(0, 3.0)
+    reused.duration, reused.reuse = 2.0, True
+    aggregate.add([analyzed, reused])
+    assert reused.detections is analyzed.detections
+    assert aggregate.behavior_time == {1: {"writing": 3.0}}
+    assert aggregate.emotion_time == {1: {"happy": 3.0}}
+
+    empty = _gray(0, 4.0)  # an analyzed sample with nobody in it is repeated as well
+    later = _gray(0, 8.0)
+    later.duration, later.reuse = 4.0, True
+    aggregate.add([empty, later])
+    assert later.detections == []
+    assert aggregate.take_buckets() == [(1, 0, "behavior", "writing", 3.0), (1, 0, "emotion", "happy", 3.0)]
+
+
+@pytest.fixture(scope="module")
+def clip(tmp_path_factory):
+    # 6 s at 10 fps; frame i is a flat gray of level 4 * i, so a sample shows which frame served it
+    path = str(tmp_path_factory.mktemp("video") / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10.0, (64, 48))
+    assert writer.isOpened()
+    for i in range(60):
+        writer.write(np.full((48, 64, 3), 4 * i, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def _samples(path, backend, **kwargs):
+    source = FRAME_SOURCES[backend](path, interval_sec=1.0, **kwargs)
+    try:
+        return [(round(float(item.frame.mean()) / 4), item.timestamp, item.duration) for item in source]
+    finally:
+        source.close()
+
+
+@pytest.mark.parametrize("backend", ["read", "grab", "seek"])
+def test_backends_sample_every_target_including_the_last(clip, backend):
+    samples = _samples(clip, backend)
+    # The target at 6.0 s is past the last frame (5.9 s) but within the clip, so that frame serves it
+    assert [frame for frame, _, _ in samples] == [10, 20, 30, 40, 50, 59]
+    assert [timestamp for _, timestamp, _ in samples] == pytest.approx([1, 2, 3, 4, 5, 6], abs=0.1 + 1e-6)
+    assert [duration for _, _, duration in samples] == pytest.approx([1.0] * 6)
+
+
+@pytest.mark.parametrize("backend", ["read", "grab", "seek"])
+def test_backends_split_into_shards_without_gaps(clip, backend):
+    first = _samples(clip, backend, end_sec=3.0)
+    second = _samples(clip, backend, start_sec=3.0)
+    assert [frame for frame, _, _ in first + second] == [10, 20, 30, 40, 50, 59]
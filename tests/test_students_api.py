@@ -0,0 +1,29 @@
+import os
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api import students_api
+from core.database import get_db
+from db import crud
+
+
+def test_delete_student_removes_photo_rows_and_files(db_session, tmp_path, monkeypatch):
+    from core.config import settings
+    monkeypatch.setattr(settings, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(students_api.vector_db_instance, "remove_student", lambda student_id: 2)
+    app = FastAPI()
+    app.include_router(students_api.router)
+    app.dependency_overrides[get_db] = lambda: db_session
+
+    student = crud.create_student(db_session, name="Gone")
+    other = crud.create_student(db_session, name="Kept")
+    for name, owner in (("a.jpg", student), ("b.jpg", student), ("c.jpg", other)):
+        (tmp_path / name).write_bytes(b"jpeg")
+        crud.create_student_photo(db_session, owner.id, f"/uploads/{name}")
+    crud.update_student(db_session, student.id, photo_path="/uploads/b.jpg")
+
+    reply = TestClient(app).delete(f"/students/{student.id}").json()
+    assert reply["reply"] == {"success": True, "embeddings_removed": 2}
+    assert crud.get_student_photos(db_session, student.id) == []
+    assert sorted(os.listdir(tmp_path)) == ["c.jpg"]
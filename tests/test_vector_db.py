@@ -0,0 +1,222 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from db.vector_db import WAL_ADD, ReadOnlyVectorDB, VectorDB, WriterUnavailable, _WAL_HEADER, student_of
+
+DIM = 8
+RECORD_SIZE = _WAL_HEADER.size + DIM * 4  # one logged add
+
+
+def unit(seed):
+    vector = np.random.default_rng(seed).normal(size=DIM).astype('float32')
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def open_db(vector_settings):
+    opened = []
+
+    def open_db():
+        db = VectorDB()
+        opened.append(db)
+        return db
+
+    yield open_db
+    for db in opened:
+        db.close()
+
+
+def test_replay_restores_logged_changes(open_db, vector_settings):
+    db = open_db()
+    db.add_embedding(1, unit(1))
+    removed = db.add_embedding(1, unit(2))
+    db.add_embeddings([2, 2], np.stack([unit(3), unit(4)]))
+    db.remove_embeddings([removed])
+    db.close()
+
+    db = open_db()
+    assert db.index.ntotal == 4
+    assert db._tombstones == {removed}
+    assert db.metadata == {"1": 1, "2": 2}
+    assert db.search_embedding(unit(1)) == (1, pytest.approx(1.0))
+    assert db.search_embedding(unit(2))[1] < 0.999  # the removed vector no longer matches itself
+    assert db.next_seq == 5
+
+
+def test_replay_truncates_torn_tail(open_db, vector_settings):
+    db = open_db()
+    db.add_embeddings([1, 2], np.stack([unit(1), unit(2)]))
+    db.close()
+    with open(vector_settings.FAISS_WAL_FILE, "ab") as f:
+        f.write(bytes([WAL_ADD]) + b"\x00" * (RECORD_SIZE // 2))  # crash halfway through an append
+
+    db = open_db()
+    assert db.index.ntotal == 2
+    assert os.path.getsize(vector_settings.FAISS_WAL_FILE) == 2 * RECORD_SIZE
+    # Records appended after the truncation replay as well
+    db.add_embedding(3, unit(3))
+    db.close()
+    db = open_db()
+    assert db.index.ntotal == 3
+    assert db.search_embedding(unit(3))[0] == 3
+
+
+def test_snapshot_drops_covered_records(open_db, vector_settings):
+    db = open_db()
+    db.add_embeddings([1, 2], np.stack([unit(1), unit(2)]))
+    assert db.snapshot()
+    assert os.path.getsize(vector_settings.FAISS_WAL_FILE) == 0
+    db.add_embedding(3, unit(3))
+    db.close()
+
+    db = open_db()
+    assert db.index.ntotal == 3
+    assert db.snapshot_lsn == 2
+    assert db.next_lsn == 4
+
+
+def test_reader_leaves_torn_tail_to_the_writer(open_db, vector_settings):
+    writer = open_db()
+    writer.add_embedding(1, unit(1))
+    reader = open_db()
+    assert reader.read_only
+    assert reader.index_status()["ntotal"] == 1
+
+    writer.add_embedding(2, unit(2))
+    wal = vector_settings.FAISS_WAL_FILE
+    with open(wal, "rb") as f:
+        logged = f.read()
+    with open(wal, "r+b") as f:
+        f.truncate(len(logged) - 10)  # the writer is still appending its second record
+
+    assert reader.index_status()["ntotal"] == 1
+    assert os.path.getsize(wal) == len(logged) - 10
+    with open(wal, "ab") as f:
+        f.write(logged[-10:])
+    assert reader.index_status()["ntotal"] == 2
+    assert reader.search_embedding(unit(2))[0] == 2
+
+
+def test_reader_follows_removals_and_snapshots(open_db, vector_settings):
+    writer = open_db()
+    first = writer.add_embedding(1, unit(1))
+    reader = open_db()
+    writer.remove_embeddings([first])
+    writer.add_embedding(2, unit(2))
+    assert reader.search_embedding(unit(1))[0] is None
+    assert reader.search_embedding(unit(2))[0] == 2
+
+    writer.snapshot()
+    writer.add_embedding(3, unit(3))
+    status = reader.index_status()
+    assert (status["ntotal"], status["tombstones"], status["delta"]) == (3, 1, 1)
+    assert reader.search_embedding(unit(3))[0] == 3
+
+
+def test_reader_forwards_changes_to_the_writer(open_db, vector_settings, monkeypatch):
+    writer = open_db()
+    writer.add_embedding(1, unit(1))
+    reader = open_db()
+    monkeypatch.setattr(vector_settings, "FAISS_READER_REFRESH_SEC", 3600.0)
+
+    embedding_id = reader.add_embedding(2, unit(2))
+    assert student_of(embedding_id) == 2
+    assert writer.search_embedding(unit(2))[0] == 2
+    assert reader.search_embedding(unit(2))[0] == 2  # seen at once, not at the next refresh
+    assert reader.remove_student(1) == 1
+    assert writer.metadata == {"2": 1}
+    with pytest.raises(ValueError):
+        reader.add_embeddings([1, 2], unit(3)[None])  # the writer's error comes back as is
+    with pytest.raises(ReadOnlyVectorDB):
+        reader._append(WAL_ADD, [(2 << 32) | 9], unit(3)[None])
+
+
+class _GalleryFault(Exception):
+    def __init__(self, lock):
+        super().__init__("fault")
+        self.lock = lock  # cannot be pickled
+
+
+def test_writer_errors_that_cannot_be_pickled_still_reach_the_reader(open_db, vector_settings, monkeypatch):
+    writer = open_db()
+    reader = open_db()
+    monkeypatch.setattr(vector_settings, "FAISS_WRITER_TIMEOUT_SEC", 2.0)  # a lost reply would be WriterUnavailable
+
+    def fail(student_id):
+        raise _GalleryFault(threading.Lock())
+
+    monkeypatch.setattr(writer, "remove_student", fail)
+    with pytest.raises(RuntimeError, match="_GalleryFault"):
+        reader.remove_student(1)
+    monkeypatch.setattr(writer, "remove_student", lambda student_id: threading.Lock())
+    with pytest.raises(RuntimeError, match="cannot return"):
+        reader.remove_student(1)
+    assert reader.add_embedding(1, unit(1)) is not None  # the connection is still usable
+
+
+def test_reader_without_writer_changes_nothing(open_db, vector_settings):
+    writer = open_db()
+    writer.add_embedding(1, unit(1))
+    reader = open_db()
+    writer.close()
+    size = os.path.getsize(vector_settings.FAISS_WAL_FILE)
+
+    with pytest.raises(WriterUnavailable):
+        reader.add_embedding(2, unit(2))
+    with pytest.raises(WriterUnavailable):
+        reader.remove_student(1)
+    assert os.path.getsize(vector_settings.FAISS_WAL_FILE) == size
+    assert reader.index_status()["ntotal"] == 1
+
+
+def test_embedding_ids_pack_student_and_sequence(open_db, vector_settings):
+    db = open_db()
+    ids = db.add_embeddings([7, 3, 7], np.stack([unit(1), unit(2), unit(3)]))
+    assert student_of(ids).tolist() == [7, 3, 7]
+    assert (ids & 0xFFFFFFFF).tolist() == [1, 2, 3]
+    assert db.add_embedding(3, unit(4)) == (3 << 32) | 4
+    assert db.metadata == {"7": 2, "3": 2}
+    with pytest.raises(ValueError):
+        db.add_embedding(0, unit(5))
+    with pytest.raises(ValueError):
+        db.add_embedding(1 << 31, unit(5))
+
+
+def test_removed_embeddings_are_skipped_until_compaction(open_db, vector_settings):
+    db = open_db()
+    ids = db.add_embeddings([1, 1, 2, 3], np.stack([unit(1), unit(2), unit(3), unit(4)]))
+    assert db.remove_embeddings([ids[0], ids[0], 12345]) == 1  # duplicates and unknown ids are ignored
+    assert db.remove_student(2) == 1
+    assert db.remove_embeddings([ids[0]]) == 0  # already removed
+    assert db._tombstones == {int(ids[0]), int(ids[2])}
+    assert db.metadata == {"1": 1, "3": 1}
+    assert db.search_embedding(unit(1))[0] is None
+    assert db.search_embedding(unit(3))[0] is None
+    assert db.search_embedding(unit(2))[0] == 1
+
+    db.rebuild_index("flat", reason="compact", wait=True)
+    assert db.index.ntotal == 2
+    assert db._tombstones == set()
+    assert sorted(db._stored_ids().tolist()) == sorted([int(ids[1]), int(ids[3])])
+    assert db.search_embedding(unit(4))[0] == 3
+    # The compacted index is what the next process opens
+    db.close()
+    db = open_db()
+    assert db.index.ntotal == 2
+    assert db._tombstones == set()
+    assert db.add_embedding(1, unit(5)) & 0xFFFFFFFF == 5  # sequence numbers are never reused
+
+
+def test_tombstones_trigger_compaction(open_db, vector_settings, monkeypatch):
+    db = open_db()
+    ids = db.add_embeddings([1, 2, 3, 4], np.stack([unit(i) for i in range(4)]))
+    db.remove_embeddings(ids[:1])
+    monkeypatch.setattr(vector_settings, "FAISS_COMPACT_RATIO", 0.5)
+    assert db._rebuild_target() is None
+    monkeypatch.setattr(vector_settings, "FAISS_COMPACT_RATIO", 2.0)
+    db.remove_embeddings(ids[1:2])
+    monkeypatch.setattr(vector_settings, "FAISS_COMPACT_RATIO", 0.5)
+    assert db._rebuild_target() == ("flat", "compact 2 tombstone(s)")